@@ -1064,6 +1064,9 @@ class Config(ConfigObject):
     def get_user_model_dir(self):
         return os.path.join(self.user_dir, "models")
 
+    def get_user_spellcheck_dir(self):
+        return os.path.join(self.user_dir, "spellcheck")
+
     def get_system_model_dir(self):
         return os.path.join(self.install_dir, "models")
 
@@ -2123,7 +2126,9 @@ class ConfigWordSuggestions(ConfigObject):
         self.add_key("punctuation-assistance", True)
         self.add_key("delayed-word-separators-enabled", False)
         self.add_key("accent-insensitive", True)
+        self.add_key("typo-tolerant", True)
         self.add_key("max-word-choices", 5)
+        self.add_key("model-cache-size", 64)
         self.add_key("spelling-suggestions-enabled", True)
         self.add_key("wordlist-buttons",
                      [self.KEY_ID_PREVIOUS_PREDICTIONS,
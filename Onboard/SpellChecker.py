@@ -22,11 +22,19 @@ from __future__ import division, print_function, unicode_literals
 
 import os
 import subprocess
-import time
 import re
 import glob
-
-from Onboard.utils import unicode_str
+import threading
+import struct
+import mmap
+import hashlib
+import bisect
+import array
+import codecs
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from Onboard.utils import unicode_str, XDGDirs
 
 import Onboard.osk as osk
 
@@ -35,30 +43,52 @@ _logger = logging.getLogger(__name__)
 
 
 class SpellChecker(object):
-    MAX_QUERY_CACHE_SIZE = 100    # max number of cached queries
+    MAX_QUERY_CACHE_SIZE = 100    # max number of cached misspellings
+    MAX_CORRECT_WORDS = 10000     # max number of known correct words
 
-    def __init__(self, language_db = None):
+    def __init__(self, language_db = None, cache_dir = None):
         self._language_db = language_db
+        self._cache_dir = cache_dir
         self._backend = None
-        self._cached_queries = {}
+
+        # Queries with results, least recently used first.
+        self._cached_queries = OrderedDict()
+
+        # Negative cache, hashes of words without results, i.e. spelled
+        # correctly. Persisted per backend and dictionary. Only hashes
+        # are kept, typed text never ends up on disk in plain text.
+        self._correct_words = set()
+        self._correct_words_modified = False
+
+        # Backends aren't thread-safe, the lock serializes queries of
+        # the worker thread and the main thread.
+        self._backend_lock = threading.Lock()
+        self._executor = None
+        self._pending_word = None
+        self._pending_query = None
+        self._num_dropped_queries = 0   # tells superseded queries apart
 
     def set_backend(self, backend):
         """ Switch spell check backend on the fly """
         if backend is None:
-            if self._backend:
-                self._backend.stop()
-            self._backend = None
+            _class = None
+        elif backend == 0:
+            _class = hunspell
         else:
-            if backend == 0:
-                _class = hunspell
-            else:
-                _class = aspell_cmd
+            _class = aspell_cmd
 
-            if not self._backend or \
-               not type(self._backend) == _class:
+        current_class = type(self._backend) if self._backend else None
+        if not current_class == _class:
+            self.save_correct_words()
+            self._correct_words = set()
+
+            with self._backend_lock:
                 if self._backend:
                     self._backend.stop()
-                self._backend = _class()
+                if _class is hunspell:
+                    self._backend = _class(cache_dir=self._cache_dir)
+                else:
+                    self._backend = _class() if _class else None
 
         self.invalidate_query_cache()
 
@@ -67,10 +97,17 @@ class SpellChecker(object):
         ids = self._find_matching_dicts(dict_ids)
         if self._backend and \
            not ids == self._backend.get_active_dict_ids():
-            self._backend.stop()
-            if ids:
-                self._backend.start(ids)
-                success = True
+            self.save_correct_words()
+            self._correct_words = set()
+
+            with self._backend_lock:
+                self._backend.stop()
+                if ids:
+                    self._backend.start(ids)
+                    success = True
+
+            if success:
+                self._load_correct_words()
             else:
                 _logger.info("No matching dictionaries for '{backend}' {dicts}" \
                              .format(backend=type(self._backend),
@@ -115,17 +152,26 @@ class SpellChecker(object):
 
         return result
 
-    def find_corrections(self, word, caret_offset):
+    def find_corrections(self, word, caret_offset, done_callback = None):
         """
         Return spelling suggestions for word.
         Multiple result sets may be returned, as the spell
         checkers may return more than one result for certain tokens,
         e.g. before and after hyphens.
+
+        With done_callback, don't wait for the backend. Words that
+        aren't cached yet return no suggestions and are queried in a
+        worker thread instead. done_callback is called from the worker
+        thread once the results are ready, unless a later call
+        superseded the query.
         """
         span = None
         suggestions = []
         if self._backend:
-            results = self.query_cached(word)
+            if done_callback:
+                results = self.query_cached_async(word, done_callback)
+            else:
+                results = self.query_cached(word)
             # hunspell splits words at underscores and then
             # returns results for multiple sub-words.
             # -> find the sub-word at the current caret offset.
@@ -153,39 +199,224 @@ class SpellChecker(object):
             spans = [result[0] for result in results]
         return spans
 
+    def find_incorrect_spans_many(self, words):
+        """
+        Like find_incorrect_spans, but for multiple words at once.
+        Returns a list of spans for each word.
+        """
+        if not self._backend:
+            return [[] for word in words]
+        return [[result[0] for result in results]
+                for results in self.query_many_cached(words)]
+
     def query_cached(self, word):
         """
         Return cached query or ask the backend if necessary.
         """
-        query = self._cached_queries.get(word)
-        if query is None:
-            # limit cache size
-            size = len(self._cached_queries)
-            if size >= self.MAX_QUERY_CACHE_SIZE:
-                new_size = size // 2
-
-                _logger.debug("shrinking query cache from {} to {} entries." \
-                              .format(size, new_size))
-
-                # discard the oldest entries
-                queries = sorted(self._cached_queries.items(),
-                                 key = lambda x: x[1][0])
-                self._cached_queries = dict(queries[new_size:])
+        self._add_finished_query()
 
+        results = self._get_cached_query(word)
+        if results is None:
             # query backend
             results = self.query(word)
-            query = [0.0, results]
-            self._cached_queries[word] = query
+            if results is None:
+                return []
+            self._add_query(word, results)
+
+        return results
+
+    def query_many_cached(self, words):
+        """
+        Return cached queries for words, ask the backend about
+        the uncached ones in a single batch.
+        """
+        self._add_finished_query()
+
+        results = [self._get_cached_query(word) for word in words]
+        missing = list(OrderedDict.fromkeys(
+            word for word, r in zip(words, results) if r is None))
+        if missing:
+            new_results = dict(zip(missing, self.query_many(missing)))
+            for word in missing:
+                r = new_results[word]
+                if r is None:
+                    new_results[word] = []   # unknown, don't cache
+                else:
+                    self._add_query(word, r)
+            results = [new_results[word] if r is None else r
+                       for word, r in zip(words, results)]
+
+        return results
+
+    def query_cached_async(self, word, done_callback):
+        """
+        Return cached query, or no results if the backend has to be asked.
+        Uncached words are queried in the worker thread, dropping
+        queued queries of other words. Latest request wins.
+        """
+        self._add_finished_query()
+
+        results = self._get_cached_query(word)
+        if results is None:
+            if word != self._pending_word:
+                self._cancel_pending_query()
+                future = self._get_executor().submit(self.query, word)
+                self._pending_word = word
+                self._pending_query = future
+                num_dropped = self._num_dropped_queries
+                future.add_done_callback(
+                    lambda f: self._on_query_done(f, num_dropped,
+                                                  done_callback))
+            return []
+
+        # the caret moved on to a known word
+        self._cancel_pending_query()
+
+        return results
 
-        query[0] = time.time()
+    def _on_query_done(self, future, num_dropped, done_callback):
+        """
+        Runs in the worker thread. The callback is due unless the
+        query was dropped, even if the main thread already moved the
+        results into the cache.
+        """
+        if num_dropped == self._num_dropped_queries and \
+           not future.cancelled():
+            done_callback()
+
+    def _add_finished_query(self):
+        """ Move results of the worker thread into the cache. """
+        future = self._pending_query
+        if future and future.done():
+            word = self._pending_word
+            self._pending_word = None
+            self._pending_query = None
+            if not future.cancelled():
+                results = future.result()
+                if results is not None:
+                    self._add_query(word, results)
+
+    def _cancel_pending_query(self):
+        """
+        Drop the pending query. Queued queries won't run anymore, a
+        running query finishes, but its results are ignored.
+        """
+        if self._pending_query:
+            self._pending_query.cancel()
+            self._num_dropped_queries += 1
+        self._pending_word = None
+        self._pending_query = None
+
+    def _get_cached_query(self, word):
+        """ Return cached results or None if word isn't cached. """
+        if CorrectWordFilter.hash_word(word) in self._correct_words:
+            return []
+
+        results = self._cached_queries.get(word)
+        if results is not None:
+            self._cached_queries.move_to_end(word)
+        return results
 
-        return query[1]
+    def _add_query(self, word, results):
+        if results:
+            # discard the least recently used entry
+            if len(self._cached_queries) >= self.MAX_QUERY_CACHE_SIZE:
+                self._cached_queries.popitem(last=False)
+            self._cached_queries[word] = results
+        else:
+            # make room for the new word, any entry will do
+            if len(self._correct_words) >= self.MAX_CORRECT_WORDS:
+                self._correct_words.pop()
+            self._correct_words.add(CorrectWordFilter.hash_word(word))
+            self._correct_words_modified = True
+
+    def _get_executor(self):
+        if not self._executor:
+            # A single thread, the backend can't run queries in parallel.
+            self._executor = ThreadPoolExecutor(1)
+        return self._executor
 
     def query(self, word):
-        return self._backend.query(word)
+        """
+        Ask the backend. Returns None if there was no answer, e.g.
+        because the backend failed to start, so that the caller doesn't
+        mistake the word for being spelled correctly.
+        """
+        with self._backend_lock:
+            if not self._backend or \
+               not self._backend.is_running():
+                return None
+            return self._backend.query(word)
+
+    def query_many(self, words):
+        with self._backend_lock:
+            if not self._backend or \
+               not self._backend.is_running():
+                return [None for word in words]
+            return self._backend.query_many(words)
 
     def invalidate_query_cache(self):
-        self._cached_queries = {}
+        """
+        Forget misspellings, words may have been added to the dictionary.
+        Correct words stay correct and are kept.
+        """
+        self._cancel_pending_query()
+        self._cached_queries = OrderedDict()
+
+    def cleanup(self):
+        self.save_correct_words()
+
+    def save_correct_words(self):
+        """
+        Store the negative cache for the next session.
+        Nothing is saved if the backend isn't running anymore, its
+        last answers can't be trusted.
+        """
+        with self._backend_lock:
+            is_running = bool(self._backend) and self._backend.is_running()
+        filename = self._get_correct_words_filename()
+        if filename and self._correct_words_modified and is_running:
+            _logger.info("Saving correct words '{}'".format(filename))
+            try:
+                XDGDirs.assure_user_dir_exists(self._cache_dir)
+                tmp_filename = filename + ".tmp"
+                hashes = array.array("Q", sorted(self._correct_words))
+                with open(tmp_filename, "wb") as f:
+                    f.write(hashes.tobytes())
+                os.rename(tmp_filename, filename)
+                self._correct_words_modified = False
+            except (IOError, OSError) as e:
+                _logger.warning("Failed to save correct words '{}': {}"
+                                .format(filename, unicode_str(e)))
+
+    def _load_correct_words(self):
+        words = set()
+        filename = self._get_correct_words_filename()
+        if filename and os.path.exists(filename):
+            try:
+                hashes = array.array("Q")
+                with open(filename, "rb") as f:
+                    hashes.frombytes(f.read())
+                words = set(hashes)
+            except (IOError, OSError, ValueError) as e:
+                _logger.warning("Failed to load correct words '{}': {}"
+                                .format(filename, unicode_str(e)))
+
+        self._correct_words = words
+        self._correct_words_modified = False
+
+    def _get_correct_words_filename(self):
+        """
+        Words are spelled correctly only with respect to the active
+        backend and dictionaries, each combination has its own file.
+        """
+        if self._cache_dir and self._backend:
+            dict_ids = self._backend.get_active_dict_ids()
+            if dict_ids:
+                name = "{}-{}.bin".format(type(self._backend).__name__,
+                                          "+".join(dict_ids))
+                return os.path.join(self._cache_dir, name)
+        return None
 
     def get_supported_dict_ids(self):
         return self._backend.get_supported_dict_ids()
@@ -212,6 +443,10 @@ class SCBackend(object):
     def is_running(self):
         return NotImplementedError()
 
+    # Max number of lines sent ahead of the replies. Small enough that
+    # neither pipe buffer fills up while the other side is blocked.
+    MAX_PENDING_LINES = 32
+
     def query(self, text):
         """
         Query for spelling suggestions.
@@ -219,45 +454,85 @@ class SCBackend(object):
         list of suggestions. The spell checker backend decides about
         word boundaries.
         """
-        results = []
+        return self.query_many([text])[0]
 
+    def query_many(self, texts):
+        """
+        Query spelling suggestions for multiple texts at once.
+        Lines are streamed into the pipe ahead of the replies, instead
+        of waiting a full round trip for each of them.
+        Returns a list of results for each text, None for texts
+        that weren't answered because the process died.
+        """
         # Check if the process is still running, it might have
         # exited on start due to an unknown dictinary name.
         if self._p and not self._p.poll() is None:
             self._p = None
 
-        if self._p:
+        if not self._p:
+            return [None for text in texts]
 
-            # unicode?
-            if type(text) == type(""):
-                line = "^" + text + "\n"
-                line = line.encode("UTF-8")
-            else: # already UTF-8 byte array
-                line = b"^" + text + b"\n"
+        results = []
+        num_pending = 0
+        try:
+            for text in texts:
+                self._write_line(text)
+                num_pending += 1
+                if num_pending >= self.MAX_PENDING_LINES:
+                    self._p.stdin.flush()
+                    results.append(self._read_reply())
+                    num_pending -= 1
 
-            self._p.stdin.write(line)
             self._p.stdin.flush()
-            while True:
-                s = self._p.stdout.readline().decode("UTF-8")
-                s = s.strip()
-                if not s:
-                    break
-                if s[:1] == "&":
-                    sections = s.split(":")
-                    a = sections[0].split()
-                    begin = int(a[3]) - 1 # -1 for the prefixed ^
-                    end   = begin + len(a[1])
-                    span = [begin, end, a[1]] # begin, end, word
-                    suggestions = sections[1].strip().split(', ')
-                    results.append([span, suggestions])
-                if s[:1] == "#":
-                    sections = s.split(":")
-                    a = sections[0].split()
-                    begin = int(a[2]) - 1 # -1 for the prefixed ^
-                    end   = begin + len(a[1])
-                    span = [begin, end, a[1]] # begin, end, word
-                    suggestions = []
-                    results.append([span, suggestions])
+            for i in range(num_pending):
+                results.append(self._read_reply())
+        except (IOError, OSError) as e:  # broken pipe
+            _logger.warning("'{}' stopped responding: {}"
+                            .format(type(self).__name__, unicode_str(e)))
+
+        results += [None] * (len(texts) - len(results))
+        return results
+
+    def _write_line(self, text):
+        # unicode?
+        if type(text) == type(""):
+            line = "^" + text.replace("\n", " ") + "\n"
+            line = line.encode("UTF-8")
+        else: # already UTF-8 byte array
+            line = b"^" + text.replace(b"\n", b" ") + b"\n"
+
+        self._p.stdin.write(line)
+
+    def _read_reply(self):
+        """
+        Parse the results of one line, terminated by an empty line.
+        Returns None at the end of the output, there is no reply.
+        """
+        results = []
+        while True:
+            line = self._p.stdout.readline()
+            if not line:
+                return None
+            s = line.decode("UTF-8")
+            s = s.strip()
+            if not s:
+                break
+            if s[:1] == "&":
+                sections = s.split(":")
+                a = sections[0].split()
+                begin = int(a[3]) - 1 # -1 for the prefixed ^
+                end   = begin + len(a[1])
+                span = [begin, end, a[1]] # begin, end, word
+                suggestions = sections[1].strip().split(', ')
+                results.append([span, suggestions])
+            if s[:1] == "#":
+                sections = s.split(":")
+                a = sections[0].split()
+                begin = int(a[2]) - 1 # -1 for the prefixed ^
+                end   = begin + len(a[1])
+                span = [begin, end, a[1]] # begin, end, word
+                suggestions = []
+                results.append([span, suggestions])
 
         return results
 
@@ -289,8 +564,10 @@ class hunspell(SCBackend):
     >>> sp.query("jdaskljasd")  # doctest: +ELLIPSIS
     [[...
     """
-    def __init__(self, dict_ids = None):
+    def __init__(self, dict_ids = None, cache_dir = None):
         self._osk_hunspell = None
+        self._cache_dir = cache_dir
+        self._word_filter = None
         SCBackend.__init__(self, dict_ids)
         if dict_ids:
             self.start(dict_ids)
@@ -312,12 +589,46 @@ class hunspell(SCBackend):
                                   unicode_str(e))
                     self._osk_hunspell = None
 
+            if self._osk_hunspell and self._cache_dir:
+                self._start_word_filter(dict_ids[0], dic, aff)
+
     def stop(self):
         super(hunspell, self).stop()
         if self.is_running():
             self._osk_hunspell = None
+            self._word_filter = None
             self._active_dicts = None
 
+    def _start_word_filter(self, dict_id, dic, aff):
+        """
+        Map the correct word filter of the dictionary, build it
+        in the background if there is none yet.
+        """
+        filename = os.path.join(self._cache_dir,
+                                "hunspell-{}.filter".format(dict_id))
+        word_filter = CorrectWordFilter.load(filename, dic, aff)
+        if word_filter:
+            self._word_filter = word_filter
+        else:
+            osk_hunspell = self._osk_hunspell
+
+            def build():
+                try:
+                    word_filter = CorrectWordFilter.build(filename, dic, aff)
+                except Exception as e:
+                    _logger.warning("failed to build correct word filter "
+                                    "'{}': {}"
+                                    .format(filename, unicode_str(e)))
+                    return
+
+                # still the same dictionary?
+                if self._osk_hunspell is osk_hunspell:
+                    self._word_filter = word_filter
+
+            thread = threading.Thread(target=build)
+            thread.daemon = True
+            thread.start()
+
     def is_running(self):
         return not self._osk_hunspell is None
 
@@ -405,9 +716,15 @@ class hunspell(SCBackend):
         results = []
 
         if self._osk_hunspell:
+            word_filter = self._word_filter
             matches = self.SPLITWORDS.finditer(text)
             for match in matches:
                 word = match.group()
+
+                # common case, known correct word
+                if word_filter and word in word_filter:
+                    continue
+
                 begin = match.start()
                 end   = match.end()
                 span = [begin, end, word]
@@ -424,6 +741,10 @@ class hunspell(SCBackend):
 
         return results
 
+    def query_many(self, texts):
+        """ No round trips in the C API, just query one after another. """
+        return [self.query(text) for text in texts]
+
     def get_supported_dict_ids(self):
         """
         Return raw supported dictionary ids.
@@ -518,6 +839,201 @@ class hunspell(SCBackend):
         return paths
 
 
+class CorrectWordFilter(object):
+    """
+    Words a hunspell dictionary accepts, stored as sorted 64 bit hashes.
+
+    Built once per dictionary from the .dic stems, expanded with single
+    prefixes and suffixes of the .aff file. Every candidate is verified
+    with hunspell before it is added, so lookups have no false positives
+    beyond hash collisions. Anything not found falls through to hunspell.
+    The file is cached in the user directory and memory mapped on later
+    starts.
+    """
+    MAGIC = b"OSKWF001"
+    # magic, dic mtime, dic size, aff mtime, aff size, number of hashes
+    HEADER = struct.Struct("=8sqqqqQ")
+
+    def __init__(self, hashes, mmapped = None):
+        self._hashes = hashes
+        self._mmap = mmapped  # keeps the mapping alive
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, word):
+        h = self.hash_word(word)
+        hashes = self._hashes
+        i = bisect.bisect_left(hashes, h)
+        return i < len(hashes) and hashes[i] == h
+
+    @staticmethod
+    def hash_word(word):
+        digest = hashlib.blake2b(word.encode("UTF-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    @classmethod
+    def load(cls, filename, dic, aff):
+        """
+        Map a previously built filter. Returns None if there is none
+        or if the dictionary changed since it was built.
+        """
+        try:
+            with open(filename, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+
+        header_size = cls.HEADER.size
+        if len(mm) < header_size:
+            return None
+        fields = cls.HEADER.unpack_from(mm)
+        count = fields[-1]
+        if not fields[:-1] == cls._get_header_fields(dic, aff) or \
+           not len(mm) == header_size + count * 8:
+            return None
+
+        hashes = memoryview(mm)[header_size:].cast("Q")
+        return cls(hashes, mm)
+
+    @classmethod
+    def build(cls, filename, dic, aff):
+        """
+        Build the filter with a private hunspell instance, so it
+        may run in parallel with queries, and save it to filename.
+        """
+        _logger.info("building correct word filter '{}'".format(filename))
+        header_fields = cls._get_header_fields(dic, aff)
+        oh = osk.Hunspell(aff, dic)
+        encoding = cls._get_python_encoding(oh.get_encoding())
+
+        hashes = set()
+        for word in cls._expand_dic(dic, aff, encoding):
+            try:
+                if oh.spell(word):
+                    hashes.add(cls.hash_word(word))
+            except UnicodeEncodeError:
+                pass
+        hashes = array.array("Q", sorted(hashes))
+
+        XDGDirs.assure_user_dir_exists(os.path.dirname(filename))
+        # unique, stopping and restarting may build concurrently
+        tmp_filename = "{}.{}.tmp".format(filename, threading.get_ident())
+        with open(tmp_filename, "wb") as f:
+            f.write(cls.HEADER.pack(*(header_fields + (len(hashes),))))
+            f.write(hashes.tobytes())
+        os.rename(tmp_filename, filename)
+
+        _logger.info("correct word filter '{}' has {} words"
+                     .format(filename, len(hashes)))
+        return cls(hashes)
+
+    @classmethod
+    def _get_header_fields(cls, dic, aff):
+        sdic = os.stat(dic)
+        saff = os.stat(aff)
+        return (cls.MAGIC, sdic.st_mtime_ns, sdic.st_size,
+                saff.st_mtime_ns, saff.st_size)
+
+    @staticmethod
+    def _get_python_encoding(encoding):
+        """ Translate hunspell's encoding names, e.g. microsoft-cp1251. """
+        for name in (encoding, encoding.split("-")[-1]):
+            try:
+                return codecs.lookup(name).name
+            except LookupError:
+                pass
+        return "UTF-8"
+
+    @classmethod
+    def _expand_dic(cls, dic, aff, encoding):
+        """ Generate candidate words, stems with a single affix each. """
+        flag_type, aliases, prefixes, suffixes = \
+            cls._read_affixes(aff, encoding)
+
+        with open(dic, encoding=encoding, errors="replace") as f:
+            f.readline()  # word count
+            for line in f:
+                # drop morphological fields
+                entry = line.split("\t")[0].split(" ")[0].strip()
+                word, _sep, flags = entry.partition("/")
+                if not word:
+                    continue
+                yield word
+
+                if flags:
+                    if aliases and flags.isdigit():
+                        flags = aliases[int(flags) - 1] \
+                                if 0 < int(flags) <= len(aliases) else ""
+                    for flag in cls._split_flags(flags, flag_type):
+                        for strip, add, condition in prefixes.get(flag, ()):
+                            if word.startswith(strip) and \
+                               condition.match(word):
+                                yield add + word[len(strip):]
+                        for strip, add, condition in suffixes.get(flag, ()):
+                            if word.endswith(strip) and \
+                               condition.search(word):
+                                yield word[:len(word) - len(strip)] + add
+
+    @staticmethod
+    def _split_flags(flags, flag_type):
+        if flag_type == "long":
+            return [flags[i:i+2] for i in range(0, len(flags), 2)]
+        if flag_type == "num":
+            return flags.split(",")
+        return list(flags)
+
+    @classmethod
+    def _read_affixes(cls, aff, encoding):
+        """
+        Parse the flag type, flag aliases and affix rules of an .aff file.
+        Continuation classes are ignored.
+        """
+        flag_type = None
+        aliases = []
+        num_aliases = None
+        prefixes = {}
+        suffixes = {}
+
+        with open(aff, encoding=encoding, errors="replace") as f:
+            for line in f:
+                fields = line.split()
+                if not fields:
+                    continue
+                keyword = fields[0]
+                if keyword == "FLAG" and len(fields) > 1:
+                    flag_type = fields[1]
+                elif keyword == "AF" and len(fields) > 1:
+                    if num_aliases is None:  # first line, the count
+                        num_aliases = fields[1]
+                    else:
+                        aliases.append(fields[1])
+                elif keyword in ("PFX", "SFX") and len(fields) >= 5 and \
+                     not (fields[2] in ("Y", "N") and fields[3].isdigit()):
+                    flag, strip, add, condition = fields[1:5]
+                    strip = "" if strip == "0" else strip
+                    add = add.split("/")[0]
+                    add = "" if add == "0" else add
+                    if keyword == "PFX":
+                        pattern = "^" + cls._condition_to_regex(condition)
+                        rules = prefixes
+                    else:
+                        pattern = cls._condition_to_regex(condition) + "$"
+                        rules = suffixes
+                    try:
+                        regex = re.compile(pattern)
+                    except re.error:
+                        continue
+                    rules.setdefault(flag, []).append((strip, add, regex))
+
+        return flag_type, aliases, prefixes, suffixes
+
+    @staticmethod
+    def _condition_to_regex(condition):
+        return "".join(c if c in "[]^." else re.escape(c)
+                       for c in condition)
+
+
 class SCBackend_cmd(SCBackend):
     """ Abstract base class of command line backends """
 
@@ -533,56 +1049,8 @@ class SCBackend_cmd(SCBackend):
             self._p = None
 
     def is_running(self):
-        return not self._p is None
-
-    def query(self, text):
-        """
-        Query for spelling suggestions.
-        Text may contain one or more words. Each word generates its own
-        list of suggestions. The spell checker backend decides about
-        word boundaries.
-        """
-        results = []
-
-        # Check if the process is still running, it might have
-        # exited on start due to an unknown dictinary name.
-        if self._p and not self._p.poll() is None:
-            self._p = None
-
-        if self._p:
-
-            # unicode?
-            if type(text) == type(""):
-                line = "^" + text + "\n"
-                line = line.encode("UTF-8")
-            else: # already UTF-8 byte array
-                line = b"^" + text + b"\n"
-
-            self._p.stdin.write(line)
-            self._p.stdin.flush()
-            while True:
-                s = self._p.stdout.readline().decode("UTF-8")
-                s = s.strip()
-                if not s:
-                    break
-                if s[:1] == "&":
-                    sections = s.split(":")
-                    a = sections[0].split()
-                    begin = int(a[3]) - 1 # -1 for the prefixed ^
-                    end   = begin + len(a[1])
-                    span = [begin, end, a[1]] # begin, end, word
-                    suggestions = sections[1].strip().split(', ')
-                    results.append([span, suggestions])
-                if s[:1] == "#":
-                    sections = s.split(":")
-                    a = sections[0].split()
-                    begin = int(a[2]) - 1 # -1 for the prefixed ^
-                    end   = begin + len(a[1])
-                    span = [begin, end, a[1]] # begin, end, word
-                    suggestions = []
-                    results.append([span, suggestions])
-
-        return results
+        # the process may have exited, e.g. on an unknown dictionary
+        return not self._p is None and self._p.poll() is None
 
     def get_supported_dict_ids(self):
         """
@@ -710,6 +1178,9 @@ class aspell_cmd(SCBackend):
                             " ".join(args), e))
             self._p = None
 
+    def is_running(self):
+        return not self._p is None and self._p.poll() is None
+
     def get_supported_dict_ids(self):
         """
         Return raw supported dictionary ids.
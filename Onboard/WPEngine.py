@@ -22,6 +22,8 @@ from __future__ import division, print_function, unicode_literals
 import os
 import time
 import logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from Onboard.utils import unicode_str, XDGDirs
 from Onboard.Timer import Timer
@@ -64,10 +66,12 @@ class WPLocalEngine(object):
         self.persistent_models = []
         self.auto_learn_models = []
         self.scratch_models = []
+        self._session = None
+        self._session_models = []
 
     def cleanup(self):
         self._auto_save_timer.stop()
-        self._model_cache.save_models()
+        self._model_cache.save_models(final=True)
 
     def set_models(self, persistent_models, auto_learn_models, scratch_models):
         """ Fixme: rename to "set_model_ids" """
@@ -76,13 +80,22 @@ class WPLocalEngine(object):
         self.auto_learn_models = auto_learn_models
         self.auto_learn_models = auto_learn_models
         self.scratch_models = scratch_models
+        self._model_cache.set_pinned_models(self.models)
 
     def load_models(self):
         """
-        Pre-load models set with set_models. If this isn't called,
+        Pre-load models set with set_models in the background.
+        Returns a future per model. If this isn't called,
         language models are lazy-loaded on demand.
         """
-        self._model_cache.get_models(self.models)
+        return self._model_cache.load_models_async(self.models)
+
+    def prefetch_models(self, lmids):
+        """
+        Load models that may be needed soon in the background,
+        if they fit into the model cache.
+        """
+        self._model_cache.prefetch_models(lmids)
 
     def postpone_autosave(self):
         self._auto_save_timer.postpone()
@@ -101,8 +114,17 @@ class WPLocalEngine(object):
                 accent_insensitive=False,
                 accent_insensitive_smart=False,
                 ignore_capitalized=False,
-                ignore_non_capitalized=False):
-        """ Find completion/prediction choices. """
+                ignore_non_capitalized=False,
+                ignore_markers=False,
+                prefer_lower_case=False,
+                capitalize=False,
+                fuzzy_prefix=False):
+        """
+        Find completion/prediction choices. Post-filtering of the choices,
+        i.e. ignore_markers, prefer_lower_case and capitalize, happens
+        before limiting them. With fuzzy_prefix, completions of prefixes
+        within a small edit distance are included, ranked below exact ones.
+        """
         LanguageModel = pypredict.LanguageModel
         options = 0
         if case_insensitive:
@@ -117,6 +139,14 @@ class WPLocalEngine(object):
             options |= LanguageModel.IGNORE_CAPITALIZED
         if ignore_non_capitalized:
             options |= LanguageModel.IGNORE_NON_CAPITALIZED
+        if ignore_markers:
+            options |= LanguageModel.IGNORE_MARKERS
+        if prefer_lower_case:
+            options |= LanguageModel.PREFER_LOWER_CASE
+        if capitalize:
+            options |= LanguageModel.CAPITALIZE
+        if fuzzy_prefix:
+            options |= LanguageModel.FUZZY_PREFIX
 
         context, spans = pypredict.tokenize_context(context_line)
         choices = self._get_prediction(self.models, context, limit, options)
@@ -206,12 +236,13 @@ class WPLocalEngine(object):
         There is one lookup result per token and language model. Each lookup
         result is either 0 for no match, 1 for an exact match or -n for
         count n partial (prefix) matches.
+        Models still being loaded don't know any tokens yet.
         """
         tokspans  = [(spans[i][0], spans[i][1], t)
                      for i, t in enumerate(tokens)]
         counts = [[0 for lmid in lmids] for t in tokspans]
         for i, lmid in enumerate(lmids):
-            model = self._model_cache.get_model(lmid)
+            model = self._model_cache.get_model(lmid, block=False)
             if model:
                 for j, t in enumerate(tokspans):
                     counts[j][i] = model.lookup_word(t[2])
@@ -226,11 +257,12 @@ class WPLocalEngine(object):
     def word_exists(self, word):
         """
         Does word exist in any of the non-scratch models?
+        Models still being loaded are skipped, like in predict().
         """
         exists = False
         lmids = self.persistent_models
         for i, lmid in enumerate(lmids):
-            model = self._model_cache.get_model(lmid)
+            model = self._model_cache.get_model(lmid, block=False)
             if model:
                 count = model.lookup_word(word)
                 if count > 0:
@@ -282,8 +314,19 @@ class WPLocalEngine(object):
             return ""
 
     def _get_prediction(self, lmdesc, context, limit, options):
+        # Don't wait for models still being loaded, predict
+        # without them for now.
         lmids, weights = self._model_cache.parse_lmdesc(lmdesc)
-        models = self._model_cache.get_models(lmids)
+        models = []
+        lookup_models = []
+        for lmid in lmids:
+            m = self._model_cache.get_model(lmid, block=False)
+            if m:
+                models.append(m)
+                # Words typed into scratch models don't decide
+                # about PREFER_LOWER_CASE, like in word_exists().
+                if lmid in self.persistent_models:
+                    lookup_models.append(m)
 
         for m in models:
             # Kneser-ney perfomes best in entropy and ksr measures, but
@@ -306,27 +349,44 @@ class WPLocalEngine(object):
                 m.recency_smoothing = "jelinek-mercer"
                 m.recency_lambdas = [0.404, 0.831, 0.444]
 
-        model = pypredict.overlay(models)
-        # model = pypredict.linint(models, weights)
-        # model = pypredict.loglinint(models, weights)
-
-        choices = model.predictp(context, limit, options=options)
+        session = self._get_session(models, weights, lookup_models)
+        choices = session.predictp(context, limit, options=options)
 
         return choices
 
+    def _get_session(self, models, weights, lookup_models):
+        """
+        Keep the prediction session as long as the component models
+        stay the same. The session caches the candidates of the last
+        prediction and narrows them down while a word is being typed.
+        """
+        if self._session is None or \
+           len(models) != len(self._session_models) or \
+           any(m1 is not m2 for m1, m2 in zip(models, self._session_models)):
+            model = pypredict.overlay(models)
+            # model = pypredict.linint(models, weights)
+            # model = pypredict.loglinint(models, weights)
+            model.set_lookup_models(lookup_models)
+            self._session = pypredict.PredictionSession(model)
+            self._session_models = models
+        return self._session
+
     def remove_context(self, context):
         """
         Remove the last word of context in the given context.
         If len(context) == 1 then all occurences of the word will be removed.
         """
         lmids, weights = self._model_cache.parse_lmdesc(self.auto_learn_models)
-        models = self._model_cache.get_models(lmids)
-        for i, m in enumerate(models):
+        for lmid in lmids:
+            # Don't wait for models still being loaded, like predict().
+            m = self._model_cache.get_model(lmid, block=False)
+            if not m:
+                continue
             changes = m.remove_context(context)
 
             # debug output
             _logger.debug("removing {} from '{}': {} n-grams affected"
-                          .format(context, lmids[i], len(changes)))
+                          .format(context, lmid, len(changes)))
             if _logger.isEnabledFor(logging.DEBUG):
                 changes = sorted(sorted(changes.items()),
                                  key=lambda x: -len(x[0]))
@@ -336,33 +396,200 @@ class WPLocalEngine(object):
 
 
 class ModelCache:
-    """ Loads and caches language models """
+    """
+    Loads and caches language models.
+
+    Models may be loaded in the background by worker threads. Only the
+    workers touch a model until it is done loading, the cache itself is
+    only ever updated from the calling (main) thread.
+
+    Changes to user models are saved by appending them to a journal.
+    Journals grown too large are compacted into the model file by
+    worker threads. They write snapshots of the models, taken quickly
+    in the main thread, and never touch the models in use. User models
+    without journal are saved from snapshots, too.
+
+    Models of all languages used in a session may stay cached until
+    they exceed the memory budget. Then the least recently used ones
+    are dropped, system models first, user models after saving them.
+    Models in use are pinned and never dropped.
+    """
+
+    MAX_LOADER_THREADS = 3
+
+    # Rough ratio of the memory size of a loaded model to its file size.
+    MEMORY_SIZE_PER_FILE_SIZE = 3
+
+    # Compact journals larger than this or than a fraction of the model file.
+    JOURNAL_COMPACT_SIZE = 256 * 1024
+    JOURNAL_COMPACT_RATIO = 0.25
 
     def __init__(self):
-        self._language_models = {}
+        self._language_models = OrderedDict()  # least recently used first
+        self._memory_sizes = {}  # lmid -> memory size of the cached model
+        self._pinned = set()    # lmids of the models in use
+        self._loading = {}      # lmid -> future of a model being loaded
+        self._compacting = {}   # lmid -> (future, model, journal offset)
+        self._saving = {}       # lmid -> (future, model, model generation)
+        self._executor = None
 
     def clear(self):
-        self._language_models = {}
+        # Models still being loaded finish, but are dropped.
+        self._language_models = OrderedDict()
+        self._memory_sizes = {}
+        self._loading = {}
 
-    def get_models(self, lmids):
+    def get_models(self, lmids, block=True):
         models = []
         for lmid in lmids:
-            model = self.get_model(lmid)
+            model = self.get_model(lmid, block)
             if model:
                 models.append(model)
         return models
 
-    def get_model(self, lmid):
-        """ get language model from cache or load it from disk"""
+    def get_model(self, lmid, block=True):
+        """
+        Get language model from cache or load it from disk.
+        With block=False, return None for models that aren't loaded
+        yet and start loading them in the background instead.
+        """
         lmid = self.canonicalize_lmid(lmid)
+        self._add_loaded_models()
         if lmid in self._language_models:
             model = self._language_models[lmid]
+            self._language_models.move_to_end(lmid)
         else:
-            model = self.load_model(lmid)
+            future = self._loading.get(lmid)
+            if future is None and block:
+                model = self.load_model(lmid)
+            else:
+                if future is None:
+                    future = self._load_model_async(lmid)
+                if not block and not future.done():
+                    return None
+                del self._loading[lmid]
+                model = future.result()
             if model:
-                self._language_models[lmid] = model
+                self._add_model(lmid, model)
         return model
 
+    def _add_loaded_models(self):
+        """ Cache models done loading in the background. """
+        for lmid, future in list(self._loading.items()):
+            if future.done():
+                del self._loading[lmid]
+                model = future.result()
+                if model:
+                    self._add_model(lmid, model)
+
+    def _add_model(self, lmid, model):
+        self._language_models[lmid] = model
+        self._memory_sizes[lmid] = self.get_memory_size(model)
+        self._evict_models()
+
+    def set_pinned_models(self, lmids):
+        """ Keep the models in use, drop others if over budget. """
+        self._pinned = set(self.canonicalize_lmid(lmid) for lmid in lmids)
+        self._evict_models()
+
+    def prefetch_models(self, lmids):
+        """
+        Start loading models in the background, e.g. those of recently
+        used languages, as long as they are likely to fit into the
+        memory budget. They stay cached, but aren't pinned.
+        """
+        budget = self.get_memory_budget()
+        total = sum(self._memory_sizes.values()) + \
+                sum(self.estimate_memory_size(lmid) for lmid in self._loading)
+        for lmid in lmids:
+            lmid = self.canonicalize_lmid(lmid)
+            if lmid in self._language_models or \
+               lmid in self._loading:
+                continue
+            total += self.estimate_memory_size(lmid)
+            if budget and total > budget:
+                break
+            self._load_model_async(lmid)
+
+    def _evict_models(self):
+        """
+        Drop least recently used models until the cache fits into
+        the memory budget.
+        """
+        budget = self.get_memory_budget()
+        total = sum(self._memory_sizes.values())
+        if not budget or total <= budget:
+            return
+
+        lmids = [lmid for lmid in self._language_models
+                 if lmid not in self._pinned and self.can_evict(lmid)]
+
+        # System models can be reloaded any time, drop them first.
+        lmids.sort(key=self.can_save)
+
+        for lmid in lmids:
+            if total <= budget:
+                break
+
+            model = self._language_models[lmid]
+            if self.can_save(lmid):
+                self.save_model(model, lmid)
+                if model.modified:
+                    continue  # failed to save, keep the changes
+
+            _logger.info("Dropping language model '{}' from the cache."
+                         .format(lmid))
+            del self._language_models[lmid]
+            total -= self._memory_sizes.pop(lmid)
+
+    def get_memory_budget(self):
+        """ Memory budget of cached models in bytes, 0 for unlimited. """
+        return max(0, config.wp.model_cache_size) * 1024 * 1024
+
+    @staticmethod
+    def get_memory_size(model):
+        return sum(model.memory_size())
+
+    def estimate_memory_size(self, lmid):
+        """ Memory size of a model before it is loaded. """
+        filename = self.get_filename(lmid)
+        if filename:
+            try:
+                return os.path.getsize(filename) * \
+                       self.MEMORY_SIZE_PER_FILE_SIZE
+            except OSError:
+                pass
+        return 0
+
+    def load_models_async(self, lmids):
+        """
+        Start loading models in background threads.
+        Returns a future per model, completed for cached models.
+        """
+        futures = []
+        for lmid in lmids:
+            lmid = self.canonicalize_lmid(lmid)
+            if lmid in self._language_models:
+                self._language_models.move_to_end(lmid)
+                future = Future()
+                future.set_result(self._language_models[lmid])
+            else:
+                future = self._loading.get(lmid)
+                if future is None:
+                    future = self._load_model_async(lmid)
+            futures.append(future)
+        return futures
+
+    def _load_model_async(self, lmid):
+        future = self._get_executor().submit(self.load_model, lmid)
+        self._loading[lmid] = future
+        return future
+
+    def _get_executor(self):
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(self.MAX_LOADER_THREADS)
+        return self._executor
+
     def find_available_model_names(self, _class):
         names = []
         models = self._find_models(_class)
@@ -446,10 +673,13 @@ class ModelCache:
 
         if type_ == "lm":
             if class_ == "system":
+                # System models are never learned into, keep them
+                # in the compact read-only representation.
                 if pypredict.read_order(filename) == 1:
                     model = pypredict.UnigramModel()
                 else:
-                    model = pypredict.DynamicModel()
+                    model = pypredict.FrozenModel()
+                    model.precompute = True
             elif class_ == "user":
                 model = pypredict.CachedDynamicModel()
             elif class_ == "mem":
@@ -464,8 +694,21 @@ class ModelCache:
             return None
 
         if filename:
+            # Prefer the memory mapped binary version of system models,
+            # fall back to the text version if it can't be loaded.
+            binary_filename = self.get_binary_filename(filename)
+            if class_ == "system" and \
+               os.path.exists(binary_filename):
+                self.do_load_model(model, binary_filename, class_)
+                if not model.load_error_msg:
+                    return model
+                model.load_error_msg = ""
+
             self.do_load_model(model, filename, class_)
 
+            if class_ == "user":
+                self.do_load_journal(model, filename)
+
         return model
 
     @staticmethod
@@ -496,22 +739,77 @@ class ModelCache:
                     _logger.error("Saving word suggestions disabled "
                                   "to prevent further data loss.")
 
-    def save_models(self):
+    @staticmethod
+    def do_load_journal(model, filename):
+        """
+        Replay the changes journaled since the model file was last
+        written and keep journaling further changes.
+        """
+        if model.load_error:
+            return
+
+        journal = pypredict.ModelJournal(
+            ModelCache.get_journal_filename(filename), filename)
+        try:
+            n = journal.replay(model)
+        except (IOError, OSError) as ex:
+            msg = _format("Failed to load language model journal '{}': "
+                          "{} ({})",
+                          journal.filename, os.strerror(ex.errno), ex.errno)
+            _logger.error(msg)
+            _logger.error("Saving word suggestions disabled "
+                          "to prevent further data loss.")
+            model.load_error = True
+            model.load_error_msg = msg
+            return
+
+        if n:
+            _logger.info("Replayed {} journal records of '{}'."
+                         .format(n, filename))
+        if journal.stale_filename:
+            _logger.warning("Language model journal '{}' doesn't belong "
+                            "to '{}', kept as '{}'."
+                            .format(journal.filename, filename,
+                                    journal.stale_filename))
+        model.modified = False
+        model.journal = journal
+
+    def save_models(self, final=False):
+        """
+        Save modified user models. With final=True, wait for running
+        journal compactions and don't start new ones.
+        """
+        self._finish_compactions(final)
+        self._finish_saves(final)
         for lmid, model in list(self._language_models.items()):
             if self.can_save(lmid):
                 self.save_model(model, lmid)
+                if not final:
+                    self._compact_model_async(model, lmid)
+
+                # user models grow with learning
+                self._memory_sizes[lmid] = self.get_memory_size(model)
+
+        if final:
+            self._finish_saves(True)
+        else:
+            self._evict_models()
 
     @staticmethod
     def can_save(lmid):
         type_, class_, name  = lmid.split(":")
         return class_ == "user"
 
+    @staticmethod
+    def can_evict(lmid):
+        """ In-memory models can't be reloaded. """
+        type_, class_, name  = lmid.split(":")
+        return class_ != "mem"
+
     def save_model(self, model, lmid):
         type_, class_, name  = lmid.split(":")
         filename = self.get_filename(lmid)
 
-        backup_filename = self.get_backup_filename(filename)
-
         if filename and \
            model.modified:
 
@@ -526,23 +824,128 @@ class ModelCache:
                     path = os.path.dirname(filename)
                     XDGDirs.assure_user_dir_exists(path)
 
-                    if 1:
-                        # save to temp file
-                        basename, ext = os.path.splitext(filename)
-                        tempfile = basename + ".tmp"
-                        model.save(tempfile)
-
-                        # rename to final file
-                        if os.path.exists(filename):
-                            os.rename(filename, backup_filename)
-                        os.rename(tempfile, filename)
-
-                    model.modified = False
+                    if model.journal:
+                        # append changes, compacted later
+                        model.journal.flush()
+                        model.modified = False
+                    else:
+                        # modified is reset once the file is on disk
+                        self._save_model_async(model, lmid)
                 except (IOError, OSError) as e:
                     _logger.warning(
                         "Failed to save language model '{}': {} ({})"
                         .format(filename, os.strerror(e.errno), e.errno))
 
+    def _save_model_async(self, model, lmid):
+        """ Write the model file from a snapshot in a worker thread. """
+        if lmid in self._saving:
+            return  # still busy, try again on the next save
+
+        filename = self.get_filename(lmid)
+        future = self._get_executor().submit(self._save_snapshot,
+                                             filename, model.snapshot())
+        self._saving[lmid] = (future, model, model.generation)
+
+    @staticmethod
+    def _save_snapshot(filename, snapshot):
+        """ Worker thread: write and put in place a new model file. """
+        tempfile = ModelCache.get_snapshot_filename(filename)
+        snapshot.save(tempfile)
+
+        if os.path.exists(filename):
+            os.rename(filename, ModelCache.get_backup_filename(filename))
+        os.rename(tempfile, filename)
+
+    def _finish_saves(self, wait=False):
+        """ Main thread: mark models as saved once their files are. """
+        for lmid, (future, model, generation) in list(self._saving.items()):
+            if not wait and not future.done():
+                continue
+            del self._saving[lmid]
+
+            filename = self.get_filename(lmid)
+            try:
+                future.result()
+            except (IOError, OSError) as e:
+                _logger.warning(
+                    "Failed to save language model '{}': {} ({})"
+                    .format(filename, os.strerror(e.errno), e.errno))
+                continue
+
+            # Changes made while saving still have to be saved.
+            if model.generation == generation:
+                model.modified = False
+
+    def _compact_model_async(self, model, lmid):
+        """ Start compacting the journal of a model if it grew too large. """
+        journal = model.journal
+        if not journal or \
+           model.modified or \
+           lmid in self._compacting:
+            return
+
+        filename = self.get_filename(lmid)
+        try:
+            base_size = os.path.getsize(filename)
+        except OSError:
+            base_size = 0
+        if journal.size <= max(self.JOURNAL_COMPACT_SIZE,
+                               base_size * self.JOURNAL_COMPACT_RATIO):
+            return
+
+        _logger.info("Compacting language model journal '{}'"
+                     .format(journal.filename))
+        # Without pending changes, the model contains exactly the
+        # records on disk.
+        end = journal.size
+        future = self._get_executor().submit(self._compact_model,
+                                             filename, model.snapshot())
+        self._compacting[lmid] = (future, model, end)
+
+    @staticmethod
+    def _compact_model(filename, snapshot):
+        """
+        Worker thread: write a new model file from a snapshot of the
+        model. Returns the journal's identifier of the new file.
+        """
+        tempfile = ModelCache.get_compact_filename(filename)
+        snapshot.save(tempfile)
+        return pypredict.ModelJournal.get_base_id(tempfile)
+
+    def _finish_compactions(self, wait=False):
+        """
+        Main thread: put compacted model files in place and drop the
+        journal records they contain.
+        """
+        for lmid, (future, model, end) in list(self._compacting.items()):
+            if not wait and not future.done():
+                continue
+            del self._compacting[lmid]
+
+            filename = self.get_filename(lmid)
+            journal = model.journal
+            try:
+                base_id = future.result()
+
+                # Models dropped from the cache may be loaded again
+                # already, with a new journal.
+                if self._language_models.get(lmid) is not model:
+                    continue
+
+                # Rewrite the journal before replacing the model file.
+                # On load, the journal that matches the model file wins.
+                journal.flush()
+                journal.begin_rebase(base_id, end)
+
+                if os.path.exists(filename):
+                    os.rename(filename, self.get_backup_filename(filename))
+                os.rename(self.get_compact_filename(filename), filename)
+
+                journal.end_rebase()
+            except (IOError, OSError) as e:
+                _logger.warning("Failed to compact language model '{}': {}"
+                                .format(filename, unicode_str(e)))
+
     @staticmethod
     def get_filename(lmid):
         type_, class_, name  = lmid.split(":")
@@ -558,10 +961,28 @@ class ModelCache:
 
         return filename
 
+    @staticmethod
+    def get_binary_filename(filename):
+        return filename + "b"
+
     @staticmethod
     def get_backup_filename(filename):
         return filename + ".bak"
 
+    @staticmethod
+    def get_journal_filename(filename):
+        return filename + ".journal"
+
+    @staticmethod
+    def get_snapshot_filename(filename):
+        basename, ext = os.path.splitext(filename)
+        return basename + ".snapshot.tmp"
+
+    @staticmethod
+    def get_compact_filename(filename):
+        basename, ext = os.path.splitext(filename)
+        return basename + ".tmp"
+
     @staticmethod
     def get_broken_filename(filename):
         """
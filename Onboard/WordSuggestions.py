@@ -43,7 +43,7 @@ from Onboard.Layout            import LayoutPanel
 from Onboard.AtspiStateTracker import AtspiStateTracker
 from Onboard.WPEngine          import WPLocalEngine, ModelCache
 from Onboard.utils             import Rect, unicode_str, escape_markup
-from Onboard.Timer             import CallOnce, Timer, TimerOnce
+from Onboard.Timer             import CallOnce, Timer, idle_call
 from Onboard.KeyGtk            import FullSizeKey, WordKey
 from Onboard.KeyboardPopups    import PendingSeparatorPopup
 
@@ -54,6 +54,9 @@ config = Config()
 class WordSuggestions:
     """ Keyboard mix-in for word prediction """
 
+    # Number of previously used languages whose models are loaded ahead.
+    NUM_PREFETCHED_LANGUAGES = 2
+
     def __init__(self):
 
         self.input_line = InputLine()
@@ -61,12 +64,14 @@ class WordSuggestions:
         self.text_context = self.atspi_text_context  # initialize for doctests
         self._learn_strategy = LearnStrategyLRU(self)
         self._languagedb = LanguageDB(self)
-        self._spell_checker = SpellChecker(self._languagedb)
+        self._spell_checker = SpellChecker(self._languagedb,
+                                           config.get_user_spellcheck_dir())
         self._punctuator = PunctuatorImmediateSeparators(self)
         self._pending_separator_popup = PendingSeparatorPopup()
         self._pending_separator_popup_timer = Timer()
         self._load_error_recovery = ModelErrorRecovery(self)
         self._load_errors_reported = False
+        self._model_futures = []
         self._wpengine  = None
 
         self._correction_choices = []
@@ -89,6 +94,8 @@ class WordSuggestions:
         self.reset()
         if self.text_context:
             self.text_context.cleanup()
+        if self._spell_checker:
+            self._spell_checker.cleanup()
         if self._wpengine:
             self._wpengine.cleanup()
 
@@ -146,11 +153,7 @@ class WordSuggestions:
     def apply_prediction_profile(self):
         if self._wpengine:
             lang_id = self.get_lang_id()
-            system_lang_id = \
-                self._languagedb.find_system_model_language_id(lang_id)
-
-            system_models  = ["lm:system:" + system_lang_id]
-            user_models    = ["lm:user:" + lang_id]
+            system_models, user_models = self._get_lang_model_ids(lang_id)
             scratch_models = ["lm:mem"]
 
             persistent_models = system_models + user_models
@@ -175,14 +178,52 @@ class WordSuggestions:
                                       auto_learn_models,
                                       scratch_models)
 
-            # Make sure to load the language models, so there is no
-            # delay on first key press. Don't burden the startup
-            # with this either, run it a little delayed.
-            TimerOnce(1, self._load_models)
+            # Load the language models in the background, so there is
+            # no delay on first key press. Predictions skip models
+            # that aren't ready yet.
+            self._load_models()
+            self._prefetch_recent_models(lang_id)
+
+    def _get_lang_model_ids(self, lang_id):
+        """ System and user model ids of a language. """
+        system_lang_id = \
+            self._languagedb.find_system_model_language_id(lang_id)
+        return ["lm:system:" + system_lang_id], ["lm:user:" + lang_id]
+
+    def _prefetch_recent_models(self, active_lang_id):
+        """
+        Load the models of the most recently used other languages
+        ahead, so switching back to them is instant.
+        """
+        # most recently used first
+        lang_ids = [lang_id
+                    for lang_id in config.typing_assistance.recent_languages
+                    if lang_id != active_lang_id]
+
+        lmids = []
+        for lang_id in lang_ids[:self.NUM_PREFETCHED_LANGUAGES]:
+            system_models, user_models = self._get_lang_model_ids(lang_id)
+            lmids += system_models + user_models
+        self._wpengine.prefetch_models(lmids)
 
     def _load_models(self):
-        self._wpengine.load_models()
-        if not self._load_errors_reported:
+        futures = self._wpengine.load_models()
+        self._model_futures = futures
+        for future in futures:
+            future.add_done_callback(
+                lambda f: idle_call(self._on_model_loaded))
+
+    def _on_model_loaded(self):
+        """ A model finished loading, runs in the main thread. """
+        if not self._wpengine:
+            return
+
+        # show suggestions of the new model
+        self.invalidate_context_ui()
+        self.commit_ui_updates()
+
+        if all(f.done() for f in self._model_futures) and \
+           not self._load_errors_reported:
             self._load_errors_reported = True
             self._load_error_recovery.report_errors(self._wpengine)
 
@@ -586,11 +627,24 @@ class WordSuggestions:
                     (self._correction_choices,
                      self._correction_span,
                      auto_capitalization) = \
-                        self._find_correction_choices(word_span, False)
+                        self._find_correction_choices(word_span, False,
+                                                      False)
+
+    def _on_corrections_found(self):
+        """ Spelling suggestions arrived, runs in the main thread. """
+        if not self._spell_checker:
+            return
 
-    def _find_correction_choices(self, word_span, auto_capitalize):
+        # show the new correction choices
+        self.invalidate_context_ui()
+        self.commit_ui_updates()
+
+    def _find_correction_choices(self, word_span, auto_capitalize,
+                                 block = True):
         """
         Find spelling suggestions for the word at or before the caret.
+        With block=False, uncached words are spell checked in the
+        background and _on_corrections_found is called when done.
 
         Doctests:
         >>> ws = WordSuggestions()
@@ -622,8 +676,13 @@ class WordSuggestions:
         caret = self.text_context.get_caret()
         offset = caret - text_begin  # caret offset into the word
 
+        if block:
+            done_callback = None
+        else:
+            done_callback = lambda: idle_call(self._on_corrections_found)
+
         span, choices = \
-            self._spell_checker.find_corrections(word, offset)
+            self._spell_checker.find_corrections(word, offset, done_callback)
         if choices:
             correction_choices = choices
             correction_span = TextSpan(span[0] + text_begin,
@@ -668,34 +727,29 @@ class WordSuggestions:
                                                  bool(self.mods[1]),
                                                  bot_marker)
 
-                _choices = self._wpengine.predict(
+                # Only fetch more than fits the wordlist if there are
+                # buttons to scroll to them.
+                limit = config.wp.max_word_choices
+                if "next-predictions" in \
+                   config.word_suggestions.get_shown_wordlist_button_ids():
+                    limit *= 8
+
+                # Filter out begin of text markers that sneak in as
+                # high frequency unigrams.
+                # Drop upper caps spelling in favor of a lower caps one, if
+                # requested. Auto-capitalization may elect to upper caps on
+                # insertion.
+                choices = self._wpengine.predict(
                     bot_context,
-                    config.wp.max_word_choices * 8,
+                    limit,
                     case_insensitive=case_insensitive_mode == 1,
                     case_insensitive_smart=case_insensitive_mode == 2,
                     accent_insensitive_smart=config.wp.accent_insensitive,
-                    ignore_non_capitalized=ignore_non_caps)
-
-                choices = []
-                for choice in _choices:
-                    # Filter out begin of text markers that sneak in as
-                    # high frequency unigrams.
-                    if choice.startswith("<bot:"):
-                        continue
-
-                    # Drop upper caps spelling in favor of a lower caps one.
-                    # Auto-capitalization may elect to upper caps on insertion.
-                    if drop_capitalized:
-                        choice_lower = choice.lower()
-                        if choice != choice_lower and \
-                           self._wpengine.word_exists(choice_lower):
-                            continue
-
-                    choices.append(choice)
-
-                # Make all words start upper case
-                if capitalize:
-                    choices = self._capitalize_choices(choices)
+                    ignore_non_capitalized=ignore_non_caps,
+                    ignore_markers=True,
+                    prefer_lower_case=drop_capitalized,
+                    capitalize=capitalize,
+                    fuzzy_prefix=config.wp.typo_tolerant)
             else:
                 choices = []
 
@@ -795,45 +849,25 @@ class WordSuggestions:
         wis = []
         if text.rstrip():  # don't load models on startup
             tokspans, counts = self._wpengine.lookup_text(text)
+            words = [text[start:end] for start, end, token in tokspans]
+            if self._spell_checker:
+                # check all words in one batch
+                spelling_errors = \
+                    self._spell_checker.find_incorrect_spans_many(words)
+
             for i, t in enumerate(tokspans):
                 start, end, token = t
-                word = text[start:end]
+                word = words[i]
                 wi = WordInfo(start, end, word)
                 wi.exact_match   = any(count == 1 for count in counts[i])
                 wi.partial_match = any(count  < 0 for count in counts[i])
                 wi.ignored       = word != token
                 if self._spell_checker:
-                    wi.spelling_errors = \
-                        self._spell_checker.find_incorrect_spans(word)
+                    wi.spelling_errors = spelling_errors[i]
                 wis.append(wi)
 
         return wis
 
-    @staticmethod
-    def _capitalize_choices(choices):
-        """
-        Set first letters to upper case and remove
-        double entries created that way.
-
-        Doctests:
-        >>> WordSuggestions._capitalize_choices(
-        ...     ["word1", "Word1", "Word2", "word3"])
-        ['Word1', 'Word2', 'Word3']
-        >>> WordSuggestions._capitalize_choices(
-        ...     ["Word", "woRD", "WORD"])
-        ['Word', 'WoRD', 'WORD']
-        """
-        results = []
-        seen = set()
-
-        for choice in choices:
-            if choice:
-                choice = choice[:1].upper() + choice[1:]
-                if choice not in seen:
-                    results.append(choice)
-                    seen.add(choice)
-        return results
-
     def _get_prediction_choice_changes(self, choice):
         """
         Determines the text changes necessary when inserting
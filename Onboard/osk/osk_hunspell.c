@@ -75,7 +75,12 @@ osk_hunspell_spell (PyObject *self, PyObject *args)
     if (!PyArg_ParseTuple (args, "es:spell", encoding, &word))
         return NULL;
 
+    // Callers serialize access to the handle, hunspell isn't thread-safe.
+    Py_BEGIN_ALLOW_THREADS
     res = Hunspell_spell(oh->hh, word);
+    Py_END_ALLOW_THREADS
+
+    PyMem_Free(word);
 
     return PyLong_FromLong(res);
 }
@@ -100,11 +105,18 @@ osk_hunspell_suggest (PyObject *self, PyObject *args)
     if (!PyArg_ParseTuple (args, "es:suggest", encoding, &word))
         return NULL;
 
+    // Generating suggestions may take hundreds of milliseconds,
+    // let other threads run meanwhile.
+    Py_BEGIN_ALLOW_THREADS
     n = Hunspell_suggest(oh->hh, &slst, word);
+    Py_END_ALLOW_THREADS
+
+    PyMem_Free(word);
 
     result = PyTuple_New(n);
     if (!result)
     {
+        Hunspell_free_list(oh->hh, &slst, n);
         PyErr_SetString(PyExc_MemoryError, "failed to allocate result tuple");
         return NULL;
     }
@@ -116,6 +128,7 @@ osk_hunspell_suggest (PyObject *self, PyObject *args)
         if (!suggestion)
         {
             PyErr_SetString(PyExc_MemoryError, "failed to decode suggestion");
+            Hunspell_free_list(oh->hh, &slst, n);
             Py_DECREF(result);
             return NULL;
         }
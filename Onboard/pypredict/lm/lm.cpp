@@ -23,6 +23,8 @@
 #include <algorithm>
 #include <cmath>
 #include <string>
+#include <unordered_set>
+#include <atomic>
 #include <wctype.h>
 
 #include "lm.h"
@@ -30,6 +32,9 @@
 
 using namespace std;
 
+// Probability factor per edit of typo-tolerant completions.
+static const double FUZZY_EDIT_PENALTY = 0.01;
+
 
 StrConv::StrConv()
 {
@@ -146,30 +151,8 @@ class PrefixCmp
 
             do
             {
-                c1 = (wint_t) *s++;
                 c2 = (wint_t) *p++;
-
-                if (options & LanguageModel::CASE_INSENSITIVE_SMART)
-                {
-                    if (!iswupper(c2))
-                        c1 = (wint_t) towlower(c1);
-                }
-                else
-                if (options & LanguageModel::CASE_INSENSITIVE)
-                {
-                    c1 = (wint_t) towlower(c1);
-                }
-
-                if (options & LanguageModel::ACCENT_INSENSITIVE_SMART)
-                {
-                    if (!has_accent(c2))
-                        c1 = (wint_t) op_remove_accent(c1);
-                }
-                else
-                if (options & LanguageModel::ACCENT_INSENSITIVE)
-                {
-                    c1 = (wint_t) op_remove_accent(c1);
-                }
+                c1 = fold_char((wint_t) *s++, c2);
 
                 if (c1 == L'\0' || c1 != c2)
                     return false;
@@ -178,6 +161,50 @@ class PrefixCmp
             return c1 == c2;
         }
 
+        // Fold character c1 of a word as the options require for
+        // comparing it with character c2 of the prefix. With the smart
+        // options, upper case and accented characters of the prefix
+        // only match themselves.
+        wint_t fold_char(wint_t c1, wint_t c2)
+        {
+            if (options & LanguageModel::CASE_INSENSITIVE_SMART)
+            {
+                if (!iswupper(c2))
+                    c1 = (wint_t) towlower(c1);
+            }
+            else
+            if (options & LanguageModel::CASE_INSENSITIVE)
+            {
+                c1 = (wint_t) towlower(c1);
+            }
+
+            if (options & LanguageModel::ACCENT_INSENSITIVE_SMART)
+            {
+                if (!has_accent(c2))
+                    c1 = (wint_t) op_remove_accent(c1);
+            }
+            else
+            if (options & LanguageModel::ACCENT_INSENSITIVE)
+            {
+                c1 = (wint_t) op_remove_accent(c1);
+            }
+            return c1;
+        }
+
+        // The prefix, folded as far as the options allow.
+        const wstring& get_prefix()
+        {
+            return prefix;
+        }
+
+        // Full case- and accent-folding, key of the folded prefix index.
+        // Any word matching with any of the case or accent insensitive
+        // options also matches when both sides are fully folded.
+        static wint_t fold(wint_t c)
+        {
+            return op_remove_accent(towlower(c));
+        }
+
     private:
         static wint_t op_lower(wint_t c)
         {
@@ -232,9 +259,12 @@ void Dictionary::clear()
 {
     vector<char*>::iterator it;
     for (it=words.begin(); it < words.end(); it++)
-        MemFree(*it);
+        if (!is_mapped(*it))
+            MemFree(*it);
 
     vector<char*>().swap(words);  // clear and really free the memory
+    mapped_begin = NULL;
+    mapped_end = NULL;
 
     if (sorted)
     {
@@ -242,6 +272,18 @@ void Dictionary::clear()
         sorted = NULL;
     }
     sorted_words_begin = 0;
+
+    clear_folded_index();
+
+    epoch = new_epoch();
+}
+
+// Epochs are unique across all dictionaries, so a word id mapping
+// remembers both, which vocabulary and which version of it was mapped.
+uint64_t Dictionary::new_epoch()
+{
+    static std::atomic<uint64_t> next_epoch(1);
+    return next_epoch++;
 }
 
 
@@ -268,6 +310,7 @@ LMError Dictionary::set_words(const vector<wchar_t*>& new_words)
         delete sorted;
         sorted = NULL;
     }
+    clear_folded_index();
 
     // encode as utf-8 and store in "words"
     int initial_size = words.size(); // number of initial control words
@@ -309,6 +352,54 @@ LMError Dictionary::set_words(const vector<wchar_t*>& new_words)
     sort(words.begin()+initial_size, words.end(), cmp);
 
     sorted_words_begin = initial_size;
+    epoch = new_epoch();
+
+    return ERR_NONE;
+}
+
+// Set words in bulk from a memory mapped binary model, without copying.
+// Same preconditions as set_words(), plus new_words has to be sorted
+// already, except for leading control words. The mapping has to
+// outlive the dictionary contents.
+LMError Dictionary::set_mapped_words(const vector<const char*>& new_words,
+                                     const void* begin, const void* end)
+{
+    if (sorted)
+    {
+        delete sorted;
+        sorted = NULL;
+    }
+    clear_folded_index();
+
+    int initial_size = words.size(); // number of initial control words
+    int n = new_words.size();
+    words.reserve(initial_size + n);
+    for (int i = 0; i<n; i++)
+    {
+        const char* w = new_words[i];
+
+        // is this a known control word?
+        bool exists = false;
+        if (i < initial_size)
+        {
+            for (int j = 0; j<initial_size; j++)
+            {
+                if (strcmp(w, words[j]) == 0)
+                {
+                    exists = true;
+                    break;
+                }
+            }
+        }
+
+        if (!exists)
+            words.push_back(const_cast<char*>(w));
+    }
+
+    mapped_begin = static_cast<const char*>(begin);
+    mapped_end = static_cast<const char*>(end);
+    sorted_words_begin = initial_size;
+    epoch = new_epoch();
 
     return ERR_NONE;
 }
@@ -364,6 +455,8 @@ WordId Dictionary::add_word(const wchar_t* word)
 
     words.push_back(w);
 
+    update_folded_index(wid);
+
     return wid;
 }
 
@@ -421,16 +514,447 @@ void Dictionary::prefix_search(const wchar_t* prefix,
         }
     }
     else
-    // exhaustive search through the dictionary
+    // range query on the prefix index
     {
+        const uint32_t fold_options = LanguageModel::CASE_INSENSITIVE |
+                                      LanguageModel::CASE_INSENSITIVE_SMART |
+                                      LanguageModel::ACCENT_INSENSITIVE |
+                                      LanguageModel::ACCENT_INSENSITIVE_SMART;
+        std::vector<WordId> wids;
+        if (options & fold_options)
+        {
+            wstring key = prefix ? prefix : L"";
+            transform(key.begin(), key.end(), key.begin(), PrefixCmp::fold);
+            const char* k = conv.wc2mb(key.c_str());
+            if (!k)
+                return;
+            // copy, building the index reuses the conversion buffer
+            get_folded_prefix_matches(string(k).c_str(), min_wid, wids);
+        }
+        else
+        {
+            const char* k = conv.wc2mb(prefix ? prefix : L"");
+            if (!k)
+                return;
+            get_prefix_matches(k, min_wid, wids);
+        }
+
+        // The range is a superset of the matches, check each candidate
+        // with the exact comparison, including the capitalization options.
         PrefixCmp cmp = PrefixCmp(prefix, options);
-        int size = words.size();
-        for (int i = min_wid; i<size; i++)
-            if (cmp.matches(words[i]))
-                wids_out.push_back(i);
+        std::vector<WordId>::const_iterator it;
+        for(it = wids.begin(); it != wids.end(); it++)
+            if (cmp.matches(words[*it]))
+                wids_out.push_back(*it);
     }
 }
 
+// Collect the ids of all words starting with the UTF-8 prefix.
+// UTF-8 preserves code point order, so all words sharing a prefix
+// form a contiguous range in the byte-wise sorted vocabulary.
+void Dictionary::get_prefix_matches(const char* prefix, WordId min_wid,
+                                    std::vector<WordId>& wids)
+{
+    int len = strlen(prefix);
+    int size = words.size();
+
+    if (sorted)
+    {
+        for (int i = binsearch_sorted(prefix); i<size; i++)
+        {
+            WordId wid = (*sorted)[i];
+            if (strncmp(words[wid], prefix, len) != 0)
+                break;
+            if (wid >= min_wid)
+                wids.push_back(wid);
+        }
+    }
+    else
+    {
+        // control words aren't part of the sorted range
+        for (int i = min_wid; i<sorted_words_begin; i++)
+            if (strncmp(words[i], prefix, len) == 0)
+                wids.push_back(i);
+
+        for (int i = binsearch_words(prefix); i<size; i++)
+        {
+            if (strncmp(words[i], prefix, len) != 0)
+                break;
+            if (i >= (int)min_wid)
+                wids.push_back(i);
+        }
+    }
+}
+
+// Collect the ids of all words whose folded keys start with
+// the already folded UTF-8 prefix.
+void Dictionary::get_folded_prefix_matches(const char* prefix, WordId min_wid,
+                                           std::vector<WordId>& wids)
+{
+    if (!folded_sorted)
+        build_folded_index();
+
+    int len = strlen(prefix);
+    int size = folded_sorted->size();
+    for (int i = binsearch_folded(prefix); i<size; i++)
+    {
+        WordId wid = (*folded_sorted)[i];
+        if (strncmp(get_folded_key(wid), prefix, len) != 0)
+            break;
+        if (wid >= min_wid)
+            wids.push_back(wid);
+    }
+}
+
+// Decode the UTF-8 sequence at s into code point c. Returns the number
+// of bytes consumed, 0 at the end of the string. Invalid bytes decode
+// as themselves, one at a time.
+static int utf8_decode(const char* s, uint32_t& c)
+{
+    const unsigned char* u = reinterpret_cast<const unsigned char*>(s);
+    int len;
+    c = u[0];
+    if (c < 0x80)
+        return c ? 1 : 0;
+    else if ((c & 0xe0) == 0xc0)
+    {
+        c &= 0x1f;
+        len = 2;
+    }
+    else if ((c & 0xf0) == 0xe0)
+    {
+        c &= 0x0f;
+        len = 3;
+    }
+    else if ((c & 0xf8) == 0xf0)
+    {
+        c &= 0x07;
+        len = 4;
+    }
+    else
+        return 1;
+
+    for (int i=1; i<len; i++)
+    {
+        if ((u[i] & 0xc0) != 0x80)
+        {
+            c = u[0];
+            return 1;
+        }
+        c = (c << 6) | (u[i] & 0x3f);
+    }
+    return len;
+}
+
+// Typo-tolerant prefix search. Collect the ids of all words starting
+// with a string within max_distance edits (insertions, deletions,
+// substitutions and transpositions of adjacent characters) of prefix,
+// together with the smallest such distance.
+// The sorted vocabulary is traversed like a trie. Rows of edit distances
+// are shared between words with common prefixes, and whole ranges of
+// words are skipped once their common prefix is out of reach.
+void Dictionary::fuzzy_prefix_search(const wchar_t* prefix, int max_distance,
+                                     std::vector<WordId>& wids_out,
+                                     std::vector<int>& distances_out,
+                                     uint32_t options)
+{
+    WordId min_wid = (options & LanguageModel::INCLUDE_CONTROL_WORDS) \
+                     ? 0 : NUM_CONTROL_WORDS;
+    const uint32_t fold_options = LanguageModel::CASE_INSENSITIVE |
+                                  LanguageModel::CASE_INSENSITIVE_SMART |
+                                  LanguageModel::ACCENT_INSENSITIVE |
+                                  LanguageModel::ACCENT_INSENSITIVE_SMART;
+    bool folded = options & fold_options;
+
+    // Case or accent insensitive searches traverse the fully folded keys.
+    // Folding only makes characters equal, so distances between folded
+    // keys are lower bounds and pruning with them loses no words. The
+    // distance of each match is then computed again with the options.
+    PrefixCmp cmp = PrefixCmp(prefix, options);
+    const wstring& folded_prefix = cmp.get_prefix();
+    wstring p = prefix ? prefix : L"";
+    if (folded)
+    {
+        transform(p.begin(), p.end(), p.begin(), PrefixCmp::fold);
+        if (!folded_sorted)
+            build_folded_index();
+    }
+    int n = p.size();
+
+    int begin = 0;
+    int size;
+    if (folded)
+        size = folded_sorted->size();
+    else if (sorted)
+        size = sorted->size();
+    else
+    {
+        begin = sorted_words_begin;  // control words aren't sorted
+        size = words.size();
+    }
+    auto get_key = [&](int i, WordId& wid) -> const char*
+    {
+        if (folded)
+        {
+            wid = (*folded_sorted)[i];
+            return get_folded_key(wid);
+        }
+        wid = sorted ? (*sorted)[i] : i;
+        return words[wid];
+    };
+    vector<wint_t> word;
+    vector< vector<int> > word_rows;
+    auto get_distance = [&](WordId wid) -> int
+    {
+        // Words longer than n + max_distance can't get closer to p.
+        word.clear();
+        const char* w = words[wid];
+        uint32_t c;
+        for (int len; (int)word.size() < n + max_distance &&
+                      (len = utf8_decode(w, c)); w += len)
+            word.push_back(c);
+
+        const wstring& q = folded_prefix;
+        int m = word.size();
+        word_rows.resize(m+1, vector<int>(n+1));
+        for (int k=0; k<=n; k++)
+            word_rows[0][k] = k;
+        int distance = n;
+        for (int j=1; j<=m; j++)
+        {
+            vector<int>& row = word_rows[j];
+            const vector<int>& prev = word_rows[j-1];
+            row[0] = j;
+            for (int k=1; k<=n; k++)
+            {
+                wint_t qc = (wint_t) q[k-1];
+                int d = min(min(prev[k], row[k-1]) + 1,
+                            prev[k-1] + (cmp.fold_char(word[j-1], qc) != qc));
+                if (j > 1 && k > 1)
+                {
+                    wint_t qp = (wint_t) q[k-2];
+                    if (cmp.fold_char(word[j-2], qc) == qc &&
+                        cmp.fold_char(word[j-1], qp) == qp)
+                        d = min(d, word_rows[j-2][k-2] + 1);
+                }
+                row[k] = d;
+            }
+            distance = min(distance, row[n]);
+        }
+        return distance;
+    };
+    auto add_match = [&](WordId wid, int distance)
+    {
+        if (wid < min_wid)
+            return;
+        if (folded)
+        {
+            distance = get_distance(wid);
+            if (distance > max_distance)
+                return;
+        }
+        if (options & (LanguageModel::IGNORE_CAPITALIZED |
+                       LanguageModel::IGNORE_NON_CAPITALIZED))
+        {
+            uint32_t c;
+            utf8_decode(words[wid], c);
+            bool upper = iswupper(c);
+            if ((options & LanguageModel::IGNORE_CAPITALIZED && upper) ||
+                (options & LanguageModel::IGNORE_NON_CAPITALIZED && !upper))
+                return;
+        }
+        wids_out.push_back(wid);
+        distances_out.push_back(distance);
+    };
+
+    // Trie path of the current key, one entry per character depth:
+    // the character, the row of edit distances between all prefixes of
+    // p and the key up to here, and the smallest distance between p and
+    // any prefix of the key up to here.
+    vector<uint32_t> chars(1, 0);
+    vector< vector<int> > rows(1, vector<int>(n+1));
+    vector<int> best(1, n);
+    for (int k=0; k<=n; k++)
+        rows[0][k] = k;
+
+    int i = begin;
+    while (i < size)
+    {
+        WordId wid;
+        const char* key = get_key(i, wid);
+
+        // keep the path shared with the previous key
+        int depth = 1;
+        int offset = 0;
+        while (depth < (int)chars.size())
+        {
+            uint32_t c;
+            int len = utf8_decode(key + offset, c);
+            if (!len || c != chars[depth])
+                break;
+            offset += len;
+            depth++;
+        }
+        chars.resize(depth);
+        best.resize(depth);
+
+        // extend the path by the remaining characters
+        bool out_of_reach = false;
+        while (true)
+        {
+            uint32_t c;
+            int len = utf8_decode(key + offset, c);
+            if (!len)
+                break;
+            offset += len;
+
+            int j = chars.size();
+            chars.push_back(c);
+            if ((int)rows.size() <= j)
+                rows.resize(j+1, vector<int>(n+1));
+            const vector<int>& prev = rows[j-1];
+            vector<int>& row = rows[j];
+
+            row[0] = j;
+            int row_min = j;
+            for (int k=1; k<=n; k++)
+            {
+                int d = min(min(prev[k], row[k-1]) + 1,
+                            prev[k-1] + (p[k-1] != (wchar_t)c));
+                if (j > 1 && k > 1 &&
+                    p[k-1] == (wchar_t)chars[j-1] &&
+                    p[k-2] == (wchar_t)c)
+                    d = min(d, rows[j-2][k-2] + 1);
+                row[k] = d;
+                row_min = min(row_min, d);
+            }
+            best.push_back(min(best[j-1], row[n]));
+
+            // Longer prefixes of the key only get further away from p.
+            if (row_min > max_distance)
+            {
+                out_of_reach = true;
+                break;
+            }
+        }
+
+        int distance = best.back();
+        if (!out_of_reach)
+        {
+            if (distance <= max_distance)
+                add_match(wid, distance);
+            i++;
+        }
+        else
+        {
+            // Skip all keys sharing the prefix, they are at the same
+            // distance from p.
+            int lo = i + 1;
+            int hi = size;
+            while (lo < hi)
+            {
+                int mid = (lo+hi)>>1;
+                WordId w;
+                if (strncmp(get_key(mid, w), key, offset) == 0)
+                    lo = mid + 1;
+                else
+                    hi = mid;
+            }
+            if (distance <= max_distance)
+                for (int m=i; m<lo; m++)
+                {
+                    get_key(m, wid);
+                    add_match(wid, distance);
+                }
+            i = lo;
+        }
+    }
+}
+
+struct cmp_folded_keys
+{
+    bool operator() (const pair<const char*, WordId>& a,
+                     const pair<const char*, WordId>& b)
+    { return strcmp(a.first, b.first) < 0; }
+};
+
+// Build the case- and accent-folded index of the whole vocabulary.
+// Done on first use only, plenty of models never need it.
+void Dictionary::build_folded_index()
+{
+    clear_folded_index();
+
+    int size = words.size();
+    folded_keys = new vector<char*>(size, (char*)NULL);
+    for (int i=0; i<size; i++)
+        update_folded_key(i);
+
+    vector< pair<const char*, WordId> > v;
+    v.reserve(size);
+    for (int i=0; i<size; i++)
+        v.push_back(pair<const char*, WordId>(get_folded_key(i), i));
+    stable_sort(v.begin(), v.end(), cmp_folded_keys());
+
+    folded_sorted = new vector<WordId>;
+    folded_sorted->reserve(size);
+    for (int i=0; i<size; i++)
+        folded_sorted->push_back(v[i].second);
+}
+
+void Dictionary::clear_folded_index()
+{
+    if (folded_keys)
+    {
+        vector<char*>::iterator it;
+        for (it=folded_keys->begin(); it < folded_keys->end(); it++)
+            if (*it)
+                MemFree(*it);
+        delete folded_keys;
+        folded_keys = NULL;
+    }
+    if (folded_sorted)
+    {
+        delete folded_sorted;
+        folded_sorted = NULL;
+    }
+}
+
+// Store the folded key of a word, if it differs from the word itself.
+void Dictionary::update_folded_key(WordId wid)
+{
+    const wchar_t* w = conv.mb2wc(words[wid]);
+    if (!w)
+        return;
+    wstring key = w;
+    transform(key.begin(), key.end(), key.begin(), PrefixCmp::fold);
+    if (key != w)
+    {
+        const char* k = conv.wc2mb(key.c_str());
+        if (k)
+        {
+            char* s = (char*)MemAlloc((strlen(k) + 1) * sizeof(char));
+            if (s)
+            {
+                strcpy(s, k);
+                (*folded_keys)[wid] = s;
+            }
+        }
+    }
+}
+
+// Keep an existing folded index up to date when words are added.
+void Dictionary::update_folded_index(WordId wid)
+{
+    if (!folded_sorted)
+        return;
+
+    folded_keys->push_back(NULL);
+    update_folded_key(wid);
+
+    int index = binsearch_folded(get_folded_key(wid));
+    folded_sorted->insert(folded_sorted->begin()+index, wid);
+}
+
 // lookup word
 // return value: 0 = no match
 //               1 = exact match
@@ -489,6 +1013,17 @@ uint64_t Dictionary::get_memory_size()
     uint64_t sc = sorted ? sizeof(WordId) * sorted->capacity() : 0;
     sum += sc;
 
+    uint64_t fi = 0;
+    if (folded_sorted)
+    {
+        fi += sizeof(WordId) * folded_sorted->capacity();
+        fi += sizeof(char*) * folded_keys->capacity();
+        for (unsigned i=0; i<folded_keys->size(); i++)
+            if ((*folded_keys)[i])
+                fi += strlen((*folded_keys)[i]) + 1;
+    }
+    sum += fi;
+
     #ifndef NDEBUG
     printf("dictionary object: %12ld Byte\n", d);
     printf("strings:           %12ld Byte (%u)\n", w, (unsigned)words.size());
@@ -509,7 +1044,8 @@ uint64_t Dictionary::get_memory_size()
 void LanguageModel::get_candidates(const std::vector<WordId>& history,
                                    const wchar_t* prefix,
                                    std::vector<WordId>& candidates,
-                                   uint32_t options)
+                                   uint32_t options,
+                                   std::vector<int>* distances)
 {
     bool has_prefix = (prefix && wcslen(prefix));
     int history_size = history.size();
@@ -536,6 +1072,39 @@ void LanguageModel::get_candidates(const std::vector<WordId>& history,
             dictionary.prefix_search(NULL, &wids_in, candidates, options);
         }
         else
+        if (has_prefix &&
+            options & FUZZY_PREFIX &&
+            get_max_edit_distance(prefix) > 0)
+        {
+            std::vector<WordId> wids;
+            std::vector<int> dists;
+            dictionary.fuzzy_prefix_search(prefix,
+                                           get_max_edit_distance(prefix),
+                                           wids, dists, options);
+
+            std::vector< std::pair<WordId, int> > matches;
+            for (int i=0; i<(int)wids.size(); i++)
+                matches.push_back(std::make_pair(wids[i], dists[i]));
+            sort(matches.begin(), matches.end());
+            for (int i=0; i<(int)wids.size(); i++)
+                wids[i] = matches[i].first;
+
+            // Filter out words with removed unigrams, keeps the order.
+            filter_candidates(wids, candidates);
+
+            if (distances)
+            {
+                distances->resize(candidates.size());
+                int j = 0;
+                for (int i=0; i<(int)candidates.size(); i++)
+                {
+                    while (matches[j].first != candidates[i])
+                        j++;
+                    (*distances)[i] = matches[j].second;
+                }
+            }
+        }
+        else
         {
             std::vector<WordId> wids;
             dictionary.prefix_search(prefix, NULL, wids, options);
@@ -564,12 +1133,147 @@ void LanguageModel::get_candidates(const std::vector<WordId>& history,
 
 }
 
+// Predict completions/next words. If a cache is given, it is used
+// and updated to speed up predictions while typing a word.
 void LanguageModel::predict(std::vector<LanguageModel::Result>& results,
                             const std::vector<wchar_t*>& context,
-                            int limit, uint32_t options)
+                            int limit, uint32_t options,
+                            PredictionCache* cache)
+{
+    vector<WordId> wids;
+    vector<double> probabilities;
+
+    uint32_t filter_options = options & POST_FILTER_OPTIONS;
+    options &= ~POST_FILTER_OPTIONS;
+
+    if (!filter_options)
+    {
+        predict_ids(wids, probabilities, context, limit, options, cache);
+
+        // look up the words of the final results only
+        results.clear();
+        results.reserve(wids.size());
+        for (int i=0; i<(int)wids.size(); i++)
+        {
+            const wchar_t* word = id_to_word(wids[i]);
+            if (word)
+            {
+                Result result = {word, probabilities[i]};
+                results.push_back(result);
+            }
+        }
+    }
+    else
+    {
+        // Filtering drops some of the results. Get a few more than
+        // requested and, in the rare case that isn't enough, try again
+        // with a larger limit. The cache keeps the repetition cheap.
+        int fetch_limit = limit < 0 ? -1 : limit * 2 + 10;
+        while (true)
+        {
+            predict_ids(wids, probabilities, context, fetch_limit, options,
+                        cache);
+            post_filter(results, wids, probabilities, limit,
+                        filter_options);
+            if (fetch_limit < 0 ||
+                (int)results.size() >= limit ||
+                (int)wids.size() < fetch_limit)
+                break;
+            fetch_limit *= 4;
+        }
+    }
+}
+
+// Number of edits allowed for typo-tolerant completion of prefix.
+// Very short prefixes would match almost anything.
+int LanguageModel::get_max_edit_distance(const wchar_t* prefix)
+{
+    int len = prefix ? wcslen(prefix) : 0;
+    if (len < 3)
+        return 0;
+    if (len < 7)
+        return 1;
+    return 2;
+}
+
+// Flag the words that complete prefix without edits, as far as the
+// case and accent options allow. Typo-tolerant completions rank
+// after all of them.
+void LanguageModel::find_exact_completions(const vector<const char*>& words,
+                                           const wchar_t* prefix,
+                                           uint32_t options,
+                                           vector<bool>& exact)
+{
+    PrefixCmp cmp(prefix, options);
+    exact.resize(words.size());
+    for (int i=0; i<(int)words.size(); i++)
+        exact[i] = words[i] && cmp.matches(words[i]);
+}
+
+// Look up the words of the final results and apply the
+// post-filtering options until limit results are found.
+void LanguageModel::post_filter(vector<Result>& results,
+                                const vector<WordId>& wids,
+                                const vector<double>& probabilities,
+                                int limit, uint32_t options)
+{
+    unordered_set<wstring> seen;
+
+    results.clear();
+    for (int i=0; i<(int)wids.size(); i++)
+    {
+        if (limit >= 0 && (int)results.size() >= limit)
+            break;
+
+        const wchar_t* w = id_to_word(wids[i]);
+        if (!w)
+            continue;
+
+        // Drop control words and begin of text markers that sneak
+        // in as high frequency unigrams.
+        size_t len = wcslen(w);
+        if (options & IGNORE_MARKERS &&
+            len >= 2 && w[0] == L'<' && w[len-1] == L'>')
+            continue;
+
+        // copy, the conversion buffer is reused for lookups
+        wstring word(w, len);
+
+        // Drop upper case spellings in favor of existing lower case ones.
+        if (options & PREFER_LOWER_CASE)
+        {
+            wstring lower = word;
+            transform(lower.begin(), lower.end(), lower.begin(), towlower);
+            if (lower != word &&
+                lookup_word(lower.c_str()) == 1)
+                continue;
+        }
+
+        if (options & CAPITALIZE)
+        {
+            if (word.empty())
+                continue;
+            word[0] = towupper(word[0]);
+            if (!seen.insert(word).second)
+                continue;
+        }
+
+        Result result = {word, probabilities[i]};
+        results.push_back(result);
+    }
+}
+
+void LanguageModel::predict_ids(std::vector<WordId>& result_wids,
+                                std::vector<double>& result_probabilities,
+                                const std::vector<wchar_t*>& context,
+                                int limit, uint32_t options,
+                                PredictionCache* cache)
 {
     int i;
 
+    result_wids.clear();
+    result_probabilities.clear();
+
     if (!context.size())
         return;
 
@@ -586,18 +1290,36 @@ void LanguageModel::predict(std::vector<LanguageModel::Result>& results,
 
     // get candidate words, completion
     vector<WordId> wids;
-    get_candidates(history, prefix, wids, options);
+    vector<int> distances;
+    get_candidates(history, prefix, wids, options, &distances);
 
     // calculate probability vector
-    vector<double> probabilities(wids.size());
-    get_probs(history, wids, probabilities);
+    // When only the prefix grew, the new candidates are a subset of
+    // the previous ones with unchanged probabilities.
+    vector<double> probabilities;
+    if (!cache ||
+        !cache->can_filter(this, generation, history, prefix, options) ||
+        !cache->get_probs(wids, probabilities))
+    {
+        probabilities.resize(wids.size());
+        get_probs(history, wids, probabilities);
+    }
+
+    if (cache)
+        cache->update(this, generation, history, prefix, options,
+                      wids, probabilities);
 
-    // prepare results vector
+    // Rank typo-tolerant completions by edit distance, too.
+    // The cache keeps the plain probabilities, distances change with
+    // the prefix.
+    if (!distances.empty())
+        for (i=0; i<(int)wids.size(); i++)
+            probabilities[i] *= pow(FUZZY_EDIT_PENALTY, distances[i]);
+
+    // prepare results vectors
     int result_size = wids.size();
     if (limit >= 0 && limit < result_size)
         result_size = limit;
-    results.clear();
-    results.reserve(result_size);
 
     if (!(options & NO_SORT)) // allow to skip sorting for calls from another model, i.e. linint
     {
@@ -607,30 +1329,28 @@ void LanguageModel::predict(std::vector<LanguageModel::Result>& results,
             argsort[i] = i;
         stable_argsort_desc(argsort, probabilities);
 
-        // merge word ids and probabilities into the return array
+        // Exact completions come first, however frequent a near miss is.
+        if (!distances.empty())
+            stable_partition(argsort.begin(), argsort.end(),
+                             [&](int32_t index)
+                             {return distances[index] == 0;});
+
+        // merge word ids and probabilities into the return arrays
+        result_wids.resize(result_size);
+        result_probabilities.resize(result_size);
         for (i=0; i<result_size; i++)
         {
             int index = argsort[i];
-            const wchar_t* word = id_to_word(wids[index]);
-            if (word)
-            {
-                Result result = {word, probabilities[index]};
-                results.push_back(result);
-            }
+            result_wids[i] = wids[index];
+            result_probabilities[i] = probabilities[index];
         }
     }
     else
     {
-        // merge word ids and probabilities into the return array
-        for (int i=0; i<result_size; i++)
-        {
-            const wchar_t* word = id_to_word(wids[i]);
-            if (word)
-            {
-                Result result = {word, probabilities[i]};
-                results.push_back(result);
-            }
-        }
+        wids.resize(result_size);
+        probabilities.resize(result_size);
+        result_wids.swap(wids);
+        result_probabilities.swap(probabilities);
     }
 }
 
@@ -659,12 +1379,7 @@ double LanguageModel::get_probability(const wchar_t* const* ngram, int n)
         if (fabs(1.0 - psum) > 1e5)
             printf("%f\n", psum);
 
-        for (int i=0; i<(int)results.size(); i++)
-            if (results[i].word == word)
-                return results[i].p;
-        for (int i=0; i<(int)results.size(); i++)
-            if (results[i].word == L"<unk>")
-                return results[i].p;
+        return find_probability(results, word);
     }
     return 0.0;
 #else
@@ -685,6 +1400,90 @@ double LanguageModel::get_probability(const wchar_t* const* ngram, int n)
 #endif
 }
 
+// Probability of word in unlimited prediction results, falls back
+// to the probability of <unk> for unknown words.
+double LanguageModel::find_probability(const vector<Result>& results,
+                                       const wchar_t* word)
+{
+    for (int i=0; i<(int)results.size(); i++)
+        if (results[i].word == word)
+            return results[i].p;
+    for (int i=0; i<(int)results.size(); i++)
+        if (results[i].word == L"<unk>")
+            return results[i].p;
+    return 0.0;
+}
+
+// Order of token positions by their history of up to order-1
+// preceding tokens.
+class cmp_history
+{
+    public:
+        cmp_history(const vector<wchar_t*>& _tokens, int _order) :
+            tokens(_tokens), order(_order)
+        {}
+
+        bool operator() (int i1, int i2)
+        {
+            int n1 = min(i1, order-1);
+            int n2 = min(i2, order-1);
+            if (n1 != n2)
+                return n1 < n2;
+            for (int k=n1; k>0; k--)
+            {
+                int cmp = wcscmp(tokens[i1-k], tokens[i2-k]);
+                if (cmp)
+                    return cmp < 0;
+            }
+            return false;
+        }
+
+        const vector<wchar_t*>& tokens;
+        int order;
+};
+
+// Return the probabilities of all tokens of a text, each given its
+// history of up to order-1 preceding tokens. Same results as calling
+// get_probability() for each n-gram, but with only one prediction per
+// distinct history.
+void LanguageModel::get_probabilities(const vector<wchar_t*>& tokens,
+                                      int order,
+                                      vector<double>& probabilities)
+{
+    int n = tokens.size();
+    probabilities.assign(n, 0.0);
+    if (order < 1)
+        return;
+
+    // group token positions by history
+    cmp_history cmp(tokens, order);
+    vector<int> positions(n);
+    for (int i=0; i<n; i++)
+        positions[i] = i;
+    std::stable_sort(positions.begin(), positions.end(), cmp);
+
+    vector<wchar_t*> ctx;
+    vector<Result> results;
+    for (int i=0; i<n; )
+    {
+        int j = i+1;
+        while (j < n && !cmp(positions[i], positions[j]))
+            j++;
+
+        // Run an unlimited prediction to get normalization right for
+        // overlay and loglinint. The order of results doesn't matter.
+        int pos = positions[i];
+        ctx.assign(tokens.begin() + max(pos-(order-1), 0),
+                   tokens.begin() + pos);
+        ctx.push_back((wchar_t*)L"");
+        predict(results, ctx, -1, NORMALIZE | NO_SORT);
+
+        for (; i<j; i++)
+            probabilities[positions[i]] =
+                find_probability(results, tokens[positions[i]]);
+    }
+}
+
 // split context into history and prefix
 const wchar_t* LanguageModel::split_context(const vector<wchar_t*>& context,
                                                   vector<wchar_t*>& history)
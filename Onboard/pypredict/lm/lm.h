@@ -31,6 +31,7 @@
 #include <map>
 #include <algorithm>
 #include <string>
+#include <mutex>
 
 
 // break into debugger
@@ -87,6 +88,9 @@ enum LMError
     ERR_UNEXPECTED_EOF,
     ERR_WC2MB,
     ERR_MD2WC,
+    ERR_BAD_HEADER,
+    ERR_VERSION_UNSUPPORTED,
+    ERR_CHECKSUM,
 };
 
 template <class T>
@@ -110,9 +114,8 @@ class StrConv
             char* inptr = const_cast<char*>(instr);
             size_t inbytes = strlen(instr);
 
-            static char outstr[4096];
-            char* outptr = outstr;
-            size_t outbytes = sizeof(outstr);
+            char* outptr = wcstr;
+            size_t outbytes = sizeof(wcstr);
 
             size_t nconv;
 
@@ -134,7 +137,7 @@ class StrConv
             if (outbytes >= sizeof (wchar_t))
                 *((wchar_t *) outptr) = L'\0';
 
-            return (wchar_t *) outstr;
+            return (wchar_t *) wcstr;
         }
 
         // encode wide-char to multi-byte
@@ -143,9 +146,8 @@ class StrConv
             char* inptr = (char*)instr;
             size_t inbytes = wcslen(instr) * sizeof(*instr);
 
-            static char outstr[4096];
-            char* outptr = outstr;
-            size_t outbytes = sizeof(outstr);
+            char* outptr = mbstr;
+            size_t outbytes = sizeof(mbstr);
 
             size_t nconv = iconv(cd_wc_mb, &inptr, &inbytes,
                                            &outptr, &outbytes);
@@ -166,9 +168,12 @@ class StrConv
             if (outbytes >= sizeof (wchar_t))
                 *outptr = '\0';
 
-            return outstr;
+            return mbstr;
         }
     private:
+        // per instance, conversions may run concurrently in different models
+        char wcstr[4096];
+        char mbstr[4096];
         iconv_t cd_mb_wc;
         iconv_t cd_wc_mb;
 };
@@ -184,16 +189,29 @@ class Dictionary
         Dictionary()
         {
             sorted = NULL;
+            folded_keys = NULL;
+            folded_sorted = NULL;
+            mapped_begin = NULL;
+            mapped_end = NULL;
             clear();
         }
 
+        ~Dictionary()
+        {
+            clear_folded_index();
+        }
+
         void clear();
 
         WordId word_to_id(const wchar_t* word);
         const wchar_t* id_to_word(WordId wid);
+        const char* id_to_word_utf8(WordId wid)
+        {return wid < words.size() ? words[wid] : NULL;}
         std::vector<WordId> words_to_ids(const wchar_t** word, int n);
 
         LMError set_words(const std::vector<wchar_t*>& new_words);
+        LMError set_mapped_words(const std::vector<const char*>& new_words,
+                                 const void* begin, const void* end);
         WordId add_word(const wchar_t* word);
 
         // get word ids, add unknown words as needed
@@ -231,12 +249,21 @@ class Dictionary
                            std::vector<WordId>* wids_in,  // may be NULL
                            std::vector<WordId>& wids_out,
                            uint32_t options = 0);
+        void fuzzy_prefix_search(const wchar_t* prefix, int max_distance,
+                                 std::vector<WordId>& wids_out,
+                                 std::vector<int>& distances_out,
+                                 uint32_t options = 0);
         int lookup_word(const wchar_t* word);
 
         int get_num_word_types() {return words.size();}
 
         uint64_t get_memory_size();
 
+        // Changes whenever existing word ids may change their meaning.
+        // Adding words keeps the epoch, they only get new ids.
+        uint64_t get_epoch() {return epoch;}
+        static uint64_t new_epoch();
+
     protected:
         int search_index(const char* word)
         {
@@ -299,11 +326,151 @@ class Dictionary
 
         void update_sorting(const char* word, WordId wid);
 
+        // prefix index
+        void get_prefix_matches(const char* prefix, WordId min_wid,
+                                std::vector<WordId>& wids);
+        void get_folded_prefix_matches(const char* prefix, WordId min_wid,
+                                       std::vector<WordId>& wids);
+
+        // case- and accent-folded keys, built on demand
+        void build_folded_index();
+        void clear_folded_index();
+        void update_folded_key(WordId wid);
+        void update_folded_index(WordId wid);
+        const char* get_folded_key(WordId wid)
+        {
+            const char* key = (*folded_keys)[wid];
+            return key ? key : words[wid];
+        }
+        int binsearch_folded(const char* key)
+        {
+            int lo = 0;
+            int hi = folded_sorted->size();
+            while (lo < hi)
+            {
+                int mid = (lo+hi)>>1;
+                int cmp = strcmp(get_folded_key((*folded_sorted)[mid]), key);
+                if (cmp < 0)
+                    lo = mid + 1;
+                else
+                    hi = mid;
+            }
+            return lo;
+        }
+
     protected:
         std::vector<char*> words;
         std::vector<WordId>* sorted;  // only when words aren't already sorted
         int sorted_words_begin;
         StrConv conv;
+
+        // Folded keys, one per word id, NULL where the folded key
+        // equals the word itself. Keeps memory low for the majority
+        // of lower case words without accents.
+        std::vector<char*>* folded_keys;
+        std::vector<WordId>* folded_sorted; // word ids sorted by folded key
+
+        // Address range of words that live in a memory mapped
+        // binary model. They are owned by the mapping, not by us.
+        const char* mapped_begin;
+        const char* mapped_end;
+        bool is_mapped(const char* w)
+        {return w >= mapped_begin && w < mapped_end;}
+
+        uint64_t epoch;
+};
+
+
+//------------------------------------------------------------------------
+// PredictionCache - state of the previous prediction of a session
+//------------------------------------------------------------------------
+// Keeps the scored candidate words of the last prediction. Extending
+// the completion prefix only narrows down the candidates, so their
+// probabilities can be taken from the cache instead of being
+// calculated again.
+
+class LanguageModel;
+
+class PredictionCache
+{
+    public:
+        PredictionCache()
+        {
+            clear();
+        }
+
+        void clear()
+        {
+            model = NULL;
+            generation = 0;
+            options = 0;
+            history.clear();
+            prefix.clear();
+            candidates.clear();
+            probabilities.clear();
+            components.clear();
+        }
+
+        // Can the cached candidates be filtered to get the candidates
+        // for the given history and prefix?
+        bool can_filter(LanguageModel* lm, uint64_t lm_generation,
+                        const std::vector<WordId>& wids,
+                        const wchar_t* new_prefix, uint32_t new_options)
+        {
+            return model == lm &&
+                   generation == lm_generation &&
+                   options == new_options &&
+                   history == wids &&
+                   !prefix.empty() &&
+                   new_prefix &&
+                   wcsncmp(new_prefix, prefix.c_str(), prefix.size()) == 0;
+        }
+
+        void update(LanguageModel* lm, uint64_t lm_generation,
+                    const std::vector<WordId>& wids,
+                    const wchar_t* new_prefix, uint32_t new_options,
+                    const std::vector<WordId>& new_candidates,
+                    const std::vector<double>& new_probabilities)
+        {
+            model = lm;
+            generation = lm_generation;
+            options = new_options;
+            history = wids;
+            prefix = new_prefix ? new_prefix : L"";
+            candidates = new_candidates;
+            probabilities = new_probabilities;
+        }
+
+        // Look up cached probabilities of a subset of the candidates.
+        // Both are sorted by word id.
+        bool get_probs(const std::vector<WordId>& wids,
+                       std::vector<double>& probs)
+        {
+            int j = 0;
+            int size = candidates.size();
+            probs.resize(wids.size());
+            for (int i=0; i<(int)wids.size(); i++)
+            {
+                while (j < size && candidates[j] < wids[i])
+                    j++;
+                if (j >= size || candidates[j] != wids[i])
+                    return false;
+                probs[i] = probabilities[j];
+            }
+            return true;
+        }
+
+    public:
+        LanguageModel* model;
+        uint64_t generation;
+        uint32_t options;
+        std::vector<WordId> history;
+        std::wstring prefix;
+        std::vector<WordId> candidates;       // sorted by word id
+        std::vector<double> probabilities;    // one per candidate
+
+        // caches of the component models of merged models
+        std::vector<PredictionCache> components;
 };
 
 
@@ -339,17 +506,34 @@ class LanguageModel
             NORMALIZE              = 1<<8, // explicit normalization for
                                            // overlay and loglinint, everything
                                            // else ought to be normalized already.
+
+            // Post-filtering of the final results. The limit applies
+            // to what is left after filtering.
+            IGNORE_MARKERS         = 1<<9,  // ignore control words and
+                                            // <bot:...> markers
+            PREFER_LOWER_CASE      = 1<<10, // drop words whose lower case
+                                            // spelling exists in the model
+            CAPITALIZE             = 1<<11, // upper case first letters, drop
+                                            // the duplicates this creates
+
+            FUZZY_PREFIX           = 1<<12, // typo-tolerant completion, also
+                                            // complete prefixes within a
+                                            // small edit distance
             FILTER_OPTIONS         = CASE_INSENSITIVE |
                                      ACCENT_INSENSITIVE |
                                      ACCENT_INSENSITIVE_SMART |
                                      IGNORE_CAPITALIZED |
                                      IGNORE_NON_CAPITALIZED,
+            POST_FILTER_OPTIONS    = IGNORE_MARKERS |
+                                     PREFER_LOWER_CASE |
+                                     CAPITALIZE,
             DEFAULT_OPTIONS        = 0
         };
 
     public:
         LanguageModel()
         {
+            generation = 0;
         }
 
         virtual ~LanguageModel()
@@ -359,8 +543,13 @@ class LanguageModel
         virtual void clear()
         {
             dictionary.clear();
+            generation++;
         }
 
+        // Changes whenever the model contents change,
+        // invalidates prediction caches.
+        virtual uint64_t get_generation() {return generation;}
+
         // never fails
         virtual WordId word_to_id(const wchar_t* word)
         {
@@ -380,7 +569,7 @@ class LanguageModel
         }
 
         // never fails
-        const wchar_t* id_to_word(WordId wid)
+        virtual const wchar_t* id_to_word(WordId wid)
         {
             static const wchar_t* not_found = L"";
             const wchar_t* w = dictionary.id_to_word(wid);
@@ -389,18 +578,49 @@ class LanguageModel
             return w;
         }
 
-        int lookup_word(const wchar_t* word)
+        // UTF-8 word of the vocabulary, NULL if the id doesn't exist
+        virtual const char* id_to_word_utf8(WordId wid)
+        {
+            return dictionary.id_to_word_utf8(wid);
+        }
+
+        // Changes whenever word ids may change their meaning,
+        // invalidates word id mappings of merged models.
+        virtual uint64_t get_vocabulary_epoch()
+        {
+            return dictionary.get_epoch();
+        }
+
+        virtual int lookup_word(const wchar_t* word)
         {
             return dictionary.lookup_word(word);
         }
 
         typedef struct {std::wstring word; double p;} Result;
+        void predict(std::vector<LanguageModel::Result>& results,
+                     const std::vector<wchar_t*>& context,
+                     int limit=-1,
+                     uint32_t options = DEFAULT_OPTIONS)
+        {
+            predict(results, context, limit, options, NULL);
+        }
         virtual void predict(std::vector<LanguageModel::Result>& results,
                              const std::vector<wchar_t*>& context,
-                             int limit=-1,
-                             uint32_t options = DEFAULT_OPTIONS);
+                             int limit, uint32_t options,
+                             PredictionCache* cache);
+
+        // Same as predict(), but with results as word ids of the model's
+        // vocabulary. Words are only looked up for the final results.
+        virtual void predict_ids(std::vector<WordId>& wids,
+                                 std::vector<double>& probabilities,
+                                 const std::vector<wchar_t*>& context,
+                                 int limit, uint32_t options,
+                                 PredictionCache* cache);
 
         virtual double get_probability(const wchar_t* const* ngram, int n);
+        virtual void get_probabilities(const std::vector<wchar_t*>& tokens,
+                                       int order,
+                                       std::vector<double>& probabilities);
 
         virtual int get_num_word_types() {return dictionary.get_num_word_types();}
 
@@ -412,6 +632,17 @@ class LanguageModel
     protected:
         const wchar_t* split_context(const std::vector<wchar_t*>& context,
                                      std::vector<wchar_t*>& history);
+        static int get_max_edit_distance(const wchar_t* prefix);
+        static void find_exact_completions(
+                                     const std::vector<const char*>& words,
+                                     const wchar_t* prefix, uint32_t options,
+                                     std::vector<bool>& exact);
+        void post_filter(std::vector<Result>& results,
+                         const std::vector<WordId>& wids,
+                         const std::vector<double>& probabilities,
+                         int limit, uint32_t options);
+        static double find_probability(const std::vector<Result>& results,
+                                       const wchar_t* word);
         virtual void get_words_with_predictions(
                                      const std::vector<WordId>& history,
                                      std::vector<WordId>& wids)
@@ -419,7 +650,8 @@ class LanguageModel
         virtual void get_candidates(const std::vector<WordId>& history,
                                     const wchar_t* prefix,
                                     std::vector<WordId>& wids,
-                                    uint32_t options);
+                                    uint32_t options,
+                                    std::vector<int>* distances = NULL);
         virtual void filter_candidates(const std::vector<WordId>& in,
                                              std::vector<WordId>& out)
         {
@@ -431,8 +663,27 @@ class LanguageModel
         {}
         LMError read_utf8(const char* filename, wchar_t*& text);
 
+        // Assign a parameter that affects probabilities,
+        // invalidates prediction caches on change.
+        template <class T>
+        void set_parameter(T& parameter, const T& value)
+        {
+            if (!(parameter == value))
+            {
+                parameter = value;
+                generation++;
+            }
+        }
+
     public:
         Dictionary dictionary;
+
+        // Held by the python bindings while the model is in use,
+        // see ModelGuard in lm_python.cpp.
+        std::recursive_mutex mutex;
+
+    protected:
+        uint64_t generation;
 };
 
 
@@ -0,0 +1,339 @@
+/*
+ * Copyright © 2026 agent <agent@local>
+ *
+ * This file is part of Onboard.
+ *
+ * Onboard is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * Onboard is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+#include "lm_binary.h"
+
+using namespace std;
+
+
+// 64 bit FNV-1a hash
+static uint64_t fnv1a(const uint8_t* data, size_t size)
+{
+    uint64_t h = 0xcbf29ce484222325ULL;
+    for (size_t i=0; i<size; i++)
+    {
+        h ^= data[i];
+        h *= 0x100000001b3ULL;
+    }
+    return h;
+}
+
+static void align(vector<uint8_t>& buf, size_t alignment = 8)
+{
+    size_t size = (buf.size() + alignment - 1) / alignment * alignment;
+    buf.resize(size, 0);
+}
+
+template <class T>
+static void append(vector<uint8_t>& buf, const vector<T>& v)
+{
+    if (!v.empty())
+    {
+        const uint8_t* p = reinterpret_cast<const uint8_t*>(&v[0]);
+        buf.insert(buf.end(), p, p + v.size() * sizeof(T));
+    }
+}
+
+
+//------------------------------------------------------------------------
+// MappedFile
+//------------------------------------------------------------------------
+
+LMError MappedFile::open(const char* filename)
+{
+    close();
+
+    int fd = ::open(filename, O_RDONLY);
+    if (fd < 0)
+        return ERR_FILE;
+
+    struct stat st;
+    if (fstat(fd, &st) < 0)
+    {
+        ::close(fd);
+        return ERR_FILE;
+    }
+
+    if (st.st_size < (off_t)sizeof(BinaryModelHeader))
+    {
+        ::close(fd);
+        return ERR_BAD_HEADER;
+    }
+
+    void* p = mmap(NULL, st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+    ::close(fd);   // the mapping keeps its own reference
+    if (p == MAP_FAILED)
+        return ERR_FILE;
+
+    data = static_cast<const uint8_t*>(p);
+    size = st.st_size;
+
+    return ERR_NONE;
+}
+
+void MappedFile::close()
+{
+    if (data)
+    {
+        munmap(const_cast<uint8_t*>(data), size);
+        data = NULL;
+        size = 0;
+    }
+}
+
+
+//------------------------------------------------------------------------
+// reading and writing
+//------------------------------------------------------------------------
+
+// Check the magic number only, cheap enough to sniff the file type.
+bool is_binary_model(const char* filename)
+{
+    char magic[sizeof(((BinaryModelHeader*)0)->magic)];
+
+    FILE* f = fopen(filename, "rb");
+    if (!f)
+        return false;
+    size_t n = fread(magic, 1, sizeof(magic), f);
+    fclose(f);
+
+    return n == sizeof(magic) &&
+           memcmp(magic, BINARY_MODEL_MAGIC, sizeof(magic)) == 0;
+}
+
+// Lay out the tables in memory exactly as they are stored on disk.
+LMError build_binary_model(vector<uint8_t>& buf, int order, int num_words,
+                           const BinaryModelTables& tables)
+{
+    if (order < 1 || order > BINARY_MODEL_MAX_ORDER ||
+        (int)tables.levels.size() != order ||
+        (int)tables.words.size() != num_words)
+        return ERR_ORDER_UNSUPPORTED;
+
+    BinaryModelHeader header;
+    memset(&header, 0, sizeof(header));
+    memcpy(header.magic, BINARY_MODEL_MAGIC, sizeof(header.magic));
+    header.version = BINARY_MODEL_VERSION;
+    header.header_size = sizeof(header);
+    header.byte_order = BINARY_MODEL_BYTE_ORDER;
+    header.flags = tables.flags;
+    header.order = order;
+    header.num_words = num_words;
+
+    // The payload starts right after the header, offsets are
+    // relative to the beginning of the file.
+    buf.assign(sizeof(header), 0);
+
+    // vocabulary
+    header.vocabulary_offset = buf.size();
+    vector<uint32_t> offsets;
+    offsets.reserve(num_words);
+    uint32_t offset = 0;
+    for (int i=0; i<num_words; i++)
+    {
+        offsets.push_back(offset);
+        offset += strlen(tables.words[i]) + 1;
+    }
+    append(buf, offsets);
+    for (int i=0; i<num_words; i++)
+    {
+        const char* w = tables.words[i];
+        buf.insert(buf.end(), w, w + strlen(w) + 1);
+    }
+
+    // n-gram levels
+    for (int level=0; level<order; level++)
+    {
+        const BinaryModelTables::Level& l = tables.levels[level];
+        size_t num_nodes = l.wids.size();
+        if (l.counts.size() != num_nodes ||
+            (tables.flags & BINARY_MODEL_HAS_TIMES &&
+             l.times.size() != num_nodes) ||
+            (level < order-1 && l.child_begin.size() != num_nodes+1))
+            return ERR_COUNT;
+
+        align(buf);
+        header.level_offsets[level] = buf.size();
+        header.num_nodes[level] = num_nodes;
+        append(buf, l.wids);
+        append(buf, l.counts);
+        if (tables.flags & BINARY_MODEL_HAS_TIMES)
+            append(buf, l.times);
+        if (level < order-1)
+            append(buf, l.child_begin);
+    }
+    align(buf);
+
+    header.file_size = buf.size();
+    header.checksum = fnv1a(&buf[sizeof(header)], buf.size() - sizeof(header));
+    memcpy(&buf[0], &header, sizeof(header));
+
+    return ERR_NONE;
+}
+
+LMError write_binary_model(const char* filename, int order, int num_words,
+                           const BinaryModelTables& tables)
+{
+    vector<uint8_t> buf;
+    LMError err = build_binary_model(buf, order, num_words, tables);
+    if (err)
+        return err;
+
+    return replace_file(filename, &buf[0], buf.size());
+}
+
+// Write a new file and rename it over filename once it is complete.
+// Other processes may have the old file mapped, rewriting it in place
+// would pull the rug out from under them.
+LMError replace_file(const char* filename, const void* data, size_t size)
+{
+    string tmp_filename = string(filename) + ".XXXXXX";
+    int fd = mkstemp(&tmp_filename[0]);
+    if (fd < 0)
+        return ERR_FILE;
+
+    // readable for everyone, like any other model file
+    bool failed = fchmod(fd, 0644) != 0;
+
+    const uint8_t* p = static_cast<const uint8_t*>(data);
+    size_t written = 0;
+    while (!failed && written < size)
+    {
+        ssize_t n = write(fd, p + written, size - written);
+        if (n < 0)
+            failed = true;
+        else
+            written += n;
+    }
+
+    if (fsync(fd) != 0)
+        failed = true;
+    if (::close(fd) != 0)
+        failed = true;
+    if (!failed && rename(tmp_filename.c_str(), filename) != 0)
+        failed = true;
+
+    if (failed)
+    {
+        unlink(tmp_filename.c_str());
+        return ERR_FILE;
+    }
+
+    return ERR_NONE;
+}
+
+// Validate the mapped file and set up a view into it.
+LMError read_binary_model(const MappedFile& file, BinaryModelView& view)
+{
+    return read_binary_model(file.data, file.size, view);
+}
+
+// Validate a binary model in memory and set up a view into it.
+LMError read_binary_model(const uint8_t* data, size_t size,
+                          BinaryModelView& view)
+{
+    const BinaryModelHeader* header =
+                      reinterpret_cast<const BinaryModelHeader*>(data);
+
+    if (size < sizeof(BinaryModelHeader) ||
+        memcmp(header->magic, BINARY_MODEL_MAGIC, sizeof(header->magic)) ||
+        header->header_size != sizeof(BinaryModelHeader) ||
+        header->byte_order != BINARY_MODEL_BYTE_ORDER ||
+        header->file_size != size)
+        return ERR_BAD_HEADER;
+
+    if (header->version != BINARY_MODEL_VERSION)
+        return ERR_VERSION_UNSUPPORTED;
+
+    if (header->order < 1 || header->order > BINARY_MODEL_MAX_ORDER)
+        return ERR_ORDER_UNSUPPORTED;
+
+    if (fnv1a(data + sizeof(BinaryModelHeader),
+              size - sizeof(BinaryModelHeader)) != header->checksum)
+        return ERR_CHECKSUM;
+
+    // vocabulary
+    uint64_t num_words = header->num_words;
+    uint64_t strings_begin = header->vocabulary_offset +
+                             num_words * sizeof(uint32_t);
+    uint64_t strings_end = header->order ? header->level_offsets[0] :
+                                           size;
+    if (strings_begin > strings_end || strings_end > size)
+        return ERR_BAD_HEADER;
+
+    const uint32_t* offsets = reinterpret_cast<const uint32_t*>
+                             (data + header->vocabulary_offset);
+    const char* strings = reinterpret_cast<const char*>
+                             (data + strings_begin);
+    uint64_t strings_size = strings_end - strings_begin;
+
+    // The strings are zero terminated, but there may be alignment
+    // padding after the last one.
+    view.words.resize(num_words);
+    for (uint64_t i=0; i<num_words; i++)
+    {
+        if (offsets[i] >= strings_size ||
+            !memchr(strings + offsets[i], 0, strings_size - offsets[i]))
+            return ERR_BAD_HEADER;
+        view.words[i] = strings + offsets[i];
+    }
+
+    // levels
+    for (uint32_t level=0; level<header->order; level++)
+    {
+        uint64_t num_nodes = header->num_nodes[level];
+        uint64_t bytes = num_nodes * (sizeof(WordId) + sizeof(CountType));
+        if (header->flags & BINARY_MODEL_HAS_TIMES)
+            bytes += num_nodes * sizeof(uint32_t);
+        if (level < header->order-1)
+            bytes += (num_nodes + 1) * sizeof(uint32_t);
+
+        uint64_t offset = header->level_offsets[level];
+        if (offset % 8 || offset + bytes > size)
+            return ERR_BAD_HEADER;
+    }
+
+    view.header = header;
+
+    return ERR_NONE;
+}
+
+// Models use the vocabulary of the file as the dictionary's sorted
+// index, so it has to be in the order Dictionary expects: control
+// words first, then all other words strictly ascending.
+LMError check_sorted_vocabulary(const BinaryModelView& view)
+{
+    if (!(view.header->flags & BINARY_MODEL_SORTED_VOCABULARY))
+        return ERR_BAD_HEADER;
+
+    const vector<const char*>& words = view.words;
+    for (int i=NUM_CONTROL_WORDS+1; i<(int)words.size(); i++)
+        if (strcmp(words[i-1], words[i]) >= 0)
+            return ERR_BAD_HEADER;
+
+    return ERR_NONE;
+}
@@ -0,0 +1,181 @@
+/*
+ * Copyright © 2026 agent <agent@local>
+ *
+ * This file is part of Onboard.
+ *
+ * Onboard is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * Onboard is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#ifndef LM_BINARY_H
+#define LM_BINARY_H
+
+#include <vector>
+
+#include "lm.h"
+
+//------------------------------------------------------------------------
+// Binary model format - read-only, memory mapped system models
+//------------------------------------------------------------------------
+//
+// Layout, all values in native byte order, sections 8 byte aligned:
+//
+//   BinaryModelHeader
+//   vocabulary:  uint32_t offsets[num_words]  (relative to the strings)
+//                char strings[]               (UTF-8, zero terminated)
+//   per level:   WordId   wids[num_nodes]     (sorted per parent)
+//                CountType counts[num_nodes]
+//                uint32_t times[num_nodes]    (BINARY_MODEL_HAS_TIMES only)
+//                uint32_t child_begin[num_nodes+1]  (all but the last level)
+//
+// Levels are stored breadth first. The children of node i of level k
+// are the nodes child_begin[i] to child_begin[i+1]-1 of level k+1.
+// Level 0, the unigrams, has exactly one node per word id.
+
+#define BINARY_MODEL_MAGIC "OBLMBIN"
+#define BINARY_MODEL_VERSION 1
+#define BINARY_MODEL_BYTE_ORDER 0x01020304
+#define BINARY_MODEL_MAX_ORDER 16
+
+enum BinaryModelFlags
+{
+    BINARY_MODEL_HAS_TIMES        = 1<<0, // recency time stamps included
+    BINARY_MODEL_SORTED_VOCABULARY = 1<<1, // word ids in sort order
+};
+
+typedef struct
+{
+    char     magic[8];
+    uint32_t version;
+    uint32_t header_size;
+    uint32_t byte_order;
+    uint32_t flags;
+    uint32_t order;
+    uint32_t num_words;
+    uint32_t num_nodes[BINARY_MODEL_MAX_ORDER];
+    uint64_t vocabulary_offset;
+    uint64_t level_offsets[BINARY_MODEL_MAX_ORDER];
+    uint64_t file_size;
+    uint64_t checksum;     // FNV-1a over everything after the header
+} BinaryModelHeader;
+
+// Level-wise tables of a whole n-gram trie, in-memory counterpart
+// of the binary file layout.
+class BinaryModelTables
+{
+    public:
+        class Level
+        {
+            public:
+                std::vector<WordId> wids;
+                std::vector<CountType> counts;
+                std::vector<uint32_t> times;
+                std::vector<uint32_t> child_begin;
+        };
+
+    public:
+        BinaryModelTables()
+        {
+            flags = 0;
+        }
+
+        uint32_t flags;
+        std::vector<const char*> words;   // UTF-8, indexed by word id
+        std::vector<Level> levels;
+};
+
+// Read-only view of a mapped binary model file.
+class BinaryModelView
+{
+    public:
+        BinaryModelView()
+        {
+            header = NULL;
+        }
+
+        const BinaryModelHeader* header;
+        std::vector<const char*> words;
+
+        const WordId*    get_wids(int level)
+        {return (const WordId*) get_level(level);}
+        const CountType* get_counts(int level)
+        {return (const CountType*) (get_wids(level) + get_num_nodes(level));}
+        const uint32_t*  get_times(int level)
+        {
+            if (!(header->flags & BINARY_MODEL_HAS_TIMES))
+                return NULL;
+            return (const uint32_t*) (get_counts(level) + get_num_nodes(level));
+        }
+        const uint32_t*  get_child_begin(int level)
+        {
+            if (level >= get_order() - 1)
+                return NULL;
+            const uint32_t* p = (const uint32_t*) (get_counts(level) +
+                                                   get_num_nodes(level));
+            if (header->flags & BINARY_MODEL_HAS_TIMES)
+                p += get_num_nodes(level);
+            return p;
+        }
+
+        int get_order() {return header->order;}
+        int get_num_nodes(int level) {return header->num_nodes[level];}
+
+    private:
+        const uint8_t* get_level(int level)
+        {return (const uint8_t*)header + header->level_offsets[level];}
+};
+
+//------------------------------------------------------------------------
+// MappedFile - read-only, shared memory mapping of a whole file
+//------------------------------------------------------------------------
+class MappedFile
+{
+    public:
+        MappedFile()
+        {
+            data = NULL;
+            size = 0;
+        }
+        ~MappedFile()
+        {
+            close();
+        }
+
+        LMError open(const char* filename);
+        void close();
+        bool is_open() {return data != NULL;}
+
+        // Transfer ownership of the mapping.
+        void swap(MappedFile& other)
+        {
+            std::swap(data, other.data);
+            std::swap(size, other.size);
+        }
+
+    public:
+        const uint8_t* data;
+        size_t size;
+};
+
+bool is_binary_model(const char* filename);
+LMError build_binary_model(std::vector<uint8_t>& buf, int order,
+                           int num_words, const BinaryModelTables& tables);
+LMError write_binary_model(const char* filename, int order, int num_words,
+                           const BinaryModelTables& tables);
+LMError read_binary_model(const MappedFile& file, BinaryModelView& view);
+LMError read_binary_model(const uint8_t* data, size_t size,
+                          BinaryModelView& view);
+LMError check_sorted_vocabulary(const BinaryModelView& view);
+LMError replace_file(const char* filename, const void* data, size_t size);
+
+#endif
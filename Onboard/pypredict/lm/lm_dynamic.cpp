@@ -18,11 +18,71 @@
  */
 
 #include <error.h>
+#include <unistd.h>
+#include <algorithm>
 
 #include "lm_dynamic.h"
 
 using namespace std;
 
+//------------------------------------------------------------------------
+// ModelSnapshot
+//------------------------------------------------------------------------
+
+LMError ModelSnapshot::save(const char* filename)
+{
+    int i;
+
+    FILE* f = fopen(filename, "w");
+    if (!f)
+        return ERR_FILE;
+
+    fprintf(f, "\n");
+    fprintf(f, "\\data\\\n");
+
+    for (i=0; i<order; i++)
+        fprintf(f, "ngram %d=%d\n", i+1, num_ngrams[i]);
+
+    int stride = with_times ? 2 : 1;
+    for (i=0; i<order; i++)
+    {
+        fprintf(f, "\n");
+        fprintf(f, "\\%d-grams:\n", i+1);
+
+        int n = i+1;
+        const WordId* wids = ngrams[i].data();
+        const int32_t* v = values[i].data();
+        int count = values[i].size() / stride;
+        for (int j=0; j<count; j++, wids += n, v += stride)
+        {
+            if (with_times)
+                fprintf(f, "%d %d", v[0], v[1]);
+            else
+                fprintf(f, "%d", v[0]);
+
+            for (int k=0; k<n; k++)
+            {
+                fputc(' ', f);
+                fputs(&words[word_offsets[wids[k]]], f);
+            }
+            fputc('\n', f);
+        }
+    }
+
+    fprintf(f, "\n");
+    fprintf(f, "\\end\\\n");
+
+    // Durable before the caller considers the model saved.
+    bool failed = fflush(f) != 0 ||
+                  ferror(f) ||
+                  fsync(fileno(f)) != 0;
+    if (fclose(f) != 0)
+        failed = true;
+
+    return failed ? ERR_FILE : ERR_NONE;
+}
+
+
 //------------------------------------------------------------------------
 // DynamicModelBase
 //------------------------------------------------------------------------
@@ -335,3 +395,687 @@ LMError DynamicModelBase::set_unigrams(const vector<Unigram>& unigrams)
     return error;
 }
 
+
+// Count all n-grams of a stream of tokens.
+// <unk> isn't learned, the token stream is split into sections
+// between <unk>s. Sentence begins <s> start new sections too,
+// so that n-grams don't span across sentences.
+LMError DynamicModelBase::learn_tokens(const vector<wchar_t*>& tokens,
+                                       bool allow_new_words)
+{
+    int n = tokens.size();
+    if (!n)
+        return ERR_NONE;
+
+    vector<WordId> wids(n);
+    if (!dictionary.query_add_words(&tokens[0], n, wids, allow_new_words))
+        return ERR_MEMORY;
+
+    int begin = 0;
+    for (int i=0; i<=n; i++)
+    {
+        if (i == n ||
+            wcscmp(tokens[i], L"<unk>") == 0)
+        {
+            // drop trailing single <s>
+            if (i - begin > 1 ||
+                (i - begin == 1 && wcscmp(tokens[begin], L"<s>") != 0))
+                if (learn_section(wids, begin, i))
+                    return ERR_MEMORY;
+            begin = i+1;
+        }
+        else
+        if (wcscmp(tokens[i], L"<s>") == 0)
+        {
+            if (i > begin)
+                if (learn_section(wids, begin, i))
+                    return ERR_MEMORY;
+            begin = i;   // keep <s> as start of the next section
+        }
+    }
+
+    return ERR_NONE;
+}
+
+// Run a window of size <order> along the section and count n-grams.
+LMError DynamicModelBase::learn_section(const vector<WordId>& wids,
+                                        int begin, int end)
+{
+    for (int i=begin; i<end; i++)
+        for (int n=1; n<=order && i+n<=end; n++)
+            if (!count_ngram(&wids[i], n, 1))
+                return ERR_MEMORY;
+    return ERR_NONE;
+}
+
+// Number of n-gram types and total occurrences for each level.
+void DynamicModelBase::get_counts(vector<int>& counts, vector<int>& totals)
+{
+    counts.assign(order, 0);
+    totals.assign(order, 0);
+
+    DynamicModelBase::ngrams_iter* it;
+    for (it = ngrams_begin(); ; (*it)++)
+    {
+        BaseNode* node = *(*it);
+        if (!node)
+            break;
+
+        int level = it->get_level();
+        if (level >= 1 && level <= order)
+        {
+            counts[level-1]++;
+            totals[level-1] += node->get_count();
+        }
+    }
+    delete it;
+}
+
+// Simulate removal of context.back() where it appears after the
+// history of context. Collects all n-grams containing context and
+// their (negative) count changes in traversal order.
+void DynamicModelBase::get_remove_context_changes(
+                                        const vector<WordId>& context,
+                                        vector<NGramCount>& changes)
+{
+    changes.clear();
+
+    int m = context.size();
+    if (!m)
+        return;
+
+    vector<WordId> wids;
+    DynamicModelBase::ngrams_iter* it;
+    for (it = ngrams_begin(); ; (*it)++)
+    {
+        BaseNode* node = *(*it);
+        if (!node)
+            break;
+        if (it->at_root())
+            continue;
+
+        it->get_ngram(wids);
+        int n = wids.size();
+        for (int i=m-1; i<n; i++)
+            if (equal(context.begin(), context.end(), wids.begin()+i-m+1))
+            {
+                changes.push_back(NGramCount(wids, -node->get_count()));
+                break;
+            }
+    }
+    delete it;
+}
+
+// Remove context.back() where it appears after the history of context.
+// Returns the applied count changes.
+LMError DynamicModelBase::remove_context(const vector<WordId>& context,
+                                         vector<NGramCount>& changes)
+{
+    get_remove_context_changes(context, changes);
+
+    vector<NGramCount>::const_iterator it;
+    for (it = changes.begin(); it != changes.end(); it++)
+        if (!count_ngram(&it->first[0], it->first.size(), it->second))
+            return ERR_MEMORY;
+
+    return ERR_NONE;
+}
+
+// Count all n-grams of this model in model.
+LMError DynamicModelBase::copy_to(DynamicModelBase* model)
+{
+    return copy_ngrams(model, NULL);
+}
+
+// Copy all n-grams, to be saved later by ModelSnapshot::save().
+void DynamicModelBase::take_snapshot(ModelSnapshot& snapshot)
+{
+    int i;
+
+    snapshot.order = order;
+    snapshot.with_times = has_node_times();
+
+    snapshot.num_ngrams.resize(order);
+    for (i=0; i<order; i++)
+        snapshot.num_ngrams[i] = get_num_ngrams(i);
+
+    int num_words = dictionary.get_num_word_types();
+    snapshot.words.clear();
+    snapshot.word_offsets.resize(num_words);
+    for (i=0; i<num_words; i++)
+    {
+        const char* word = dictionary.id_to_word_utf8(i);
+        snapshot.word_offsets[i] = snapshot.words.size();
+        snapshot.words.insert(snapshot.words.end(),
+                              word, word + strlen(word) + 1);
+    }
+
+    snapshot.ngrams.assign(order, vector<WordId>());
+    snapshot.values.assign(order, vector<int32_t>());
+
+    vector<WordId> wids;
+    DynamicModelBase::ngrams_iter* it;
+    for (it = ngrams_begin(); ; (*it)++)
+    {
+        BaseNode* node = *(*it);
+        if (!node)
+            break;
+        int level = it->get_level();
+        if (level < 1 || level > order)
+            continue;
+
+        it->get_ngram(wids);
+        vector<WordId>& ngrams = snapshot.ngrams[level-1];
+        ngrams.insert(ngrams.end(), wids.begin(), wids.end());
+
+        vector<int32_t>& values = snapshot.values[level-1];
+        values.push_back(node->get_count());
+        if (snapshot.with_times)
+            values.push_back(get_node_time(node));
+    }
+    delete it;
+}
+
+// Count all n-grams of this model in model, except those with counts
+// less or equal to the prune count of their level. The last prune
+// count applies to all higher levels, -1 prunes the whole level.
+LMError DynamicModelBase::prune_to(DynamicModelBase* model,
+                                   const vector<int>& prune_counts)
+{
+    if (prune_counts.empty())
+        return ERR_NONE;
+    return copy_ngrams(model, &prune_counts);
+}
+
+LMError DynamicModelBase::copy_ngrams(DynamicModelBase* model,
+                                      const vector<int>* prune_counts)
+{
+    LMError err = ERR_NONE;
+
+    // map word ids to those of the destination model, on demand
+    vector<WordId> wid_map(dictionary.get_num_word_types(), WIDNONE);
+    vector<WordId> wids;
+    vector<WordId> dst_wids;
+
+    DynamicModelBase::ngrams_iter* it;
+    for (it = ngrams_begin(); ; (*it)++)
+    {
+        BaseNode* node = *(*it);
+        if (!node)
+            break;
+        if (it->at_root())
+            continue;
+
+        int count = node->get_count();
+        it->get_ngram(wids);
+        int n = wids.size();
+
+        if (prune_counts)
+        {
+            int k = min((int)prune_counts->size(), n) - 1;
+            int prune_count = (*prune_counts)[k];
+            if (count <= prune_count || prune_count == -1)
+                continue;
+        }
+
+        dst_wids.resize(n);
+        for (int i=0; i<n; i++)
+        {
+            WordId& wid = wid_map[wids[i]];
+            if (wid == WIDNONE)
+            {
+                const wchar_t* word = dictionary.id_to_word(wids[i]);
+                if (!word)
+                {
+                    err = ERR_MD2WC;
+                    break;
+                }
+                wid = model->dictionary.word_to_id(word);
+                if (wid == WIDNONE)
+                    wid = model->dictionary.add_word(word);
+                if (wid == WIDNONE)
+                {
+                    err = ERR_MEMORY;
+                    break;
+                }
+                if (wid == (WordId)-2)   // conversion failed
+                {
+                    err = ERR_WC2MB;
+                    break;
+                }
+            }
+            dst_wids[i] = wid;
+        }
+        if (err)
+            break;
+
+        if (!model->count_ngram(&dst_wids[0], n, count))
+        {
+            err = ERR_MEMORY;
+            break;
+        }
+    }
+    delete it;
+
+    return err;
+}
+
+// Check the structure of a binary model and find the parent
+// index of each node, per level.
+static LMError get_binary_parents(BinaryModelView& view,
+                                  vector< vector<uint32_t> >& parents)
+{
+    int i;
+    int order = view.get_order();
+    int num_words = view.header->num_words;
+
+    parents.resize(order);
+    for (int level=0; level<order; level++)
+    {
+        int num_nodes = view.get_num_nodes(level);
+        const WordId* wids = view.get_wids(level);
+        for (i=0; i<num_nodes; i++)
+            if (wids[i] >= (WordId)num_words)
+                return ERR_BAD_HEADER;
+
+        const uint32_t* child_begin = view.get_child_begin(level);
+        if (child_begin)
+        {
+            if (child_begin[0] != 0 ||
+                child_begin[num_nodes] != (uint32_t)view.get_num_nodes(level+1))
+                return ERR_BAD_HEADER;
+
+            vector<uint32_t>& p = parents[level+1];
+            p.reserve(child_begin[num_nodes]);
+            for (i=0; i<num_nodes; i++)
+            {
+                if (child_begin[i] > child_begin[i+1])
+                    return ERR_BAD_HEADER;
+                p.insert(p.end(), child_begin[i+1] - child_begin[i], i);
+            }
+        }
+    }
+
+    return ERR_NONE;
+}
+
+// Load a binary model, see lm_binary.h.
+// The vocabulary stays in the memory mapped file, n-grams are
+// added level by level, including removed ones with count 0, so
+// the trie ends up exactly as it was saved.
+LMError DynamicModelBase::load_binary(const char* filename)
+{
+    int i;
+    MappedFile file;
+    BinaryModelView view;
+
+    clear();
+
+    LMError err_code = file.open(filename);
+    if (!err_code)
+        err_code = read_binary_model(file, view);
+    if (!err_code)
+        err_code = check_sorted_vocabulary(view);
+    if (err_code)
+        return err_code;
+
+    int new_order = view.get_order();
+
+    int max_order = get_max_order();
+    if (max_order && max_order < new_order)
+        return ERR_ORDER_UNSUPPORTED;
+
+    // Check the structure before touching the model and
+    // find the parent index of each node.
+    vector< vector<uint32_t> > parents;
+    err_code = get_binary_parents(view, parents);
+    if (err_code)
+        return err_code;
+
+    // clear language model and set it up for the new order
+    set_order(new_order);
+    reserve_unigrams(view.get_num_nodes(0));
+
+    // Words are stored sorted, just like set_words() would leave them,
+    // so word ids in the file are dictionary ids. Checked above.
+    err_code = dictionary.set_mapped_words(view.words, file.data,
+                                           file.data + file.size);
+    if (!err_code)
+    {
+        mapped_file.swap(file);
+
+        vector<WordId> ngram;
+        for (int level=0; level<new_order; level++)
+        {
+            int n = level+1;
+            int num_nodes = view.get_num_nodes(level);
+            const CountType* counts = view.get_counts(level);
+            const uint32_t* times = view.get_times(level);
+
+            ngram.resize(n);
+            for (i=0; i<num_nodes; i++)
+            {
+                // reconstruct the n-gram from the path to the root
+                uint32_t index = i;
+                for (int l=level; l>=0; l--)
+                {
+                    ngram[l] = view.get_wids(l)[index];
+                    if (l)
+                        index = parents[l][index];
+                }
+
+                BaseNode* node = count_ngram(&ngram[0], n, counts[i]);
+                if (!node)
+                {
+                    err_code = ERR_MEMORY; // out of memory
+                    break;
+                }
+                if (times)
+                    set_node_time(node, times[i]);
+            }
+            if (err_code)
+                break;
+        }
+    }
+
+    if (err_code)
+        clear();
+
+    // Control words exist in any valid model, but make sure anyway.
+    assure_valid_control_words();
+
+    return err_code;
+}
+
+// Count all n-grams of a binary model file in this model, on top of
+// the existing counts. Merges count tables without building a second
+// trie, e.g. of partial models counted by separate processes.
+LMError DynamicModelBase::merge_binary(const char* filename)
+{
+    MappedFile file;
+    BinaryModelView view;
+
+    LMError err_code = file.open(filename);
+    if (!err_code)
+        err_code = read_binary_model(file, view);
+    if (err_code)
+        return err_code;
+
+    int file_order = view.get_order();
+    if (file_order > get_order())
+        return ERR_ORDER_UNSUPPORTED;
+
+    vector< vector<uint32_t> > parents;
+    err_code = get_binary_parents(view, parents);
+    if (err_code)
+        return err_code;
+
+    // map word ids of the file to those of this model, on demand
+    StrConv conv;
+    vector<WordId> wid_map(view.header->num_words, WIDNONE);
+
+    vector<WordId> ngram;
+    for (int level=0; level<file_order; level++)
+    {
+        int n = level+1;
+        int num_nodes = view.get_num_nodes(level);
+        const CountType* counts = view.get_counts(level);
+
+        ngram.resize(n);
+        for (int i=0; i<num_nodes; i++)
+        {
+            // Control words start out with a count of 1 in every
+            // model, keep that initial count only once.
+            int count = counts[i];
+            if (level == 0 && i < NUM_CONTROL_WORDS)
+                count--;
+            if (count <= 0)
+                continue;
+
+            uint32_t index = i;
+            for (int l=level; l>=0; l--)
+            {
+                WordId wid = view.get_wids(l)[index];
+                WordId& mapped = wid_map[wid];
+                if (mapped == WIDNONE)
+                {
+                    const wchar_t* word = conv.mb2wc(view.words[wid]);
+                    if (!word)
+                        return ERR_MD2WC;
+                    mapped = dictionary.word_to_id(word);
+                    if (mapped == WIDNONE)
+                        mapped = dictionary.add_word(word);
+                    if (mapped == WIDNONE)
+                        return ERR_MEMORY;
+                }
+                ngram[l] = mapped;
+                if (l)
+                    index = parents[l][index];
+            }
+
+            if (!count_ngram(&ngram[0], n, count))
+                return ERR_MEMORY;
+        }
+    }
+
+    return ERR_NONE;
+}
+
+// Save in binary format, see lm_binary.h.
+LMError DynamicModelBase::save_binary(const char* filename)
+{
+    BinaryModelTables tables;
+    get_binary_tables(tables);
+    return write_binary_model(filename, order, tables.words.size(), tables);
+}
+
+// Order of word ids in a binary model: control words first,
+// then all other words sorted like Dictionary::set_words() does.
+class cmp_binary_words
+{
+    public:
+        cmp_binary_words(const vector<const char*>& _words) :
+            words(_words)
+        {}
+
+        bool operator() (WordId w1, WordId w2)
+        {
+            if (w1 < NUM_CONTROL_WORDS || w2 < NUM_CONTROL_WORDS)
+                return w1 < w2;
+            return strcmp(words[w1], words[w2]) < 0;
+        }
+
+        const vector<const char*>& words;
+};
+
+// Compare n-grams of the same length stored consecutively in "ngrams".
+class cmp_binary_ngrams
+{
+    public:
+        cmp_binary_ngrams(const vector<WordId>& _ngrams, int _n) :
+            ngrams(_ngrams), n(_n)
+        {}
+
+        bool operator() (uint32_t i1, uint32_t i2)
+        {
+            const WordId* ng1 = &ngrams[i1*n];
+            const WordId* ng2 = &ngrams[i2*n];
+            return lexicographical_compare(ng1, ng1+n, ng2, ng2+n);
+        }
+
+        const vector<WordId>& ngrams;
+        int n;
+};
+
+// Collect level-wise tables of all n-grams.
+// Parents of n-grams have to be present, even if they were
+// removed (count 0), so their paths are added back with count 0.
+void DynamicModelBase::get_binary_tables(BinaryModelTables& tables)
+{
+    int i;
+    int num_words = dictionary.get_num_word_types();
+
+    // map word ids to their new, sorted positions
+    vector<const char*> old_words(num_words);
+    for (i=0; i<num_words; i++)
+        old_words[i] = dictionary.id_to_word_utf8(i);
+
+    vector<WordId> sorted_wids(num_words);
+    for (i=0; i<num_words; i++)
+        sorted_wids[i] = i;
+    stable_sort(sorted_wids.begin(), sorted_wids.end(),
+                cmp_binary_words(old_words));
+
+    vector<WordId> wid_map(num_words);
+    tables.words.resize(num_words);
+    for (i=0; i<num_words; i++)
+    {
+        wid_map[sorted_wids[i]] = i;
+        tables.words[i] = old_words[sorted_wids[i]];
+    }
+
+    // gather all n-grams with their new word ids, level by level
+    vector< vector<WordId> > ngrams(order);
+    vector< vector<CountType> > counts(order);
+    vector< vector<uint32_t> > times(order);
+    bool has_times = false;
+
+    std::vector<WordId> wids;
+    DynamicModelBase::ngrams_iter* it;
+    for (it = ngrams_begin(); ; (*it)++)
+    {
+        BaseNode* node = *(*it);
+        if (!node)
+            break;
+
+        it->get_ngram(wids);
+        int level = wids.size()-1;
+        for (i=0; i<(int)wids.size(); i++)
+            ngrams[level].push_back(wid_map[wids[i]]);
+        counts[level].push_back(node->get_count());
+
+        uint32_t time = get_node_time(node);
+        times[level].push_back(time);
+        if (time)
+            has_times = true;
+    }
+    delete it;
+
+    // unigrams: exactly one per word
+    vector<CountType> unigram_counts(num_words, 0);
+    vector<uint32_t> unigram_times(num_words, 0);
+    for (i=0; i<(int)counts[0].size(); i++)
+    {
+        unigram_counts[ngrams[0][i]] = counts[0][i];
+        unigram_times[ngrams[0][i]] = times[0][i];
+    }
+
+    tables.flags = BINARY_MODEL_SORTED_VOCABULARY;
+    if (has_times)
+        tables.flags |= BINARY_MODEL_HAS_TIMES;
+    tables.levels.resize(order);
+
+    BinaryModelTables::Level& unigrams = tables.levels[0];
+    unigrams.wids.resize(num_words);
+    for (i=0; i<num_words; i++)
+        unigrams.wids[i] = i;
+    unigrams.counts.swap(unigram_counts);
+    if (has_times)
+        unigrams.times.swap(unigram_times);
+
+    // Higher levels, from the top down, so that missing parents
+    // of removed n-grams can be added to the level below.
+    vector< vector<uint32_t> > sorted(order);
+    for (int level=order-1; level>=1; level--)
+    {
+        int n = level+1;
+        int num_ngrams = counts[level].size();
+
+        vector<uint32_t>& indices = sorted[level];
+        indices.resize(num_ngrams);
+        for (i=0; i<num_ngrams; i++)
+            indices[i] = i;
+        sort(indices.begin(), indices.end(), cmp_binary_ngrams(ngrams[level], n));
+
+        // add parents that are missing one level down
+        if (level >= 2)
+        {
+            vector<WordId>& lower = ngrams[level-1];
+            vector<uint32_t> lower_indices(counts[level-1].size());
+            for (i=0; i<(int)lower_indices.size(); i++)
+                lower_indices[i] = i;
+            sort(lower_indices.begin(), lower_indices.end(),
+                 cmp_binary_ngrams(lower, level));
+
+            const WordId* prev = NULL;
+            for (i=0; i<num_ngrams; i++)
+            {
+                const WordId* prefix = &ngrams[level][indices[i]*n];
+                if (prev && equal(prefix, prefix+level, prev))
+                    continue;
+                prev = prefix;
+
+                // binary search for the parent
+                int lo = 0;
+                int hi = lower_indices.size();
+                while (lo < hi)
+                {
+                    int mid = (lo+hi)>>1;
+                    const WordId* p = &lower[lower_indices[mid]*level];
+                    if (lexicographical_compare(p, p+level, prefix, prefix+level))
+                        lo = mid+1;
+                    else
+                        hi = mid;
+                }
+                const WordId* p = lo < (int)lower_indices.size() ?
+                                  &lower[lower_indices[lo]*level] : NULL;
+                if (!p || !equal(prefix, prefix+level, p))
+                {
+                    lower.insert(lower.end(), prefix, prefix+level);
+                    counts[level-1].push_back(0);
+                    times[level-1].push_back(0);
+                }
+            }
+        }
+    }
+
+    // Fill the tables in breadth first order. All levels are sorted
+    // lexicographically, so the children of each node are contiguous.
+    for (int level=1; level<order; level++)
+    {
+        int n = level+1;
+        const vector<uint32_t>& indices = sorted[level];
+        int num_ngrams = indices.size();
+
+        BinaryModelTables::Level& l = tables.levels[level];
+        l.wids.resize(num_ngrams);
+        l.counts.resize(num_ngrams);
+        if (has_times)
+            l.times.resize(num_ngrams);
+        for (i=0; i<num_ngrams; i++)
+        {
+            uint32_t index = indices[i];
+            l.wids[i] = ngrams[level][index*n + level];
+            l.counts[i] = counts[level][index];
+            if (has_times)
+                l.times[i] = times[level][index];
+        }
+
+        // link parents to their children
+        BinaryModelTables::Level& parent_level = tables.levels[level-1];
+        int num_parents = parent_level.wids.size();
+        parent_level.child_begin.resize(num_parents+1);
+        int j = 0;
+        for (int p=0; p<num_parents; p++)
+        {
+            const WordId* parent = level == 1 ? &parent_level.wids[p] :
+                               &ngrams[level-1][sorted[level-1][p]*level];
+            parent_level.child_begin[p] = j;
+            while (j < num_ngrams &&
+                   equal(parent, parent+level,
+                         &ngrams[level][indices[j]*n]))
+                j++;
+        }
+        parent_level.child_begin[num_parents] = j;
+    }
+}
@@ -26,6 +26,7 @@
 #include <string>
 
 #include "lm.h"
+#include "lm_binary.h"
 
 #define HONOR_REMOVED_NODES true
 
@@ -689,6 +690,30 @@ enum Smoothing
     KNESER_NEY_I,        // kneser-ney interpolated
 };
 
+//------------------------------------------------------------------------
+// ModelSnapshot - frozen copy of all n-grams of a dynamic model
+//------------------------------------------------------------------------
+// Taking a snapshot is much quicker than writing the model file. The
+// snapshot shares no data with its model, it can be saved by another
+// thread while the model keeps learning.
+class ModelSnapshot
+{
+    public:
+        // Write the file DynamicModelBase::save_arpac() would have
+        // written and flush it to disk.
+        LMError save(const char* filename);
+
+    public:
+        int order;
+        bool with_times;                // n-grams have recency times
+        std::vector<int> num_ngrams;    // per level
+        std::vector<char> words;        // zero-terminated UTF-8 words
+        std::vector<uint32_t> word_offsets;  // per word id
+        std::vector< std::vector<WordId> > ngrams;   // per level
+        std::vector< std::vector<int32_t> > values;  // per level, count
+                                                     // and time per n-gram
+};
+
 //------------------------------------------------------------------------
 // DynamicModelBase - non-template abstract base class of all DynamicModels
 //------------------------------------------------------------------------
@@ -711,6 +736,7 @@ class DynamicModelBase : public NGramModel
         virtual void clear()
         {
             LanguageModel::clear();
+            mapped_file.close();  // after the dictionary let go of it
             assure_valid_control_words();
         }
 
@@ -742,11 +768,42 @@ class DynamicModelBase : public NGramModel
         virtual BaseNode* count_ngram(const WordId* wids,
                                       int n, int increment) = 0;
 
+        // Count all n-grams of a stream of tokens.
+        virtual LMError learn_tokens(const std::vector<wchar_t*>& tokens,
+                                     bool allow_new_words=true);
+
+        // Model-wide maintenance, all by direct traversal of the trie.
+        typedef std::pair<std::vector<WordId>, int> NGramCount;
+        virtual void get_counts(std::vector<int>& counts,
+                                std::vector<int>& totals);
+        virtual void get_remove_context_changes(
+                                      const std::vector<WordId>& context,
+                                      std::vector<NGramCount>& changes);
+        virtual LMError remove_context(const std::vector<WordId>& context,
+                                       std::vector<NGramCount>& changes);
+        virtual LMError copy_to(DynamicModelBase* model);
+        virtual void take_snapshot(ModelSnapshot& snapshot);
+        virtual LMError prune_to(DynamicModelBase* model,
+                                 const std::vector<int>& prune_counts);
+
         virtual LMError load(const char* filename)
-        {return load_arpac(filename);}
+        {
+            if (is_binary_model(filename))
+                return load_binary(filename);
+            return load_arpac(filename);
+        }
         virtual LMError save(const char* filename)
         {return save_arpac(filename);}
 
+        // Save in the memory mappable binary format of lm_binary.h.
+        virtual LMError save_binary(const char* filename);
+
+        // Add the counts of all n-grams of a binary model file.
+        virtual LMError merge_binary(const char* filename);
+
+        // Level-wise tables of all n-grams, as stored by save_binary().
+        virtual void get_binary_tables(BinaryModelTables& tables);
+
         // Debug output, dump all n-grams.
         virtual void dump()
         {
@@ -783,6 +840,11 @@ class DynamicModelBase : public NGramModel
         } Unigram;
         virtual LMError set_unigrams(const std::vector<Unigram>& unigrams);
 
+        LMError learn_section(const std::vector<WordId>& wids,
+                              int begin, int end);
+        LMError copy_ngrams(DynamicModelBase* model,
+                            const std::vector<int>* prune_counts);
+
         virtual LMError write_arpa_ngram(FILE* f,
                                        const BaseNode* node,
                                        const std::vector<WordId>& wids)
@@ -801,15 +863,23 @@ class DynamicModelBase : public NGramModel
 
         virtual LMError load_arpac(const char* filename);
         virtual LMError save_arpac(const char* filename);
+        virtual LMError load_binary(const char* filename);
 
         virtual void set_node_time(BaseNode* node, uint32_t time)
         {}
+        virtual uint32_t get_node_time(BaseNode* node)
+        {return 0;}
+        virtual bool has_node_times()
+        {return false;}
         virtual int get_num_ngrams(int level) = 0;
         virtual void reserve_unigrams(int count) = 0;
 
         // Number of distinct words excluding removed ones with count=0.
         virtual int get_num_word_types() {return get_num_ngrams(0);}
 
+    protected:
+        // Binary model the dictionary words point into.
+        MappedFile mapped_file;
 };
 
 
@@ -871,7 +941,7 @@ class _DynamicModel : public DynamicModelBase
         virtual void clear();
         virtual void set_order(int order);
         virtual Smoothing get_smoothing() {return smoothing;}
-        virtual void set_smoothing(Smoothing s) {smoothing = s;}
+        virtual void set_smoothing(Smoothing s) {set_parameter(smoothing, s);}
 
         virtual std::vector<Smoothing> get_smoothings()
         {
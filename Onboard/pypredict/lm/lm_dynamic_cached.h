@@ -71,6 +71,31 @@ class RecencyNode : public BaseNode
         uint32_t time;   // time of last use
 };
 
+//------------------------------------------------------------------------
+// RecencyHistoryNode - RecencyNode with children, all but the leaf nodes
+//------------------------------------------------------------------------
+// Keeps the sum of the recency weights of all children as of
+// recency_sum_time. The sum can be brought to any later time by
+// decaying it as a whole, so it doesn't have to be recalculated
+// for each query.
+class RecencyHistoryNode : public RecencyNode
+{
+    public:
+        RecencyHistoryNode(WordId wid = -1)
+        : RecencyNode(wid)
+        {
+            recency_sum = 0;
+            recency_sum_time = 0;
+            recency_sum_children = 0;
+        }
+
+    public:
+        double recency_sum;            // sum of child recency weights
+        uint32_t recency_sum_time;     // time recency_sum was valid for
+        int recency_sum_children;      // number of children in recency_sum,
+                                       // later ones were added with time 0
+};
+
 template <class TNODE>
 double sum_child_recency_weights(TNODE* node, uint32_t current_time,
                                  double halflife)
@@ -104,12 +129,21 @@ class NGramTrieRecency : public NGramTrieKN<TNODE, TBEFORELASTNODE, TLASTNODE>
         void clear()
         {
             current_time = 0;
+            recency_sums_valid = false;
             Base::clear();
         }
 
         void set_current_time(int t)
         {
             current_time = t;
+            recency_sums_valid = false;
+        }
+
+        // Node times were changed directly, recalculate the
+        // sums of child recency weights on next use.
+        void invalidate_recency_sums()
+        {
+            recency_sums_valid = false;
         }
 
         int increment_node_count(BaseNode* node, const WordId* wids, int n,
@@ -129,6 +163,24 @@ class NGramTrieRecency : public NGramTrieKN<TNODE, TBEFORELASTNODE, TLASTNODE>
                static_cast<TNODE*>(node), current_time, halflife);
         }
 
+        // Sum of the recency weights of all children of node at
+        // current_time, from the incrementally maintained sums.
+        double get_child_recency_sum(BaseNode* node, int level)
+        {
+            RecencyHistoryNode* nd = static_cast<RecencyHistoryNode*>(node);
+            double halflife = recency_sums_halflife;
+            double t = current_time - nd->recency_sum_time;
+            double sum = nd->recency_sum * pow(2, -t/halflife);
+
+            // children added since then, still with time 0
+            int num_new = this->get_num_children(node, level) -
+                          nd->recency_sum_children;
+            if (num_new)
+                sum += num_new * pow(2, -double(current_time)/halflife);
+
+            return sum;
+        }
+
         void get_probs_recency_jelinek_mercer_i(const std::vector<WordId>& history,
                                     const std::vector<WordId>& words,
                                     std::vector<double>& vp,
@@ -136,8 +188,15 @@ class NGramTrieRecency : public NGramTrieKN<TNODE, TBEFORELASTNODE, TLASTNODE>
                                     uint32_t recency_halflife,
                                     std::vector<double>& lamdas);
 
+    protected:
+        void update_recency_sums(uint32_t halflife);
+        void update_recency_sums(BaseNode* node, int level);
+
     protected:
         uint32_t current_time;      // time is an ever increasing integer
+
+        bool recency_sums_valid;
+        uint32_t recency_sums_halflife;  // halflife of the recency sums
 };
 
 // Add increment to node->count and track time of last use
@@ -147,11 +206,60 @@ int NGramTrieRecency<TNODE, TBEFORELASTNODE, TLASTNODE>::
                          int increment)
 {
     this->current_time++;        // time is an ever increasing integer
-    static_cast<RecencyNode*>(node)->time = this->current_time;
+    RecencyNode* nd = static_cast<RecencyNode*>(node);
+
+    // In the parent's sum, replace the old weight of
+    // the node with 1.0, the weight at time of use.
+    if (recency_sums_valid)
+    {
+        std::vector<WordId> h(wids, wids+n-1);
+        BaseNode* parent = this->get_node(h);
+        RecencyHistoryNode* p = static_cast<RecencyHistoryNode*>(parent);
+        double old_weight = nd->get_recency_weight(current_time,
+                                                   recency_sums_halflife);
+        double sum = get_child_recency_sum(parent, n-1) - old_weight + 1.0;
+        p->recency_sum = std::max(sum, 0.0);  // don't let rounding errors
+                                              // go negative
+        p->recency_sum_time = current_time;
+        p->recency_sum_children = this->get_num_children(parent, n-1);
+    }
+
+    nd->time = this->current_time;
 
     return Base::increment_node_count(node, wids, n, increment);
 }
 
+// Recalculate the sums of child recency weights of all nodes,
+// if they aren't valid for the given halflife.
+template <class TNODE, class TBEFORELASTNODE, class TLASTNODE>
+void NGramTrieRecency<TNODE, TBEFORELASTNODE, TLASTNODE>::
+    update_recency_sums(uint32_t halflife)
+{
+    if (!recency_sums_valid || recency_sums_halflife != halflife)
+    {
+        recency_sums_halflife = halflife;
+        update_recency_sums(this, 0);
+        recency_sums_valid = true;
+    }
+}
+
+template <class TNODE, class TBEFORELASTNODE, class TLASTNODE>
+void NGramTrieRecency<TNODE, TBEFORELASTNODE, TLASTNODE>::
+    update_recency_sums(BaseNode* node, int level)
+{
+    if (level >= this->order)
+        return;
+
+    RecencyHistoryNode* nd = static_cast<RecencyHistoryNode*>(node);
+    nd->recency_sum = sum_child_recency_weights(node, level, current_time,
+                                                recency_sums_halflife);
+    nd->recency_sum_time = current_time;
+    nd->recency_sum_children = this->get_num_children(node, level);
+
+    for (int i=0; i<nd->recency_sum_children; i++)
+        update_recency_sums(this->get_child_at(node, level, i), level+1);
+}
+
 // Get probabilities based on time of last use.
 // jelinek_mercer, smoothed
 template <class TNODE, class TBEFORELASTNODE, class TLASTNODE>
@@ -168,6 +276,8 @@ void NGramTrieRecency<TNODE, TBEFORELASTNODE, TLASTNODE>::
     int size = words.size();        // number of candidate words
     std::vector<double> vt(size);   // vector of times, reused for order 1..n
 
+    update_recency_sums(recency_halflife);
+
     // order 0
     vp.resize(size);
     fill(vp.begin(), vp.end(), 1.0/num_word_types); // uniform distribution
@@ -183,22 +293,37 @@ void NGramTrieRecency<TNODE, TBEFORELASTNODE, TLASTNODE>::
             if (!N1prx)  // break early, don't reset probabilities to 0
                 break;   // for unknown histories
 
-            // total number of occurences of the history
-            double cs = sum_child_recency_weights(hnode, j, current_time,
-                                                    recency_halflife);
+            // total recency weight of the history
+            double cs = get_child_recency_sum(hnode, j);
             if (cs)
             {
                 // get ngram times
                 fill(vt.begin(), vt.end(), 0);
                 int num_children = this->get_num_children(hnode, j);
-                for(i=0; i<num_children; i++)
+                if (num_children > size)
                 {
-                    RecencyNode* child = static_cast<RecencyNode*>
-                                              (this->get_child_at(hnode, j, i));
-                    int index = binsearch(words, child->word_id); // word_indices have to be sorted by index
-                    if (index >= 0)
-                        vt[index] = child->get_recency_weight(current_time,
+                    // fewer candidates than children, look them up
+                    for(i=0; i<size; i++)
+                    {
+                        int index;
+                        RecencyNode* child = static_cast<RecencyNode*>
+                                     (this->get_child(hnode, j, words[i], index));
+                        if (child)
+                            vt[i] = child->get_recency_weight(current_time,
                                                               recency_halflife);
+                    }
+                }
+                else
+                {
+                    for(i=0; i<num_children; i++)
+                    {
+                        RecencyNode* child = static_cast<RecencyNode*>
+                                                  (this->get_child_at(hnode, j, i));
+                        int index = binsearch(words, child->word_id); // word_indices have to be sorted by index
+                        if (index >= 0)
+                            vt[index] = child->get_recency_weight(current_time,
+                                                                  recency_halflife);
+                    }
                 }
 
                 double lambda = lamdas[j]; // normalization factor
@@ -249,15 +374,27 @@ class _CachedDynamicModel : public _DynamicModelKN<TNGRAMS>
         virtual void set_node_time(BaseNode* node, uint32_t time)
         {
             static_cast<RecencyNode*>(node)->set_time(time);
+            this->ngrams.invalidate_recency_sums();
+        }
+        virtual uint32_t get_node_time(BaseNode* node)
+        {
+            return static_cast<RecencyNode*>(node)->get_time();
+        }
+        virtual bool has_node_times()
+        {
+            return true;
         }
 
-        void set_recency_halflife(double hl) {recency_halflife = hl;}
+        void set_recency_halflife(double hl)
+        {this->set_parameter(recency_halflife, (uint32_t)hl);}
         uint32_t get_recency_halflife() {return recency_halflife;}
 
-        void set_recency_ratio(double ratio) {recency_ratio = ratio;}
+        void set_recency_ratio(double ratio)
+        {this->set_parameter(recency_ratio, ratio);}
         double get_recency_ratio() {return recency_ratio;}
 
-        void set_recency_smoothing(Smoothing sm) {recency_smoothing = sm;}
+        void set_recency_smoothing(Smoothing sm)
+        {this->set_parameter(recency_smoothing, sm);}
         Smoothing get_recency_smoothing() {return recency_smoothing;}
 
         virtual std::vector<Smoothing> get_recency_smoothings()
@@ -269,8 +406,9 @@ class _CachedDynamicModel : public _DynamicModelKN<TNGRAMS>
 
         void set_recency_lambdas(const std::vector<double>& lambdas)
         {
-            recency_lambdas = lambdas;
-            recency_lambdas.resize(this->order, DEFAULT_LAMBDA);
+            std::vector<double> v = lambdas;
+            v.resize(this->order, DEFAULT_LAMBDA);
+            this->set_parameter(recency_lambdas, v);
         }
         void get_recency_lambdas(std::vector<double>& lambdas)
         {
@@ -294,8 +432,8 @@ class _CachedDynamicModel : public _DynamicModelKN<TNGRAMS>
         std::vector<double> recency_lambdas;  // jelinek_mercer smoothing weights
 };
 
-typedef _CachedDynamicModel<NGramTrieRecency<TrieNode<TrieNodeKNBase<RecencyNode> >,
-                                  BeforeLastNode<BeforeLastNodeKNBase<RecencyNode>,
+typedef _CachedDynamicModel<NGramTrieRecency<TrieNode<TrieNodeKNBase<RecencyHistoryNode> >,
+                                  BeforeLastNode<BeforeLastNodeKNBase<RecencyHistoryNode>,
                                                  LastNode<RecencyNode> >,
                                   LastNode<RecencyNode> > > CachedDynamicModel;
 
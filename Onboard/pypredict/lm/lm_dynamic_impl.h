@@ -277,6 +277,8 @@ BaseNode* _DynamicModel<TNGRAMS>::count_ngram(const WordId* wids, int n,
     if (!node)
         return NULL;
 
+    this->generation++;
+
     // remove old state
     if (node->count == 1)
         n1s[n-1]--;
@@ -0,0 +1,750 @@
+/*
+ * Copyright © 2026 agent <agent@local>
+ *
+ * This file is part of Onboard.
+ *
+ * Onboard is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * Onboard is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include <stdio.h>
+#include <string.h>
+#include <algorithm>
+
+#include "lm_frozen.h"
+
+using namespace std;
+
+
+void FrozenModel::clear()
+{
+    LanguageModel::clear();  // before the dictionary loses its words
+    mapped_file.close();
+    vector<uint8_t>().swap(buffer);
+    view = BinaryModelView();
+    order = 0;
+    num_word_types = 0;
+    total_unigram_count = 0;
+    Ds.clear();
+    probs.clear();
+    backoffs.clear();
+
+    // Control words have fixed positions, like in all other models.
+    const wchar_t* words[NUM_CONTROL_WORDS] =
+                    {L"<unk>", L"<s>", L"</s>", L"<num>"};
+    for (int i=0; i<NUM_CONTROL_WORDS; i++)
+        dictionary.add_word(words[i]);
+}
+
+LMError FrozenModel::load(const char* filename)
+{
+    LMError err;
+
+    clear();
+
+    if (is_binary_model(filename))
+    {
+        MappedFile file;
+        err = file.open(filename);
+        if (!err)
+            err = set_view(file.data, file.size,
+                           file.data, file.data + file.size);
+        if (!err)
+            mapped_file.swap(file);
+    }
+    else
+    {
+        DynamicModel model;
+        err = model.load(filename);
+        if (!err)
+            err = freeze(&model);
+    }
+
+    if (err)
+        clear();
+
+    return err;
+}
+
+// Frozen models are always saved in the binary format.
+LMError FrozenModel::save(const char* filename)
+{
+    if (!view.header)
+        return ERR_NOT_IMPL;
+
+    // The header may point into the mapping of filename itself.
+    return replace_file(filename, view.header, view.header->file_size);
+}
+
+LMError FrozenModel::freeze(DynamicModelBase* model)
+{
+    BinaryModelTables tables;
+    model->get_binary_tables(tables);
+
+    vector<uint8_t> buf;
+    LMError err = build_binary_model(buf, model->get_order(),
+                                     tables.words.size(), tables);
+    if (err)
+        return err;
+
+    clear();
+    vector<uint8_t>(buf.begin(), buf.end()).swap(buffer);  // shrink to fit
+    err = set_view(&buffer[0], buffer.size(),
+                   &buffer[0], &buffer[0] + buffer.size());
+    if (err)
+        clear();
+
+    return err;
+}
+
+LMError FrozenModel::copy_to(DynamicModelBase* model)
+{
+    if (!view.header)
+        return ERR_NONE;
+
+    vector<WordId> ngram;
+    vector<WordId> wid_map(view.header->num_words, WIDNONE);
+    return copy_ngrams(model, NULL, -1, 0, ngram, wid_map);
+}
+
+LMError FrozenModel::prune_to(DynamicModelBase* model,
+                              const vector<int>& prune_counts)
+{
+    if (!view.header || prune_counts.empty())
+        return ERR_NONE;
+
+    vector<WordId> ngram;
+    vector<WordId> wid_map(view.header->num_words, WIDNONE);
+    return copy_ngrams(model, &prune_counts, -1, 0, ngram, wid_map);
+}
+
+// Depth first through the children of a node, ngram holds the
+// word ids of the path to them.
+LMError FrozenModel::copy_ngrams(DynamicModelBase* model,
+                                 const vector<int>* prune_counts,
+                                 int level, int index,
+                                 vector<WordId>& ngram,
+                                 vector<WordId>& wid_map)
+{
+    uint32_t begin, end;
+    get_children(level, index, begin, end);
+    if (begin == end)
+        return ERR_NONE;
+
+    int n = level + 2;
+    const WordId* wids = view.get_wids(n-1);
+    const CountType* counts = view.get_counts(n-1);
+
+    int prune_count = 0;
+    if (prune_counts)
+        prune_count = (*prune_counts)[min((int)prune_counts->size(), n) - 1];
+
+    vector<WordId> dst_wids(n);
+    for (uint32_t i=begin; i<end; i++)
+    {
+        ngram.push_back(wids[i]);
+
+        int count = counts[i];
+        if (count > 0 &&
+            !(prune_counts && (count <= prune_count || prune_count == -1)))
+        {
+            // map word ids to those of the destination model, on demand
+            for (int j=0; j<n; j++)
+            {
+                WordId& wid = wid_map[ngram[j]];
+                if (wid == WIDNONE)
+                {
+                    const wchar_t* word = dictionary.id_to_word(ngram[j]);
+                    if (!word)
+                        return ERR_MD2WC;
+                    wid = model->dictionary.word_to_id(word);
+                    if (wid == WIDNONE)
+                        wid = model->dictionary.add_word(word);
+                    if (wid == WIDNONE)
+                        return ERR_MEMORY;
+                    if (wid == (WordId)-2)   // conversion failed
+                        return ERR_WC2MB;
+                }
+                dst_wids[j] = wid;
+            }
+
+            if (!model->count_ngram(&dst_wids[0], n, count))
+                return ERR_MEMORY;
+        }
+
+        LMError err = copy_ngrams(model, prune_counts, n-1, i,
+                                  ngram, wid_map);
+        if (err)
+            return err;
+
+        ngram.pop_back();
+    }
+
+    return ERR_NONE;
+}
+
+LMError FrozenModel::set_view(const uint8_t* data, size_t size,
+                              const void* begin, const void* end)
+{
+    LMError err = read_binary_model(data, size, view);
+    if (!err)
+        err = check_sorted_vocabulary(view);
+    if (!err)
+        err = check_structure();
+    if (!err)
+        err = dictionary.set_mapped_words(view.words, begin, end);
+    if (err)
+    {
+        view = BinaryModelView();
+        return err;
+    }
+
+    order = view.get_order();
+    update_statistics();
+    update_probabilities();
+
+    return ERR_NONE;
+}
+
+// The arrays are accessed without further checks,
+// make sure they are consistent.
+LMError FrozenModel::check_structure()
+{
+    int i;
+    int num_words = view.header->num_words;
+    int n = view.get_order();
+
+    // control words first, the rest of the words sorted
+    const char* control_words[NUM_CONTROL_WORDS] =
+                                  {"<unk>", "<s>", "</s>", "<num>"};
+    if (num_words < NUM_CONTROL_WORDS)
+        return ERR_BAD_HEADER;
+    for (i=0; i<NUM_CONTROL_WORDS; i++)
+        if (strcmp(view.words[i], control_words[i]))
+            return ERR_BAD_HEADER;
+    for (i=NUM_CONTROL_WORDS+1; i<num_words; i++)
+        if (strcmp(view.words[i-1], view.words[i]) >= 0)
+            return ERR_BAD_HEADER;
+
+    // unigrams, exactly one per word
+    if (view.get_num_nodes(0) != num_words)
+        return ERR_BAD_HEADER;
+    const WordId* wids = view.get_wids(0);
+    for (i=0; i<num_words; i++)
+        if (wids[i] != (WordId)i)
+            return ERR_BAD_HEADER;
+
+    // children of each node sorted by word id
+    for (int level=0; level<n-1; level++)
+    {
+        int num_nodes = view.get_num_nodes(level);
+        const uint32_t* child_begin = view.get_child_begin(level);
+        const WordId* child_wids = view.get_wids(level+1);
+
+        if (child_begin[0] != 0 ||
+            child_begin[num_nodes] != (uint32_t)view.get_num_nodes(level+1))
+            return ERR_BAD_HEADER;
+
+        for (i=0; i<num_nodes; i++)
+        {
+            uint32_t begin = child_begin[i];
+            uint32_t end = child_begin[i+1];
+            if (begin > end)
+                return ERR_BAD_HEADER;
+            for (uint32_t j=begin; j<end; j++)
+                if (child_wids[j] >= (WordId)num_words ||
+                    (j > begin && child_wids[j-1] >= child_wids[j]))
+                    return ERR_BAD_HEADER;
+        }
+    }
+
+    return ERR_NONE;
+}
+
+// Gather model-wide statistics, the counts never change.
+void FrozenModel::update_statistics()
+{
+    int n = view.get_order();
+
+    num_word_types = 0;
+    total_unigram_count = 0;
+    const CountType* counts = view.get_counts(0);
+    for (int i=0; i<view.get_num_nodes(0); i++)
+    {
+        if (counts[i] > 0)
+            num_word_types++;
+        total_unigram_count += counts[i];
+    }
+
+    // discounting parameters for absolute discounting
+    Ds.resize(n);
+    for (int level=0; level<n; level++)
+    {
+        int n1 = 0;
+        int n2 = 0;
+        counts = view.get_counts(level);
+        for (int i=0; i<view.get_num_nodes(level); i++)
+        {
+            if (counts[i] == 1)
+                n1++;
+            if (counts[i] == 2)
+                n2++;
+        }
+
+        double D;
+        if (n1 == 0 || n2 == 0)
+            D = 0.1;          // training corpus too small, take a guess
+        else
+            // deleted estimation, Ney, Essen, and Kneser 1994
+            D = n1 / (n1 + 2.0*n2);
+        Ds[level] = D;
+    }
+}
+
+void FrozenModel::set_smoothing(Smoothing s)
+{
+    Smoothing old_smoothing = smoothing;
+    set_parameter(smoothing, s);
+    if (smoothing != old_smoothing)
+        update_probabilities();
+}
+
+void FrozenModel::set_precompute(bool value)
+{
+    if (precompute != value)
+    {
+        precompute = value;
+        update_probabilities();
+    }
+}
+
+// Precompute interpolated probabilities for all n-grams and the
+// backoff weights of all histories, for the current smoothing.
+// Same results as get_probs_interpolated(), within float precision.
+// Histories without successors get a negative backoff weight, ending
+// the interpolation there, like the early break of
+// get_probs_interpolated().
+void FrozenModel::update_probabilities()
+{
+    // predictions may change, invalidate the prediction cache
+    generation++;
+
+    probs.clear();
+    backoffs.clear();
+    if (!precompute || !view.header ||
+        (smoothing != WITTEN_BELL_I && smoothing != ABS_DISC_I))
+        return;
+
+    int n = view.get_order();
+    probs.resize(n);
+    backoffs.resize(n-1);
+
+    // Parent index of each node, temporary, for rebuilding the
+    // n-grams of histories.
+    vector< vector<uint32_t> > parents(n);
+
+    // unigrams
+    {
+        const CountType* counts = view.get_counts(0);
+        int num_nodes = view.get_num_nodes(0);
+        double p0 = 1.0 / num_word_types;  // uniform distribution
+        int N1prx = num_word_types;
+        int cs = total_unigram_count;
+        vector<float>& p = probs[0];
+        p.resize(num_nodes);
+        for (int i=0; i<num_nodes; i++)
+        {
+            if (!N1prx || !cs)
+                p[i] = p0;
+            else
+            if (smoothing == WITTEN_BELL_I)
+            {
+                double l1 = N1prx / (N1prx + float(cs));
+                p[i] = (1.0 - l1) * (counts[i] / float(cs)) + l1 * p0;
+            }
+            else
+            {
+                double D = Ds[0];
+                double l1 = D / float(cs) * N1prx;
+                double a = std::max(counts[i] - D, 0.0);
+                p[i] = a / float(cs) + l1 * p0;
+            }
+        }
+    }
+
+    // bigrams and up
+    vector<WordId> history;
+    for (int level=1; level<n; level++)
+    {
+        int num_parents = view.get_num_nodes(level-1);
+        const WordId* wids = view.get_wids(level);
+        const CountType* counts = view.get_counts(level);
+        vector<float>& p = probs[level];
+        vector<float>& bow = backoffs[level-1];
+        p.resize(view.get_num_nodes(level));
+        bow.resize(num_parents);
+        parents[level].resize(view.get_num_nodes(level));
+        history.resize(level);
+
+        for (int parent=0; parent<num_parents; parent++)
+        {
+            uint32_t begin, end;
+            get_children(level-1, parent, begin, end);
+
+            // rebuild the history n-gram of the children
+            uint32_t index = parent;
+            for (int k=level-1; k>=0; k--)
+            {
+                history[k] = view.get_wids(k)[index];
+                if (k)
+                    index = parents[k][index];
+            }
+
+            int N1prx = 0;
+            int cs = 0;
+            for (uint32_t i=begin; i<end; i++)
+            {
+                parents[level][i] = parent;
+                if (counts[i] > 0)
+                    N1prx++;
+                cs += counts[i];
+            }
+
+            double l1 = 1.0;
+            if (N1prx)
+            {
+                if (smoothing == WITTEN_BELL_I)
+                    l1 = N1prx / (N1prx + float(cs));
+                else
+                    l1 = Ds[level] / float(cs) * N1prx;
+            }
+            bow[parent] = N1prx ? l1 : -1.0;
+
+            for (uint32_t i=begin; i<end; i++)
+            {
+                // probability of the lower order n-gram
+                double plower = get_prob_precomputed(&history[0] + 1, level-1,
+                                                     wids[i]);
+                if (!N1prx)
+                    p[i] = plower;
+                else
+                if (smoothing == WITTEN_BELL_I)
+                    p[i] = (1.0 - l1) * (counts[i] / float(cs)) +
+                           l1 * plower;
+                else
+                {
+                    double a = std::max(counts[i] - Ds[level], 0.0);
+                    p[i] = a / float(cs) + l1 * plower;
+                }
+            }
+        }
+    }
+}
+
+int FrozenModel::find_node(const WordId* wids, int n)
+{
+    if (n < 1 || n > view.get_order() ||
+        wids[0] >= (WordId)view.get_num_nodes(0))
+        return -1;
+
+    int index = wids[0];
+    for (int level=1; level<n; level++)
+    {
+        uint32_t begin, end;
+        get_children(level-1, index, begin, end);
+
+        const WordId* level_wids = view.get_wids(level);
+        const WordId* it = lower_bound(level_wids + begin,
+                                       level_wids + end, wids[level]);
+        if (it == level_wids + end || *it != wids[level])
+            return -1;
+        index = it - level_wids;
+    }
+    return index;
+}
+
+int FrozenModel::get_ngram_count(const wchar_t* const* ngram, int n)
+{
+    if (!view.header)
+        return 0;
+
+    vector<WordId> wids(n);
+    for (int i=0; i<n; i++)
+    {
+        wids[i] = dictionary.word_to_id(ngram[i]);
+        if (wids[i] == WIDNONE)
+            return 0;
+    }
+
+    int index = find_node(&wids[0], n);
+    if (index < 0)
+        return 0;
+    return view.get_counts(n-1)[index];
+}
+
+// Words following the last word of the history, excluding
+// removed n-grams with count 0.
+void FrozenModel::get_words_with_predictions(
+                                       const std::vector<WordId>& history,
+                                       std::vector<WordId>& wids)
+{
+    if (history.empty())
+        return;
+
+    int index = find_node(&history.back(), 1);
+    if (index < 0)
+        return;
+
+    uint32_t begin, end;
+    get_children(0, index, begin, end);
+    if (begin == end)
+        return;
+
+    const WordId* child_wids = view.get_wids(1);
+    const CountType* child_counts = view.get_counts(1);
+    for (uint32_t i=begin; i<end; i++)
+        if (child_counts[i])
+            wids.push_back(child_wids[i]);
+}
+
+// filter out removed unigrams
+void FrozenModel::filter_candidates(const std::vector<WordId>& in,
+                                          std::vector<WordId>& out)
+{
+    const CountType* counts = view.get_counts(0);
+    int num_candidates = in.size();
+    out.reserve(num_candidates);
+    for (int i=0; i<num_candidates; i++)
+    {
+        WordId wid = in[i];
+        if (counts[wid])
+            out.push_back(wid);
+    }
+}
+
+// Calculate a vector of probabilities for the ngrams formed
+// by history + word[i], for all i.
+// Same results as the trie based _DynamicModel::get_probs().
+void FrozenModel::get_probs(const std::vector<WordId>& history,
+                            const std::vector<WordId>& words,
+                            std::vector<double>& probabilities)
+{
+    // pad/cut history so it's always of length order-1
+    int n = std::min((int)history.size(), order-1);
+    std::vector<WordId> h(order-1, UNKNOWN_WORD_ID);
+    copy_backward(history.end()-n, history.end(), h.end());
+
+    switch(smoothing)
+    {
+        case WITTEN_BELL_I:
+        case ABS_DISC_I:
+            if (!probs.empty())
+                get_probs_precomputed(h, words, probabilities);
+            else
+                get_probs_interpolated(h, words, probabilities);
+            break;
+
+         default:
+            break;
+    }
+}
+
+void FrozenModel::get_probs_interpolated(const std::vector<WordId>& history,
+                                         const std::vector<WordId>& words,
+                                         std::vector<double>& vp)
+{
+    int i,j;
+    int n = history.size() + 1;
+    int size = words.size();   // number of candidate words
+    std::vector<int32_t> vc(size);  // vector of counts, reused for order 1..n
+
+    // order 0
+    vp.resize(size);
+    fill(vp.begin(), vp.end(), 1.0/num_word_types); // uniform distribution
+
+    // order 1..n
+    for(j=0; j<n; j++)
+    {
+        // node of the history of length j, the root for j==0
+        int index = 0;
+        if (j)
+        {
+            index = find_node(&history[n-j-1], j);
+            if (index < 0)
+                continue;
+        }
+
+        uint32_t begin, end;
+        get_children(j-1, index, begin, end);
+        const WordId* child_wids = view.get_wids(j);
+        const CountType* child_counts = view.get_counts(j);
+
+        // number of word types following the history and
+        // total number of occurences of the history
+        int N1prx = 0;
+        int cs = 0;
+        if (j == 0)
+        {
+            N1prx = num_word_types;
+            cs = total_unigram_count;
+        }
+        else
+        {
+            for (uint32_t k=begin; k<end; k++)
+            {
+                if (child_counts[k] > 0)
+                    N1prx++;
+                cs += child_counts[k];
+            }
+        }
+
+        if (!N1prx)  // break early, don't reset probabilities to 0
+            break;   // for unknown histories
+
+        if (cs)
+        {
+            // get ngram counts
+            fill(vc.begin(), vc.end(), 0);
+            if (j == 0)
+            {
+                // unigrams are indexed by word id
+                for(i=0; i<size; i++)
+                    vc[i] = child_counts[words[i]];
+            }
+            else
+            {
+                for (uint32_t k=begin; k<end; k++)
+                {
+                    int index = binsearch(words, child_wids[k]);
+                    if (index >= 0)
+                        vc[index] = child_counts[k];
+                }
+            }
+
+            if (smoothing == WITTEN_BELL_I)
+            {
+                double l1 = N1prx / (N1prx + float(cs)); // normalization factor
+                                                         // 1 - lambda
+                for(i=0; i<size; i++)
+                {
+                    double pmle = vc[i] / float(cs);
+                    vp[i] = (1.0 - l1) * pmle + l1 * vp[i];
+                }
+            }
+            else
+            {
+                double D = Ds[j];
+                double l1 = D / float(cs) * N1prx; // normalization factor
+                                                   // 1 - lambda
+                for(i=0; i<size; i++)
+                {
+                    double a = vc[i] - D;
+                    if (a < 0)
+                        a = 0;
+                    vp[i] = a / float(cs) + l1 * vp[i];
+                }
+            }
+        }
+    }
+}
+
+// Probability of a single word, backing off from the longest
+// history that has been seen.
+double FrozenModel::get_prob_precomputed(const WordId* history, int n,
+                                         WordId wid)
+{
+    double p = probs[0][wid];
+    for (int j=1; j<=n; j++)
+    {
+        int index = find_node(history+n-j, j);
+        if (index < 0)
+            continue;
+
+        double bow = backoffs[j-1][index];
+        if (bow < 0)  // no successors, break early
+            break;
+
+        uint32_t begin, end;
+        get_children(j-1, index, begin, end);
+        const WordId* child_wids = view.get_wids(j);
+        const WordId* it = lower_bound(child_wids + begin,
+                                       child_wids + end, wid);
+        if (it != child_wids + end && *it == wid)
+            p = probs[j][it - child_wids];
+        else
+            p *= bow;
+    }
+    return p;
+}
+
+// Same as get_probs_interpolated(), but looks up the probabilities
+// of the longest known n-grams and scales them by the backoff weights
+// of the longer histories.
+void FrozenModel::get_probs_precomputed(const std::vector<WordId>& history,
+                                        const std::vector<WordId>& words,
+                                        std::vector<double>& vp)
+{
+    int i;
+    int n = history.size() + 1;
+    int size = words.size();   // number of candidate words
+
+    // unigrams, all words have one
+    const float* p = &probs[0][0];
+    vp.resize(size);
+    for(i=0; i<size; i++)
+        vp[i] = p[words[i]];
+
+    // bigrams and up
+    for (int j=1; j<n; j++)
+    {
+        int index = find_node(&history[n-j-1], j);
+        if (index < 0)
+            continue;
+
+        double bow = backoffs[j-1][index];
+        if (bow < 0)  // no successors, break early
+            break;    // like get_probs_interpolated()
+
+        uint32_t begin, end;
+        get_children(j-1, index, begin, end);
+        for(i=0; i<size; i++)
+            vp[i] *= bow;
+
+        // Overwrite with the probabilities of known n-grams,
+        // searching in whichever of both sorted ranges is larger.
+        const WordId* child_wids = view.get_wids(j);
+        p = &probs[j][0];
+        if (end - begin > (uint32_t)size)
+        {
+            const WordId* first = child_wids + begin;
+            const WordId* last = child_wids + end;
+            for(i=0; i<size; i++)
+            {
+                first = lower_bound(first, last, words[i]);
+                if (first == last)
+                    break;
+                if (*first == words[i])
+                    vp[i] = p[first - child_wids];
+            }
+        }
+        else
+        {
+            for (uint32_t k=begin; k<end; k++)
+            {
+                int index = binsearch(words, child_wids[k]);
+                if (index >= 0)
+                    vp[index] = p[k];
+            }
+        }
+    }
+}
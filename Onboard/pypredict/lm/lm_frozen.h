@@ -0,0 +1,183 @@
+/*
+ * Copyright © 2026 agent <agent@local>
+ *
+ * This file is part of Onboard.
+ *
+ * Onboard is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * Onboard is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#ifndef LM_FROZEN_H
+#define LM_FROZEN_H
+
+#include <vector>
+
+#include "lm_dynamic.h"
+#include "lm_binary.h"
+
+//------------------------------------------------------------------------
+// FrozenModel - compact, read-only n-gram model for system models
+//------------------------------------------------------------------------
+// N-grams are kept in the level-wise sorted arrays of lm_binary.h.
+// The children of a node are a contiguous range of the next level,
+// found by offset instead of by pointer. The arrays are either
+// memory mapped from a binary model file or built once from a
+// dynamic model.
+class FrozenModel : public NGramModel
+{
+    public:
+        static const Smoothing DEFAULT_SMOOTHING = ABS_DISC_I;
+
+    public:
+        FrozenModel()
+        {
+            smoothing = DEFAULT_SMOOTHING;
+            precompute = false;
+            clear();
+        }
+
+        virtual ~FrozenModel()
+        {
+            clear();
+        }
+
+        virtual void clear();
+
+        virtual LMError load(const char* filename);
+        virtual LMError save(const char* filename);
+
+        // Build the arrays from the n-grams of a dynamic model.
+        LMError freeze(DynamicModelBase* model);
+
+        // Count all n-grams in model, like DynamicModelBase::copy_to()
+        // and prune_to(). Removed n-grams with count 0 are skipped.
+        LMError copy_to(DynamicModelBase* model);
+        LMError prune_to(DynamicModelBase* model,
+                         const std::vector<int>& prune_counts);
+
+        virtual Smoothing get_smoothing() {return smoothing;}
+        virtual void set_smoothing(Smoothing s);
+        virtual std::vector<Smoothing> get_smoothings()
+        {
+            std::vector<Smoothing> smoothings;
+            smoothings.push_back(WITTEN_BELL_I);
+            smoothings.push_back(ABS_DISC_I);
+            return smoothings;
+        }
+
+        // Store smoothed probabilities and backoff weights per node,
+        // turns scoring of candidates into table lookups.
+        bool get_precompute() {return precompute;}
+        void set_precompute(bool value);
+
+        virtual bool is_model_valid()
+        {
+            return view.header != NULL;
+        }
+
+        // Number of distinct words excluding removed ones with count=0.
+        virtual int get_num_word_types() {return num_word_types;}
+
+        int get_ngram_count(const wchar_t* const* ngram, int n);
+
+        virtual void get_memory_sizes(std::vector<long>& values)
+        {
+            values.push_back(dictionary.get_memory_size());
+            values.push_back(buffer.capacity());
+            values.push_back(mapped_file.size);
+
+            long size = 0;
+            for (int i=0; i<(int)probs.size(); i++)
+                size += probs[i].capacity() * sizeof(float);
+            for (int i=0; i<(int)backoffs.size(); i++)
+                size += backoffs[i].capacity() * sizeof(float);
+            values.push_back(size);
+        }
+
+    protected:
+        virtual void get_words_with_predictions(
+                                       const std::vector<WordId>& history,
+                                       std::vector<WordId>& wids);
+        virtual void filter_candidates(const std::vector<WordId>& in,
+                                             std::vector<WordId>& out);
+        virtual void get_probs(const std::vector<WordId>& history,
+                               const std::vector<WordId>& words,
+                               std::vector<double>& probabilities);
+
+    private:
+        LMError set_view(const uint8_t* data, size_t size,
+                         const void* begin, const void* end);
+        LMError check_structure();
+        LMError copy_ngrams(DynamicModelBase* model,
+                            const std::vector<int>* prune_counts,
+                            int level, int index,
+                            std::vector<WordId>& ngram,
+                            std::vector<WordId>& wid_map);
+        void update_statistics();
+        void update_probabilities();
+
+        // Find the node of an n-gram, returns its index into its
+        // level or -1 if it doesn't exist.
+        int find_node(const WordId* wids, int n);
+
+        // Range of children of a node in the next level.
+        void get_children(int level, int index,
+                          uint32_t& begin, uint32_t& end)
+        {
+            if (level < 0)
+            {
+                begin = 0;
+                end = view.get_num_nodes(0);
+            }
+            else
+            if (level >= view.get_order()-1)
+            {
+                begin = end = 0;
+            }
+            else
+            {
+                const uint32_t* child_begin = view.get_child_begin(level);
+                begin = child_begin[index];
+                end = child_begin[index+1];
+            }
+        }
+
+        void get_probs_interpolated(const std::vector<WordId>& history,
+                                    const std::vector<WordId>& words,
+                                    std::vector<double>& vp);
+        void get_probs_precomputed(const std::vector<WordId>& history,
+                                   const std::vector<WordId>& words,
+                                   std::vector<double>& vp);
+        double get_prob_precomputed(const WordId* history, int n,
+                                    WordId wid);
+
+    private:
+        Smoothing smoothing;
+
+        std::vector<uint8_t> buffer;    // arrays built by freeze()
+        MappedFile mapped_file;         // or mapped from a binary file
+        BinaryModelView view;
+
+        int num_word_types;
+        int total_unigram_count;
+        std::vector<double> Ds;   // discounting parameters, per level
+
+        // Precomputed tables, per level, parallel to the n-gram arrays.
+        // probs: interpolated probability of the n-gram of each node
+        // backoffs: weight of the lower order for histories, 1 - lambda
+        bool precompute;
+        std::vector< std::vector<float> > probs;
+        std::vector< std::vector<float> > backoffs;
+};
+
+#endif
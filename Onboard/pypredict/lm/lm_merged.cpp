@@ -17,10 +17,12 @@
  * along with this program. If not, see <http://www.gnu.org/licenses/>.
  */
 
+#include <unistd.h>
 #include <algorithm>
 #include <cmath>
 
 #include "lm_merged.h"
+#include "thread_pool.h"
 
 using namespace std;
 
@@ -29,91 +31,297 @@ using namespace std;
 // MergedModel - abstract container for one or more component language models
 //------------------------------------------------------------------------
 
-struct cmp_results_desc
+// Descending probabilities, ties in alphabetical order. This is a
+// total order, so (partial) sorting with it gives the same results as
+// stable sorting by probability after ordering by word.
+// UTF-8 byte order is code point order, the same as for wide strings.
+struct MergedModel::cmp_results_desc
 {
-    bool operator() (const LanguageModel::Result& x,
-                     const LanguageModel::Result& y)
-    { return (y.p < x.p);}
+    cmp_results_desc(MergedVocabulary& _vocabulary) :
+        vocabulary(_vocabulary)
+    {}
+
+    bool operator() (const IdResult& x, const IdResult& y)
+    {
+        if (x.exact != y.exact)
+            return x.exact;
+        return y.p < x.p ||
+               (y.p == x.p && strcmp(vocabulary.id_to_word(x.wid),
+                                     vocabulary.id_to_word(y.wid)) < 0);
+    }
+
+    MergedVocabulary& vocabulary;
 };
 
-struct cmp_results_word
+struct MergedModel::cmp_results_word
 {
-    bool operator() (const LanguageModel::Result& x,
-                     const LanguageModel::Result& y)
-    { return (x.word < y.word);}
+    cmp_results_word(MergedVocabulary& _vocabulary) :
+        vocabulary(_vocabulary)
+    {}
+
+    bool operator() (const IdResult& x, const IdResult& y)
+    {
+        return strcmp(vocabulary.id_to_word(x.wid),
+                      vocabulary.id_to_word(y.wid)) < 0;
+    }
+
+    MergedVocabulary& vocabulary;
 };
 
-void MergedModel::predict(vector<LanguageModel::Result>& results,
-                          const vector<wchar_t*>& context,
-                          int limit, uint32_t options)
+void MergedModel::predict_ids(vector<WordId>& wids,
+                              vector<double>& probabilities,
+                              const vector<wchar_t*>& context,
+                              int limit, uint32_t options,
+                              PredictionCache* cache)
 {
     int i;
 
     init_merge();
 
-    // merge prediction results of all component models
-    ResultsMap m;
+    // each component keeps its own cache
+    if (cache)
+        cache->components.resize(components.size());
+
+    // Ask the derived class if a limit on the number of results
+    // is allowed. Otherwise assume a limit would change the
+    // outcome and get all results.
+    bool can_limit = can_limit_components();
+
+    // Setting a limit requires sorting of results by probabilities.
+    // Skip sorting for performance reasons if there is no limit.
+    uint32_t opt = options;
+    if (!can_limit)
+        opt |= NO_SORT;
+
+    // get predictions from the component models
+    vector< vector<WordId> > wss(components.size());
+    vector< vector<double> > pss(components.size());
+    predict_components(wss, pss, context,
+                       can_limit ? limit : -1, // limit number of results
+                       opt, cache);
+
+    // Translate to merged word ids. Start over if any component
+    // renumbered its words, e.g. after loading a model.
     for (i=0; i<(int)components.size(); i++)
-    {
-        // Ask the derived class if a limit on the number of results
-        // is allowed. Otherwise assume a limit would change the
-        // outcome and get all results.
-        bool can_limit = can_limit_components();
-
-        // Setting a limit requires sorting of results by probabilities.
-        // Skip sorting for performance reasons if there is no limit.
-        uint32_t opt = options | NORMALIZE;
-        if (!can_limit)
-            opt |= NO_SORT;
-
-        // get predictions from the component model
-        vector<Result> rs;
-        components[i]->predict(rs, context,
-                           can_limit ? limit : -1, // limit number of results
-                           options);
+        if (word_id_map_epochs[i] != components[i]->get_vocabulary_epoch())
+        {
+            clear_vocabulary();
+            break;
+        }
+    for (i=0; i<(int)components.size(); i++)
+        map_word_ids(wss[i], i);
 
-        merge(m, rs, i);
-    }
+    // merge prediction results of all component models, in order
+    ResultsMap& m = results_map;
+    m.reset(vocabulary.size());
+    for (i=0; i<(int)components.size(); i++)
+        merge(m, wss[i], pss[i], i);
 
     // copy the map to the results vector
-    results.resize(0);
-    results.reserve(m.size());
-    ResultsMap::iterator mit;
-    for (mit=m.begin(); mit != m.end(); mit++)
+    const vector<WordId>& merged_wids = m.get_wids();
+    vector<IdResult> results;
+    results.reserve(merged_wids.size());
+    for (i=0; i<(int)merged_wids.size(); i++)
     {
-        Result result = {mit->first, mit->second};
+        IdResult result = {merged_wids[i], m.get_value(merged_wids[i]),
+                           true};
         results.push_back(result);
     }
 
-    if (!(options & NO_SORT))
+    // Exact completions come first, however frequent a near miss is.
+    if (options & FUZZY_PREFIX && !context.empty())
     {
-        // sort by descending probabilities
-        // Use stable sort to keep words of equal probabilities in a fixed
-        // order with little by little changing contexts.
-        cmp_results_desc cmp_results;
-        std::stable_sort(results.begin(), results.end(), cmp_results);
+        vector<const char*> words(results.size());
+        for (i=0; i<(int)results.size(); i++)
+            words[i] = vocabulary.id_to_word(results[i].wid);
+        vector<bool> exact;
+        find_exact_completions(words, context.back(), options, exact);
+        for (i=0; i<(int)results.size(); i++)
+            results[i].exact = exact[i];
     }
 
     int result_size = results.size();
     if (limit >= 0 && limit < (int)results.size())
         result_size = limit;
 
+    sort_results(results, result_size, options);
+
     // normalize the final probabilities as needed
     // Only works as expected with all words included, no filtering, no prefix
     if (options & NORMALIZE && needs_normalization())
         normalize(results, result_size);
 
     // limit results, can't really do this earlier
-    if (result_size < (int)results.size())
-        results.resize(result_size);
+    wids.resize(result_size);
+    probabilities.resize(result_size);
+    for (i=0; i<result_size; i++)
+    {
+        wids[i] = results[i].wid;
+        probabilities[i] = results[i].p;
+    }
+}
+
+// Forget all merged word ids, they are mapped again on demand.
+void MergedModel::clear_vocabulary()
+{
+    vocabulary.clear();
+    word_id_maps.assign(components.size(), vector<WordId>());
+    word_id_map_epochs.resize(components.size());
+    for (int i=0; i<(int)components.size(); i++)
+        word_id_map_epochs[i] = components[i]->get_vocabulary_epoch();
+}
+
+// Replace word ids of a component by merged word ids. Each word
+// is converted only once, then its id is remembered.
+void MergedModel::map_word_ids(vector<WordId>& wids, int model_index)
+{
+    LanguageModel* model = components[model_index];
+    vector<WordId>& word_id_map = word_id_maps[model_index];
+    for (int i=0; i<(int)wids.size(); i++)
+    {
+        WordId wid = wids[i];
+        if (wid >= word_id_map.size())
+            word_id_map.resize(wid + 1, WIDNONE);
+
+        WordId merged_wid = word_id_map[wid];
+        if (merged_wid == WIDNONE)
+        {
+            const char* word = model->id_to_word_utf8(wid);
+            merged_wid = vocabulary.add_word(word ? word : "");
+            word_id_map[wid] = merged_wid;
+        }
+        wids[i] = merged_wid;
+    }
+}
+
+// Worker threads for component predictions, shared by all merged models.
+// Returns NULL on single core machines and in forked child processes,
+// which don't inherit the workers.
+static ThreadPool* get_thread_pool()
+{
+    static pid_t pid = getpid();
+    static ThreadPool pool(std::max(std::min(
+                   (int)std::thread::hardware_concurrency() - 1, 3), 0));
+    if (getpid() != pid || !pool.get_num_threads())
+        return NULL;
+    return &pool;
+}
+
+// Run the component predictions, concurrently if possible. The calling
+// thread takes the first component, worker threads the others.
+void MergedModel::predict_components(vector< vector<WordId> >& wids,
+                                     vector< vector<double> >& probs,
+                                     const vector<wchar_t*>& context,
+                                     int limit, uint32_t options,
+                                     PredictionCache* cache)
+{
+    int n = components.size();
+    auto predict_component = [&](int i)
+    {
+        components[i]->predict_ids(wids[i], probs[i], context, limit, options,
+                                   cache ? &cache->components[i] : NULL);
+    };
+
+    ThreadPool* pool = NULL;
+    if (n > 1 && can_predict_concurrently())
+        pool = get_thread_pool();
+
+    if (!pool)
+    {
+        for (int i=0; i<n; i++)
+            predict_component(i);
+        return;
+    }
+
+    vector< std::future<void> > futures;
+    for (int i=1; i<n; i++)
+        futures.push_back(pool->submit(std::bind(predict_component, i)));
+
+    // Wait for all tasks before passing on any exception,
+    // they write to results.
+    std::exception_ptr error;
+    try
+    {
+        predict_component(0);
+    }
+    catch (...)
+    {
+        error = std::current_exception();
+    }
+    for (int i=0; i<(int)futures.size(); i++)
+    {
+        try
+        {
+            futures[i].get();
+        }
+        catch (...)
+        {
+            if (!error)
+                error = std::current_exception();
+        }
+    }
+    if (error)
+        std::rethrow_exception(error);
 }
 
-void MergedModel::normalize(vector<Result>& results, int result_size)
+// Models aren't safe to predict from multiple threads at once. Only run
+// concurrently if no model is reachable through more than one component.
+// Nested merged models predict sequentially inside of worker threads.
+bool MergedModel::can_predict_concurrently()
+{
+    if (ThreadPool::is_worker_thread())
+        return false;
+
+    vector<LanguageModel*> models;
+    get_leaf_models(models);
+    sort(models.begin(), models.end());
+    return adjacent_find(models.begin(), models.end()) == models.end();
+}
+
+void MergedModel::get_leaf_models(vector<LanguageModel*>& models)
+{
+    for (int i=0; i<(int)components.size(); i++)
+    {
+        MergedModel* model = dynamic_cast<MergedModel*>(components[i]);
+        if (model)
+            model->get_leaf_models(models);
+        else
+            models.push_back(components[i]);
+    }
+}
+
+// Bring the merged results into their final order. Only the first
+// result_size entries need to be in order, unless normalization
+// has to sum up all of them in a reproducible order.
+void MergedModel::sort_results(vector<IdResult>& results, int result_size,
+                               uint32_t options)
+{
+    if (options & NO_SORT)
+    {
+        cmp_results_word cmp_results(vocabulary);
+        std::sort(results.begin(), results.end(), cmp_results);
+    }
+    else
+    {
+        // sort by descending probabilities
+        // Keep words of equal probabilities in a fixed
+        // order with little by little changing contexts.
+        cmp_results_desc cmp_results(vocabulary);
+        if (options & NORMALIZE && needs_normalization())
+            std::sort(results.begin(), results.end(), cmp_results);
+        else
+            std::partial_sort(results.begin(),
+                              results.begin() + result_size,
+                              results.end(), cmp_results);
+    }
+}
+
+void MergedModel::normalize(vector<IdResult>& results, int result_size)
 {
     // The normalization factors for overlay and log-linear interpolation
     // are hard to come by -> Normalize the final limited results instead.
     double psum = 0.0;
-    vector<Result>::iterator it;
+    vector<IdResult>::iterator it;
     for(it=results.begin(); it!=results.end(); it++)
         psum += (*it).p;
 
@@ -130,18 +338,12 @@ void MergedModel::normalize(vector<Result>& results, int result_size)
 // the last probability found for a word wins.
 
 // merge vector of ngram probabilities
-void OverlayModel::merge(ResultsMap& dst, const vector<Result>& values,
+void OverlayModel::merge(ResultsMap& dst, const vector<WordId>& wids,
+                         const vector<double>& probabilities,
                          int model_index)
 {
-    vector<Result>::const_iterator it;
-    ResultsMap::iterator mit = dst.begin();
-    for (it=values.begin(); it != values.end(); it++)
-    {
-        const wstring& word = it->word;
-        double p = it->p;
-        mit = dst.insert(dst.begin(), pair<wstring, double>(word, 0.0));
-        mit->second = p;
-    }
+    for (int i=0; i<(int)wids.size(); i++)
+        dst.get(wids[i], 0.0) = probabilities[i];
 }
 
 
@@ -161,20 +363,14 @@ void LinintModel::init_merge()
 }
 
 // interpolate vector of ngrams
-void LinintModel::merge(ResultsMap& dst, const vector<Result>& values,
-                              int model_index)
+void LinintModel::merge(ResultsMap& dst, const vector<WordId>& wids,
+                        const vector<double>& probabilities,
+                        int model_index)
 {
     double weight = weights[model_index] / weight_sum;
 
-    vector<Result>::const_iterator it;
-    ResultsMap::iterator mit;
-    for (it=values.begin(); it != values.end(); it++)
-    {
-        const wstring& word = it->word;
-        double p = it->p;
-        mit = dst.insert(dst.begin(), pair<wstring, double>(word, 0.0));
-        mit->second += weight * p;
-    }
+    for (int i=0; i<(int)wids.size(); i++)
+        dst.get(wids[i], 0.0) += weight * probabilities[i];
 }
 
 // interpolate probabilities of a single ngram
@@ -193,6 +389,23 @@ double LinintModel::get_probability(const wchar_t* const* ngram, int n)
     return p;
 }
 
+void LinintModel::get_probabilities(const vector<wchar_t*>& tokens,
+                                    int order,
+                                    vector<double>& probabilities)
+{
+    init_merge();
+
+    probabilities.assign(tokens.size(), 0.0);
+    vector<double> ps;
+    for (int i=0; i<(int)components.size(); i++)
+    {
+        double weight = weights[i] / weight_sum;
+        components[i]->get_probabilities(tokens, order, ps);
+        for (int j=0; j<(int)ps.size(); j++)
+            probabilities[j] += weight * ps[j];
+    }
+}
+
 
 //------------------------------------------------------------------------
 // LoglinintModel - log-linear interpolation of language models
@@ -204,21 +417,14 @@ void LoglinintModel::init_merge()
 }
 
 // interpolate prediction results vector
-void LoglinintModel::merge(ResultsMap& dst, const vector<Result>& values,
-                              int model_index)
+void LoglinintModel::merge(ResultsMap& dst, const vector<WordId>& wids,
+                           const vector<double>& probabilities,
+                           int model_index)
 {
     double weight = weights[model_index];
 
-    vector<Result>::const_iterator it;
-    ResultsMap::iterator mit;
-    for (it=values.begin(); it != values.end(); it++)
-    {
-        const wstring& word = it->word;
-        double p = it->p;
-
-        mit = dst.insert(dst.begin(), pair<wstring, double>(word, 1.0));
-        mit->second *= pow(p, weight);
-    }
+    for (int i=0; i<(int)wids.size(); i++)
+        dst.get(wids[i], 1.0) *= pow(probabilities[i], weight);
 }
 
 
@@ -21,20 +21,99 @@
 #define LM_MERGED_H
 
 #include <vector>
+#include <string>
+#include <unordered_map>
 #include "lm.h"
 
 //------------------------------------------------------------------------
-// MergedModel - abstract container for one or more component language models
+// MergedVocabulary - interned words of all component models
 //------------------------------------------------------------------------
+// Words of the component models are mapped to ids of the merged
+// vocabulary, so that their prediction results can be merged by
+// integer ids instead of by strings.
 
-struct map_wstr_cmp
+class MergedVocabulary
 {
-  bool operator() (const std::wstring& lhs, const std::wstring& rhs) const
-  { return lhs < rhs; }
+    public:
+        MergedVocabulary()
+        {
+            clear();
+        }
+
+        void clear()
+        {
+            word_ids.clear();
+            words.clear();
+            epoch = Dictionary::new_epoch();
+        }
+
+        // get the id of a UTF-8 word, add it if it's new
+        WordId add_word(const char* word)
+        {
+            std::pair<std::unordered_map<std::string, WordId>::iterator,
+                      bool> r = word_ids.insert(
+                          std::make_pair(std::string(word),
+                                         (WordId)words.size()));
+            if (r.second)
+                words.push_back(r.first->first.c_str());
+            return r.first->second;
+        }
+
+        const char* id_to_word(WordId wid)
+        {return wid < words.size() ? words[wid] : NULL;}
+
+        int size() {return words.size();}
+
+        uint64_t get_epoch() {return epoch;}
+
+    private:
+        std::unordered_map<std::string, WordId> word_ids;
+        std::vector<const char*> words; // keys of word_ids, by id
+        uint64_t epoch;
+};
+
+//------------------------------------------------------------------------
+// ResultsMap - merged results, indexed by merged word id
+//------------------------------------------------------------------------
+// The final order is established by sorting, see MergedModel::predict_ids.
+
+class ResultsMap
+{
+    public:
+        // forget all entries, make room for word ids below size
+        void reset(int size)
+        {
+            for (int i=0; i<(int)wids.size(); i++)
+                present[wids[i]] = false;
+            wids.clear();
+            values.resize(size);
+            present.resize(size, false);
+        }
+
+        // value of word id wid, initialized if it wasn't present yet
+        double& get(WordId wid, double initial_value)
+        {
+            if (!present[wid])
+            {
+                present[wid] = true;
+                values[wid] = initial_value;
+                wids.push_back(wid);
+            }
+            return values[wid];
+        }
+
+        const std::vector<WordId>& get_wids() {return wids;}
+        double get_value(WordId wid) {return values[wid];}
+
+    private:
+        std::vector<WordId> wids;    // present word ids, in order of insertion
+        std::vector<double> values;
+        std::vector<bool> present;
 };
-typedef std::map<std::wstring, double, map_wstr_cmp> ResultsMap;
-//#include <unordered_map>
-//typedef std::unordered_map<const wchar_t*, double> ResultsMap;
+
+//------------------------------------------------------------------------
+// MergedModel - abstract container for one or more component language models
+//------------------------------------------------------------------------
 
 class MergedModel : public LanguageModel
 {
@@ -48,10 +127,40 @@ class MergedModel : public LanguageModel
             return true;
         };
 
-        virtual void predict(std::vector<LanguageModel::Result>& results,
-                             const std::vector<wchar_t*>& context,
-                             int limit=-1,
-                             uint32_t options = DEFAULT_OPTIONS);
+        virtual void predict_ids(std::vector<WordId>& wids,
+                                 std::vector<double>& probabilities,
+                                 const std::vector<wchar_t*>& context,
+                                 int limit, uint32_t options,
+                                 PredictionCache* cache);
+
+        virtual const wchar_t* id_to_word(WordId wid)
+        {
+            static const wchar_t* not_found = L"";
+            const char* w = vocabulary.id_to_word(wid);
+            const wchar_t* word = w ? conv.mb2wc(w) : NULL;
+            if (!word)
+                return not_found;
+            return word;
+        }
+        virtual const char* id_to_word_utf8(WordId wid)
+        {return vocabulary.id_to_word(wid);}
+        virtual uint64_t get_vocabulary_epoch()
+        {return vocabulary.get_epoch();}
+
+        // exact match in any lookup component, else the most
+        // partial matches
+        virtual int lookup_word(const wchar_t* word)
+        {
+            int result = 0;
+            for (int i=0; i<(int)lookup_components.size(); i++)
+            {
+                int count = lookup_components[i]->lookup_word(word);
+                if (count == 1)
+                    return 1;
+                result = std::min(result, count);
+            }
+            return result;
+        }
 
         virtual LMError load(const char* filename)
         {return ERR_NOT_IMPL;}
@@ -60,21 +169,64 @@ class MergedModel : public LanguageModel
 
         // merged model interface
         virtual void set_models(const std::vector<LanguageModel*>& models)
-        { components = models;}
+        {
+            components = models;
+            lookup_components = models;
+            clear_vocabulary();
+        }
+
+        const std::vector<LanguageModel*>& get_components()
+        {return components;}
+
+        // Restrict lookup_word(), and with it PREFER_LOWER_CASE, to
+        // a subset of the components, all of them by default.
+        void set_lookup_models(const std::vector<LanguageModel*>& models)
+        {
+            lookup_components = models;
+        }
 
     protected:
         // merged model interface
         virtual void init_merge() {}
         virtual bool can_limit_components() {return false;}
-        virtual void merge(ResultsMap& dst, const std::vector<Result>& values,
-                                      int model_index) = 0;
+        virtual void merge(ResultsMap& dst, const std::vector<WordId>& wids,
+                           const std::vector<double>& probabilities,
+                           int model_index) = 0;
         virtual bool needs_normalization() {return false;}
 
     private:
-        void normalize(std::vector<Result>& results, int result_size);
+        // merged word id and probability
+        typedef struct {WordId wid; double p; bool exact;} IdResult;
+        struct cmp_results_desc;
+        struct cmp_results_word;
+
+        void predict_components(std::vector< std::vector<WordId> >& wids,
+                                std::vector< std::vector<double> >& probs,
+                                const std::vector<wchar_t*>& context,
+                                int limit, uint32_t options,
+                                PredictionCache* cache);
+        bool can_predict_concurrently();
+        void get_leaf_models(std::vector<LanguageModel*>& models);
+        void clear_vocabulary();
+        void map_word_ids(std::vector<WordId>& wids, int model_index);
+        void sort_results(std::vector<IdResult>& results, int result_size,
+                          uint32_t options);
+        void normalize(std::vector<IdResult>& results, int result_size);
 
     protected:
         std::vector<LanguageModel*> components;
+        std::vector<LanguageModel*> lookup_components;
+
+    private:
+        MergedVocabulary vocabulary;
+
+        // Merged word ids by component word id, WIDNONE where not
+        // mapped yet, and the component's vocabulary epoch they are for.
+        std::vector< std::vector<WordId> > word_id_maps;
+        std::vector<uint64_t> word_id_map_epochs;
+
+        ResultsMap results_map;  // kept to reuse its memory
+        StrConv conv;
 };
 
 //------------------------------------------------------------------------
@@ -84,8 +236,9 @@ class MergedModel : public LanguageModel
 class OverlayModel : public MergedModel
 {
     protected:
-        virtual void merge(ResultsMap& dst, const std::vector<Result>& values,
-                                      int model_index);
+        virtual void merge(ResultsMap& dst, const std::vector<WordId>& wids,
+                           const std::vector<double>& probabilities,
+                           int model_index);
 
         // overlay can safely use a limit on prediction results
         // for component models
@@ -105,9 +258,13 @@ class LinintModel : public MergedModel
         { this->weights = weights; }
 
         virtual void init_merge();
-        virtual void merge(ResultsMap& dst, const std::vector<Result>& values,
-                                      int model_index);
+        virtual void merge(ResultsMap& dst, const std::vector<WordId>& wids,
+                           const std::vector<double>& probabilities,
+                           int model_index);
         virtual double get_probability(const wchar_t* const* ngram, int n);
+        virtual void get_probabilities(const std::vector<wchar_t*>& tokens,
+                                       int order,
+                                       std::vector<double>& probabilities);
 
     protected:
         std::vector<double> weights;
@@ -126,8 +283,9 @@ class LoglinintModel : public MergedModel
         { this->weights = weights; }
 
         virtual void init_merge();
-        virtual void merge(ResultsMap& dst, const std::vector<Result>& values,
-                                      int model_index);
+        virtual void merge(ResultsMap& dst, const std::vector<WordId>& wids,
+                           const std::vector<double>& probabilities,
+                           int model_index);
 
         // there appears to be no simply way to for direct normalized results
         // -> run normalization explicitly
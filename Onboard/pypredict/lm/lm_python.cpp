@@ -48,7 +48,9 @@
 #include "lm_dynamic.h"
 #include "lm_dynamic_kn.h"
 #include "lm_dynamic_cached.h"
+#include "lm_frozen.h"
 #include "lm_merged.h"
+#include "lm_tokenize.h"
 
 using namespace std;
 
@@ -126,6 +128,7 @@ typedef PyWrapper<UnigramModel> PyUnigramModel;
 typedef PyWrapper<DynamicModel> PyDynamicModel;
 typedef PyWrapper<DynamicModelKN> PyDynamicModelKN;
 typedef PyWrapper<CachedDynamicModel> PyCachedDynamicModel;
+typedef PyWrapper<FrozenModel> PyFrozenModel;
 
 // Another, derived wrapper to encapsulate python reference handling
 // of a vector of LanguageModels.
@@ -162,6 +165,75 @@ typedef PyMergedModelWrapper<OverlayModel> PyOverlayModel;
 typedef PyMergedModelWrapper<LinintModel> PyLinintModel;
 typedef PyMergedModelWrapper<LoglinintModel> PyLoglinintModel;
 
+// Keeps other threads off the models for the lifetime of the guard.
+// Predictions, learning, loading and saving release the GIL, so
+// every method touching a model takes its guard first, one thread
+// at a time per model. Merged models lock their components, too,
+// which are fixed on construction. Locks are taken in address order
+// and waited for without the GIL, threads holding them may still
+// need it to return.
+class ModelGuard
+{
+    public:
+        ModelGuard(LanguageModel* model, LanguageModel* model2 = NULL)
+        {
+            add_model(model);
+            add_model(model2);
+            sort(models.begin(), models.end());
+            models.erase(unique(models.begin(), models.end()),
+                         models.end());
+
+            if (!try_lock())
+            {
+                Py_BEGIN_ALLOW_THREADS;
+                for (int i=0; i<(int)models.size(); i++)
+                    models[i]->mutex.lock();
+                Py_END_ALLOW_THREADS;
+            }
+        }
+
+        ~ModelGuard()
+        {
+            unlock(models.size());
+        }
+
+    private:
+        void add_model(LanguageModel* model)
+        {
+            if (!model)
+                return;
+            models.push_back(model);
+
+            MergedModel* merged = dynamic_cast<MergedModel*>(model);
+            if (merged)
+            {
+                const vector<LanguageModel*>& components =
+                    merged->get_components();
+                for (int i=0; i<(int)components.size(); i++)
+                    add_model(components[i]);
+            }
+        }
+
+        bool try_lock()
+        {
+            for (int i=0; i<(int)models.size(); i++)
+                if (!models[i]->mutex.try_lock())
+                {
+                    unlock(i);
+                    return false;
+                }
+            return true;
+        }
+
+        void unlock(int n)
+        {
+            for (int i=n-1; i>=0; i--)
+                models[i]->mutex.unlock();
+        }
+
+        vector<LanguageModel*> models;
+};
+
 
 //------------------------------------------------------------------------
 // python helper functions
@@ -454,6 +526,12 @@ bool check_error(const LMError err, const char* filename = NULL)
                     msg = "error encoding to UTF-8"; break;
                 case ERR_MD2WC:
                     msg = "error decoding to Unicode"; break;
+                case ERR_BAD_HEADER:
+                    msg = "invalid binary model header"; break;
+                case ERR_VERSION_UNSUPPORTED:
+                    msg = "binary model version not supported"; break;
+                case ERR_CHECKSUM:
+                    msg = "binary model checksum mismatch"; break;
                 default:
                     PyErr_SetString(PyExc_ValueError, "Unknown Error");
                     return true;
@@ -469,7 +547,7 @@ bool check_error(const LMError err, const char* filename = NULL)
 
 static PyObject *
 predict(PyLanguageModel* self, PyObject* args, PyObject *kwds,
-        bool with_probs = false)
+        bool with_probs = false, PredictionCache* cache = NULL)
 {
     int i;
     int error = 0;
@@ -491,8 +569,13 @@ predict(PyLanguageModel* self, PyObject* args, PyObject *kwds,
         if (!pyseqence_to_strings(ocontext, context))
             return NULL;
 
+        // Python threads may run meanwhile, the model and its
+        // components are kept alive by our callers.
+        ModelGuard guard(self->o);
         vector<LanguageModel::Result> results;
-        (*self)->predict(results, context, limit, (uint32_t) options);
+        Py_BEGIN_ALLOW_THREADS;
+        (*self)->predict(results, context, limit, (uint32_t) options, cache);
+        Py_END_ALLOW_THREADS;
 
         // build return list
         result = PyList_New(results.size());
@@ -545,6 +628,7 @@ predict(PyLanguageModel* self, PyObject* args, PyObject *kwds,
 static PyObject *
 LanguageModel_clear(PyLanguageModel* self)
 {
+    ModelGuard guard(self->o);
     (*self)->clear();
     Py_RETURN_NONE;
 }
@@ -577,6 +661,7 @@ LanguageModel_get_probability(PyLanguageModel* self, PyObject* args)
         if (!ngram)
             return NULL;
 
+        ModelGuard guard(self->o);
         double p = (*self)->get_probability(ngram, n);
         result = PyFloat_FromDouble(p);
 
@@ -585,6 +670,52 @@ LanguageModel_get_probability(PyLanguageModel* self, PyObject* args)
     return result;
 }
 
+// Copy doubles into a new array.array of type 'd'.
+static PyObject *
+doubles_to_pyarray(const vector<double>& values)
+{
+    PyObject* module = PyImport_ImportModule("array");
+    if (!module)
+        return NULL;
+
+    PyObject* result = NULL;
+    PyObject* bytes = PyBytes_FromStringAndSize((const char*) values.data(),
+                                        values.size() * sizeof(double));
+    if (bytes)
+        result = PyObject_CallMethod(module, (char*)"array", (char*)"sO",
+                                     "d", bytes);
+
+    Py_XDECREF(bytes);
+    Py_DECREF(module);
+    return result;
+}
+
+// get_probabilities scores a whole token stream and returns the
+// probability of each token as array('d').
+static PyObject *
+LanguageModel_get_probabilities(PyLanguageModel* self, PyObject* args)
+{
+    PyObject *otokens = NULL;
+    int order = 0;
+
+    if (!PyArg_ParseTuple(args, "Oi:get_probabilities", &otokens, &order))
+        return NULL;
+
+    vector<wchar_t*> tokens;
+    if (!pyseqence_to_strings(otokens, tokens))
+        return NULL;
+
+    ModelGuard guard(self->o);
+    vector<double> probabilities;
+    Py_BEGIN_ALLOW_THREADS;
+    (*self)->get_probabilities(tokens, order, probabilities);
+    Py_END_ALLOW_THREADS;
+
+    free_strings(tokens);
+
+    return doubles_to_pyarray(probabilities);
+}
+
 static PyObject *
 LanguageModel_lookup_word(PyLanguageModel* self, PyObject* value)
 {
@@ -595,6 +726,7 @@ LanguageModel_lookup_word(PyLanguageModel* self, PyObject* value)
         return NULL;
     }
 
+    ModelGuard guard(self->o);
     int result = (*self)->lookup_word(word);
 
     if (word)
@@ -611,10 +743,13 @@ LanguageModel_load(PyLanguageModel *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "s:load", &filename))
         return NULL;
 
+    // Parse outside of the GIL, models may be loaded
+    // in the background while other threads keep running.
+    ModelGuard guard(self->o);
     LMError e;
-    //Py_BEGIN_ALLOW_THREADS;
+    Py_BEGIN_ALLOW_THREADS;
     e = (*self)->load(filename);
-    //Py_END_ALLOW_THREADS;
+    Py_END_ALLOW_THREADS;
 
     if (check_error(e, filename))
         return NULL;
@@ -630,12 +765,25 @@ LanguageModel_save(PyLanguageModel *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "s:save", &filename))
         return NULL;
 
-    if (check_error((*self)->save(filename), filename))
+    // Models may be saved by worker threads, too.
+    ModelGuard guard(self->o);
+    LMError e;
+    Py_BEGIN_ALLOW_THREADS;
+    e = (*self)->save(filename);
+    Py_END_ALLOW_THREADS;
+
+    if (check_error(e, filename))
         return NULL;
 
     Py_RETURN_NONE;
 }
 
+static PyObject *
+LanguageModel_get_generation(PyLanguageModel *self, void *closure)
+{
+    return PyLong_FromUnsignedLongLong((*self)->get_generation());
+}
+
 
 static PyMethodDef LanguageModel_methods[] = {
     {"clear", (PyCFunction)LanguageModel_clear, METH_NOARGS,
@@ -650,6 +798,10 @@ static PyMethodDef LanguageModel_methods[] = {
     {"get_probability", (PyCFunction)LanguageModel_get_probability, METH_VARARGS,
      ""
     },
+    {"get_probabilities", (PyCFunction)LanguageModel_get_probabilities,
+     METH_VARARGS,
+     ""
+    },
     {"lookup_word", (PyCFunction)LanguageModel_lookup_word, METH_O,
      ""
     },
@@ -662,6 +814,14 @@ static PyMethodDef LanguageModel_methods[] = {
     {NULL}  /* Sentinel */
 };
 
+static PyGetSetDef LanguageModel_getsetters[] = {
+    {(char*)"generation",
+     (getter)LanguageModel_get_generation, (setter)NULL,
+     (char*)"changes whenever the contents of the model change",
+     NULL},
+    {NULL}  /* Sentinel */
+};
+
 static PyTypeObject LanguageModelType = {
     PyVarObject_HEAD_INIT(&PyType_Type, 0)
     "lm.LanguageModel",             /*tp_name*/
@@ -692,7 +852,7 @@ static PyTypeObject LanguageModelType = {
     0,		               /* tp_iternext */
     LanguageModel_methods,     /* tp_methods */
     0,                         /* tp_members */
-    0,                         /* tp_getset */
+    LanguageModel_getsetters,  /* tp_getset */
     0,                         /* tp_base */
     0,                         /* tp_dict */
     0,                         /* tp_descr_get */
@@ -704,6 +864,153 @@ static PyTypeObject LanguageModelType = {
 };
 
 
+//------------------------------------------------------------------------
+// PredictionSession - python object, predicts with caching between calls
+//------------------------------------------------------------------------
+// Successive predictions while typing a word only filter the candidates
+// of the previous call. Changes to the history, the options or the
+// model's contents invalidate the cache.
+class PredictionSession
+{
+    public:
+        PredictionSession(PyLanguageModel* lm)
+        {
+            model = lm;
+            Py_INCREF(model);  // don't let the model go away
+        }
+
+        ~PredictionSession()
+        {
+            Py_DECREF(model);
+        }
+
+    public:
+        PyObject_HEAD
+
+        PyLanguageModel* model;
+        PredictionCache cache;
+};
+
+static PyObject *
+PredictionSession_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    PyLanguageModel* model = NULL;
+
+    static char *kwlist[] = {(char*)"model", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!:PredictionSession",
+                                     kwlist, &LanguageModelType, &model))
+        return NULL;
+
+    PredictionSession* self = (PredictionSession *)type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self = new(self) PredictionSession(model);   // placement new
+    }
+    return (PyObject *)self;
+}
+
+static void
+PredictionSession_dealloc(PredictionSession* self)
+{
+    self->~PredictionSession();   // call destructor
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+// predict returns a list of words
+static PyObject *
+PredictionSession_predict(PredictionSession* self, PyObject* args,
+                          PyObject* kwds)
+{
+    return predict(self->model, args, kwds, false, &self->cache);
+}
+
+// predictp returns a list of (word, probability) tuples
+static PyObject *
+PredictionSession_predictp(PredictionSession* self, PyObject* args,
+                           PyObject* kwds)
+{
+    return predict(self->model, args, kwds, true, &self->cache);
+}
+
+static PyObject *
+PredictionSession_reset(PredictionSession* self)
+{
+    ModelGuard guard(self->model->o);
+    self->cache.clear();
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+PredictionSession_get_model(PredictionSession *self, void *closure)
+{
+    Py_INCREF(self->model);
+    return (PyObject*) self->model;
+}
+
+static PyMethodDef PredictionSession_methods[] = {
+    {"predict", (PyCFunction)PredictionSession_predict,
+     METH_VARARGS | METH_KEYWORDS,
+     ""
+    },
+    {"predictp", (PyCFunction)PredictionSession_predictp,
+     METH_VARARGS | METH_KEYWORDS,
+     ""
+    },
+    {"reset", (PyCFunction)PredictionSession_reset, METH_NOARGS,
+     ""
+    },
+    {NULL}  /* Sentinel */
+};
+
+static PyGetSetDef PredictionSession_getsetters[] = {
+    {(char*)"model",
+     (getter)PredictionSession_get_model, (setter)NULL,
+     (char*)"language model predictions are made with",
+     NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject PredictionSessionType = {
+    PyVarObject_HEAD_INIT(&PyType_Type, 0)
+    "lm.PredictionSession",             /*tp_name*/
+    sizeof(PredictionSession),             /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor)PredictionSession_dealloc, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+    "PredictionSession objects",           /* tp_doc */
+    0,		               /* tp_traverse */
+    0,		               /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    PredictionSession_methods,     /* tp_methods */
+    0,                         /* tp_members */
+    PredictionSession_getsetters,  /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                         /* tp_init */
+    0,                         /* tp_alloc */
+    PredictionSession_new,     /* tp_new */
+};
+
+
 //------------------------------------------------------------------------
 // NGramIter - python iterator object for traversal of the n-gram trie
 //------------------------------------------------------------------------
@@ -775,6 +1082,7 @@ NGramIter_iternext(PyObject *self)
 
     NGramIter* iter = (NGramIter*) self;
 
+    ModelGuard guard(iter->lm);
     BaseNode* node = iter->next();
     if (!node)
         return NULL;
@@ -877,81 +1185,503 @@ static PyTypeObject NGramIterType = {
     0,             /* tp_new */
 };
 
+
 //------------------------------------------------------------------------
-// UnigramModel - python interface for UnigramModel
+// PyModelSnapshot - python object, n-grams of a model to be saved later
 //------------------------------------------------------------------------
-
-static PyObject *
-UnigramModel_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+class PyModelSnapshot
 {
-    PyUnigramModel *self;
+    public:
+        PyObject_HEAD
 
-    self = (PyUnigramModel *)type->tp_alloc(type, 0);
-    if (self != NULL) {
-        self = new(self) PyUnigramModel;   // placement new
-    }
-    return (PyObject *)self;
-}
+        ModelSnapshot snapshot;
+};
 
-static int
-UnigramModel_init(PyUnigramModel *self, PyObject *args, PyObject *kwds)
+static void
+ModelSnapshot_dealloc(PyModelSnapshot* self)
 {
-    return 0;
+    self->~PyModelSnapshot();   // call destructor
+    Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
-static void
-UnigramModel_dealloc(PyUnigramModel* self)
+// Write the model file. The GIL is released, snapshots are
+// meant to be saved by worker threads.
+static PyObject *
+ModelSnapshot_save(PyModelSnapshot* self, PyObject* args)
 {
-    self->~PyUnigramModel();   // call destructor
-    Py_TYPE(self)->tp_free((PyObject*)self);
+    char* filename = NULL;
+
+    if (!PyArg_ParseTuple(args, "s:save", &filename))
+        return NULL;
+
+    LMError e;
+    Py_BEGIN_ALLOW_THREADS;
+    e = self->snapshot.save(filename);
+    Py_END_ALLOW_THREADS;
+
+    if (check_error(e, filename))
+        return NULL;
+
+    Py_RETURN_NONE;
 }
 
+static PyMethodDef ModelSnapshot_methods[] = {
+    {"save", (PyCFunction)ModelSnapshot_save, METH_VARARGS,
+     ""
+    },
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject ModelSnapshotType = {
+    PyVarObject_HEAD_INIT(&PyType_Type, 0)
+    "lm.ModelSnapshot",             /*tp_name*/
+    sizeof(PyModelSnapshot),             /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor)ModelSnapshot_dealloc, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+    "ModelSnapshot objects",           /* tp_doc */
+    0,		               /* tp_traverse */
+    0,		               /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    ModelSnapshot_methods,     /* tp_methods */
+    0,                         /* tp_members */
+    0,                         /* tp_getset */
+    0,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,                         /* tp_init */
+    0,                         /* tp_alloc */
+    0,                         /* tp_new */
+};
+
+// Count the n-grams of a list of tokens. The GIL is released while
+// counting, so long texts don't block other python threads.
 static PyObject *
-UnigramModel_count_ngram(PyUnigramModel* self, PyObject* args)
+learn_tokens(DynamicModelBase* model, PyObject* args)
 {
-    PyObject* ngram = NULL;
-    int increment = 1;
+    PyObject* tokens = NULL;
     int allow_new_words = true;
 
-    if (! PyArg_ParseTuple(args, "O|II:count_ngram",
-              &ngram, &increment, &allow_new_words))
+    if (! PyArg_ParseTuple(args, "O|i:learn_tokens",
+              &tokens, &allow_new_words))
         return NULL;
 
     vector<wchar_t*> words;
-    if (!pyseqence_to_strings(ngram, words))
+    if (!pyseqence_to_strings(tokens, words))
         return NULL;
 
-    if (!(*self)->count_ngram(&words[0], words.size(),
-                              increment, allow_new_words))
-    {
-        PyErr_SetString(PyExc_MemoryError, "out of memory");
-        return NULL;
-    }
+    ModelGuard guard(model);
+    LMError err;
+    Py_BEGIN_ALLOW_THREADS;
+    err = model->learn_tokens(words, allow_new_words);
+    Py_END_ALLOW_THREADS;
 
     free_strings(words);
 
+    if (check_error(err))
+        return NULL;
+
     Py_RETURN_NONE;
 }
 
+// Add the n-gram counts of a binary model file to the model.
 static PyObject *
-UnigramModel_get_ngram_count(PyUnigramModel* self, PyObject* ngram)
+merge_binary(DynamicModelBase* model, PyObject* args)
 {
-    int n;
-    wchar_t** words = pyseqence_to_strings(ngram, &n);
-    if (!words)
+    char* filename = NULL;
+
+    if (!PyArg_ParseTuple(args, "s:merge_binary", &filename))
         return NULL;
 
-    int count = (*self)->get_ngram_count((const wchar_t**) words, n);
-    PyObject* result = PyInt_FromLong(count);
+    ModelGuard guard(model);
+    LMError err;
+    Py_BEGIN_ALLOW_THREADS;
+    err = model->merge_binary(filename);
+    Py_END_ALLOW_THREADS;
 
-    free_strings(words, n);
+    if (check_error(err, filename))
+        return NULL;
 
-    return result;
+    Py_RETURN_NONE;
+}
+
+
+// Get the DynamicModelBase of a python model object, NULL for
+// models without n-gram trie, e.g. merged models.
+static DynamicModelBase*
+to_dynamic_model_base(PyObject* object)
+{
+    if (!PyObject_TypeCheck(object, &LanguageModelType))
+        return NULL;
+    return dynamic_cast<DynamicModelBase*>(((PyLanguageModel*)object)->o);
+}
+
+// Build a dict of n-gram tuples and counts.
+static PyObject *
+ngram_counts_to_dict(DynamicModelBase* model,
+                     const vector<DynamicModelBase::NGramCount>& ngrams)
+{
+    PyObject* result = PyDict_New();
+    if (!result)
+        return NULL;
+
+    vector<DynamicModelBase::NGramCount>::const_iterator it;
+    for (it = ngrams.begin(); it != ngrams.end(); it++)
+    {
+        const vector<WordId>& wids = it->first;
+        PyObject* ongram = PyTuple_New(wids.size());
+        if (!ongram)
+        {
+            Py_DECREF(result);
+            return NULL;
+        }
+        for (int i=0; i<(int)wids.size(); i++)
+        {
+            const wchar_t* word = model->dictionary.id_to_word(wids[i]);
+            PyObject* oword = PyUnicode_FromWideChar(word, wcslen(word));
+            if (!oword)
+            {
+                Py_DECREF(ongram);
+                Py_DECREF(result);
+                return NULL;
+            }
+            PyTuple_SetItem(ongram, i, oword);
+        }
+
+        PyObject* ocount = PyInt_FromLong(it->second);
+        int error = !ocount || PyDict_SetItem(result, ongram, ocount);
+        Py_DECREF(ongram);
+        Py_XDECREF(ocount);
+        if (error)
+        {
+            Py_DECREF(result);
+            return NULL;
+        }
+    }
+
+    return result;
+}
+
+// Convert context words to word ids. Returns false if any of them
+// is unknown, such contexts can't be part of the model.
+static bool
+context_to_ids(DynamicModelBase* model, PyObject* ocontext,
+               vector<WordId>& context, bool& known)
+{
+    vector<wchar_t*> words;
+    if (!pyseqence_to_strings(ocontext, words))
+        return false;
+
+    known = true;
+    for (int i=0; i<(int)words.size(); i++)
+    {
+        WordId wid = model->dictionary.word_to_id(words[i]);
+        if (wid == WIDNONE)
+            known = false;
+        context.push_back(wid);
+    }
+
+    free_strings(words);
+    return true;
+}
+
+static PyObject *
+get_counts(DynamicModelBase* model)
+{
+    ModelGuard guard(model);
+    vector<int> counts;
+    vector<int> totals;
+
+    Py_BEGIN_ALLOW_THREADS;
+    model->get_counts(counts, totals);
+    Py_END_ALLOW_THREADS;
+
+    PyObject* ocounts = PyList_New(counts.size());
+    PyObject* ototals = PyList_New(totals.size());
+    if (!ocounts || !ototals)
+    {
+        Py_XDECREF(ocounts);
+        Py_XDECREF(ototals);
+        return NULL;
+    }
+    for (int i=0; i<(int)counts.size(); i++)
+    {
+        PyList_SetItem(ocounts, i, PyInt_FromLong(counts[i]));
+        PyList_SetItem(ototals, i, PyInt_FromLong(totals[i]));
+    }
+
+    return Py_BuildValue("(NN)", ocounts, ototals);
+}
+
+static PyObject *
+get_remove_context_changes(DynamicModelBase* model, PyObject* ocontext)
+{
+    ModelGuard guard(model);
+    vector<WordId> context;
+    bool known;
+    if (!context_to_ids(model, ocontext, context, known))
+        return NULL;
+
+    vector<DynamicModelBase::NGramCount> changes;
+    if (known)
+    {
+        Py_BEGIN_ALLOW_THREADS;
+        model->get_remove_context_changes(context, changes);
+        Py_END_ALLOW_THREADS;
+    }
+
+    return ngram_counts_to_dict(model, changes);
+}
+
+static PyObject *
+remove_context(DynamicModelBase* model, PyObject* ocontext)
+{
+    ModelGuard guard(model);
+    vector<WordId> context;
+    bool known;
+    if (!context_to_ids(model, ocontext, context, known))
+        return NULL;
+
+    vector<DynamicModelBase::NGramCount> changes;
+    if (known)
+    {
+        LMError err;
+        Py_BEGIN_ALLOW_THREADS;
+        err = model->remove_context(context, changes);
+        Py_END_ALLOW_THREADS;
+        if (check_error(err))
+            return NULL;
+    }
+
+    return ngram_counts_to_dict(model, changes);
+}
+
+// Count all n-grams in another model, optionally pruned.
+// The source may be a dynamic or a frozen model.
+template <class T>
+static PyObject *
+copy_ngrams(T* model, PyObject* args, bool prune)
+{
+    PyObject* odst = NULL;
+    PyObject* oprune_counts = NULL;
+
+    if (prune)
+    {
+        if (! PyArg_ParseTuple(args, "OO:prune_to", &odst, &oprune_counts))
+            return NULL;
+    }
+    else
+    {
+        if (! PyArg_ParseTuple(args, "O:copy_to", &odst))
+            return NULL;
+    }
+
+    DynamicModelBase* dst = to_dynamic_model_base(odst);
+    if (!dst)
+    {
+        PyErr_SetString(PyExc_TypeError,
+                        "destination must be a dynamic or unigram model");
+        return NULL;
+    }
+    if ((LanguageModel*)dst == (LanguageModel*)model)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                        "destination must not be the source model");
+        return NULL;
+    }
+
+    vector<int> prune_counts;
+    if (prune)
+    {
+        if (!PySequence_Check(oprune_counts))
+        {
+            PyErr_SetString(PyExc_ValueError, "expected sequence type");
+            return NULL;
+        }
+        int n = PySequence_Length(oprune_counts);
+        for (int i=0; i<n; i++)
+        {
+            PyObject* item = PySequence_GetItem(oprune_counts, i);
+            long count = item ? PyInt_AsLong(item) : -1;
+            Py_XDECREF(item);
+            if (PyErr_Occurred())
+                return NULL;
+            prune_counts.push_back(count);
+        }
+    }
+
+    ModelGuard guard(model, dst);
+    LMError err;
+    Py_BEGIN_ALLOW_THREADS;
+    if (prune)
+        err = model->prune_to(dst, prune_counts);
+    else
+        err = model->copy_to(dst);
+    Py_END_ALLOW_THREADS;
+
+    if (check_error(err))
+        return NULL;
+
+    Py_RETURN_NONE;
+}
+
+// Copy all n-grams for saving them without blocking the model.
+static PyObject *
+take_snapshot(DynamicModelBase* model)
+{
+    PyModelSnapshot* snapshot = (PyModelSnapshot*)
+        ModelSnapshotType.tp_alloc(&ModelSnapshotType, 0);
+    if (!snapshot)
+        return NULL;
+    snapshot = new(snapshot) PyModelSnapshot;   // placement new, keeps
+                                                // the object header
+
+    ModelGuard guard(model);
+    model->take_snapshot(snapshot->snapshot);
+
+    return (PyObject*) snapshot;
+}
+
+
+//------------------------------------------------------------------------
+// UnigramModel - python interface for UnigramModel
+//------------------------------------------------------------------------
+
+static PyObject *
+UnigramModel_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    PyUnigramModel *self;
+
+    self = (PyUnigramModel *)type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self = new(self) PyUnigramModel;   // placement new
+    }
+    return (PyObject *)self;
+}
+
+static int
+UnigramModel_init(PyUnigramModel *self, PyObject *args, PyObject *kwds)
+{
+    return 0;
+}
+
+static void
+UnigramModel_dealloc(PyUnigramModel* self)
+{
+    self->~PyUnigramModel();   // call destructor
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject *
+UnigramModel_count_ngram(PyUnigramModel* self, PyObject* args)
+{
+    PyObject* ngram = NULL;
+    int increment = 1;
+    int allow_new_words = true;
+
+    if (! PyArg_ParseTuple(args, "O|II:count_ngram",
+              &ngram, &increment, &allow_new_words))
+        return NULL;
+
+    vector<wchar_t*> words;
+    if (!pyseqence_to_strings(ngram, words))
+        return NULL;
+
+    ModelGuard guard(self->o);
+    if (!(*self)->count_ngram(&words[0], words.size(),
+                              increment, allow_new_words))
+    {
+        PyErr_SetString(PyExc_MemoryError, "out of memory");
+        return NULL;
+    }
+
+    free_strings(words);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+UnigramModel_learn_tokens(PyUnigramModel* self, PyObject* args)
+{
+    return learn_tokens(self->o, args);
+}
+
+static PyObject *
+UnigramModel_get_counts(PyUnigramModel* self)
+{
+    return get_counts(self->o);
+}
+
+static PyObject *
+UnigramModel_get_remove_context_changes(PyUnigramModel* self, PyObject* context)
+{
+    return get_remove_context_changes(self->o, context);
+}
+
+static PyObject *
+UnigramModel_remove_context(PyUnigramModel* self, PyObject* context)
+{
+    return remove_context(self->o, context);
+}
+
+static PyObject *
+UnigramModel_copy_to(PyUnigramModel* self, PyObject* args)
+{
+    return copy_ngrams(self->o, args, false);
+}
+
+static PyObject *
+UnigramModel_prune_to(PyUnigramModel* self, PyObject* args)
+{
+    return copy_ngrams(self->o, args, true);
+}
+
+static PyObject *
+UnigramModel_snapshot(PyUnigramModel* self)
+{
+    return take_snapshot(self->o);
+}
+
+static PyObject *
+UnigramModel_get_ngram_count(PyUnigramModel* self, PyObject* ngram)
+{
+    int n;
+    wchar_t** words = pyseqence_to_strings(ngram, &n);
+    if (!words)
+        return NULL;
+
+    ModelGuard guard(self->o);
+    int count = (*self)->get_ngram_count((const wchar_t**) words, n);
+    PyObject* result = PyInt_FromLong(count);
+
+    free_strings(words, n);
+
+    return result;
 }
 
 static PyObject *
 UnigramModel_memory_size(PyUnigramModel* self)
 {
+    ModelGuard guard(self->o);
     vector<long> values;
     (*self)->get_memory_sizes(values);
 
@@ -967,10 +1697,32 @@ UnigramModel_memory_size(PyUnigramModel* self)
     return result;
 }
 
+static PyObject *
+UnigramModel_merge_binary(PyUnigramModel *self, PyObject *args)
+{
+    return merge_binary(self->o, args);
+}
+
+static PyObject *
+UnigramModel_save_binary(PyUnigramModel *self, PyObject *args)
+{
+    char* filename = NULL;
+
+    if (!PyArg_ParseTuple(args, "s:save_binary", &filename))
+        return NULL;
+
+    ModelGuard guard(self->o);
+    if (check_error((*self)->save_binary(filename), filename))
+        return NULL;
+
+    Py_RETURN_NONE;
+}
+
 // returns an object implementing pythons iterator interface
 static PyObject *
 UnigramModel_iter_ngrams(PyUnigramModel *self)
 {
+    ModelGuard guard(self->o);
     NGramIter* iter = PyObject_New(NGramIter, &NGramIterType);
     if (!iter)
         return NULL;
@@ -1006,6 +1758,28 @@ static PyMethodDef UnigramModel_methods[] = {
     {"count_ngram", (PyCFunction)UnigramModel_count_ngram, METH_VARARGS,
      ""
     },
+    {"learn_tokens", (PyCFunction)UnigramModel_learn_tokens, METH_VARARGS,
+     ""
+    },
+    {"get_counts", (PyCFunction)UnigramModel_get_counts, METH_NOARGS,
+     ""
+    },
+    {"get_remove_context_changes",
+     (PyCFunction)UnigramModel_get_remove_context_changes, METH_O,
+     ""
+    },
+    {"remove_context", (PyCFunction)UnigramModel_remove_context, METH_O,
+     ""
+    },
+    {"copy_to", (PyCFunction)UnigramModel_copy_to, METH_VARARGS,
+     ""
+    },
+    {"prune_to", (PyCFunction)UnigramModel_prune_to, METH_VARARGS,
+     ""
+    },
+    {"snapshot", (PyCFunction)UnigramModel_snapshot, METH_NOARGS,
+     ""
+    },
     {"get_ngram_count", (PyCFunction)UnigramModel_get_ngram_count, METH_O,
      ""
     },
@@ -1015,6 +1789,12 @@ static PyMethodDef UnigramModel_methods[] = {
     {"memory_size", (PyCFunction)UnigramModel_memory_size, METH_NOARGS,
      ""
     },
+    {"save_binary", (PyCFunction)UnigramModel_save_binary, METH_VARARGS,
+     ""
+    },
+    {"merge_binary", (PyCFunction)UnigramModel_merge_binary, METH_VARARGS,
+     ""
+    },
     {NULL}  /* Sentinel */
 };
 
@@ -1128,6 +1908,7 @@ DynamicModel_count_ngram(PyDynamicModel* self, PyObject* args)
     if (!pyseqence_to_strings(ngram, words))
         return NULL;
 
+    ModelGuard guard(self->o);
     if (!(*self)->count_ngram(&words[0], words.size(),
                               increment, allow_new_words))
     {
@@ -1140,6 +1921,48 @@ DynamicModel_count_ngram(PyDynamicModel* self, PyObject* args)
     Py_RETURN_NONE;
 }
 
+static PyObject *
+DynamicModel_learn_tokens(PyDynamicModel* self, PyObject* args)
+{
+    return learn_tokens(self->o, args);
+}
+
+static PyObject *
+DynamicModel_get_counts(PyDynamicModel* self)
+{
+    return get_counts(self->o);
+}
+
+static PyObject *
+DynamicModel_get_remove_context_changes(PyDynamicModel* self, PyObject* context)
+{
+    return get_remove_context_changes(self->o, context);
+}
+
+static PyObject *
+DynamicModel_remove_context(PyDynamicModel* self, PyObject* context)
+{
+    return remove_context(self->o, context);
+}
+
+static PyObject *
+DynamicModel_copy_to(PyDynamicModel* self, PyObject* args)
+{
+    return copy_ngrams(self->o, args, false);
+}
+
+static PyObject *
+DynamicModel_prune_to(PyDynamicModel* self, PyObject* args)
+{
+    return copy_ngrams(self->o, args, true);
+}
+
+static PyObject *
+DynamicModel_snapshot(PyDynamicModel* self)
+{
+    return take_snapshot(self->o);
+}
+
 static PyObject *
 DynamicModel_get_ngram_count(PyDynamicModel* self, PyObject* ngram)
 {
@@ -1148,6 +1971,7 @@ DynamicModel_get_ngram_count(PyDynamicModel* self, PyObject* ngram)
     if (!words)
         return NULL;
 
+    ModelGuard guard(self->o);
     int count = (*self)->get_ngram_count((const wchar_t**) words, n);
     PyObject* result = PyInt_FromLong(count);
 
@@ -1159,6 +1983,7 @@ DynamicModel_get_ngram_count(PyDynamicModel* self, PyObject* ngram)
 static PyObject *
 DynamicModel_memory_size(PyDynamicModel* self)
 {
+    ModelGuard guard(self->o);
     vector<long> values;
     (*self)->get_memory_sizes(values);
 
@@ -1174,10 +1999,32 @@ DynamicModel_memory_size(PyDynamicModel* self)
     return result;
 }
 
+static PyObject *
+DynamicModel_merge_binary(PyDynamicModel *self, PyObject *args)
+{
+    return merge_binary(self->o, args);
+}
+
+static PyObject *
+DynamicModel_save_binary(PyDynamicModel *self, PyObject *args)
+{
+    char* filename = NULL;
+
+    if (!PyArg_ParseTuple(args, "s:save_binary", &filename))
+        return NULL;
+
+    ModelGuard guard(self->o);
+    if (check_error((*self)->save_binary(filename), filename))
+        return NULL;
+
+    Py_RETURN_NONE;
+}
+
 // returns an object implementing pythons iterator interface
 static PyObject *
 DynamicModel_iter_ngrams(PyDynamicModel *self)
 {
+    ModelGuard guard(self->o);
     NGramIter* iter = PyObject_New(NGramIter, &NGramIterType);
     if (!iter)
         return NULL;
@@ -1206,6 +2053,7 @@ DynamicModel_set_order(PyDynamicModel *self, PyObject *value, void *closure)
         return -1;
     }
 
+    ModelGuard guard(self->o);
     if (!set_order(self, order))
         return -2;
 
@@ -1298,6 +2146,7 @@ DynamicModel_set_smoothing(PyDynamicModel *self, PyObject *value, void *closure)
         return -1;
     }
 
+    ModelGuard guard(self->o);
     (*self)->set_smoothing(sm);
 
     return 0;
@@ -1324,6 +2173,28 @@ static PyMethodDef DynamicModel_methods[] = {
     {"count_ngram", (PyCFunction)DynamicModel_count_ngram, METH_VARARGS,
      ""
     },
+    {"learn_tokens", (PyCFunction)DynamicModel_learn_tokens, METH_VARARGS,
+     ""
+    },
+    {"get_counts", (PyCFunction)DynamicModel_get_counts, METH_NOARGS,
+     ""
+    },
+    {"get_remove_context_changes",
+     (PyCFunction)DynamicModel_get_remove_context_changes, METH_O,
+     ""
+    },
+    {"remove_context", (PyCFunction)DynamicModel_remove_context, METH_O,
+     ""
+    },
+    {"copy_to", (PyCFunction)DynamicModel_copy_to, METH_VARARGS,
+     ""
+    },
+    {"prune_to", (PyCFunction)DynamicModel_prune_to, METH_VARARGS,
+     ""
+    },
+    {"snapshot", (PyCFunction)DynamicModel_snapshot, METH_NOARGS,
+     ""
+    },
     {"get_ngram_count", (PyCFunction)DynamicModel_get_ngram_count, METH_O,
      ""
     },
@@ -1333,6 +2204,12 @@ static PyMethodDef DynamicModel_methods[] = {
     {"memory_size", (PyCFunction)DynamicModel_memory_size, METH_NOARGS,
      ""
     },
+    {"save_binary", (PyCFunction)DynamicModel_save_binary, METH_VARARGS,
+     ""
+    },
+    {"merge_binary", (PyCFunction)DynamicModel_merge_binary, METH_VARARGS,
+     ""
+    },
     {NULL}  /* Sentinel */
 };
 
@@ -1491,83 +2368,284 @@ CachedDynamicModel_set_recency_halflife(PyCachedDynamicModel *self, PyObject *va
         Py_DECREF(o);
     }
 
-    if (halflife <= 0)
+    if (halflife <= 0)
+    {
+        PyErr_SetString(PyExc_ValueError,
+                         "The value must be greater than zero");
+        return -1;
+    }
+
+    ModelGuard guard(self->o);
+    (*self)->set_recency_halflife(halflife);
+
+    return 0;
+}
+
+static PyObject *
+CachedDynamicModel_get_recency_lambdas(PyCachedDynamicModel *self, void *closure)
+{
+    vector<double> lambdas;
+    (*self)->get_recency_lambdas(lambdas);
+
+    PyObject* otuple = PyTuple_New(lambdas.size());
+    for (int i = 0; i<(int)lambdas.size(); i++)
+        PyTuple_SetItem(otuple, i, PyFloat_FromDouble(lambdas[i]));
+    return otuple;
+}
+
+static int
+CachedDynamicModel_set_recency_lambdas(PyCachedDynamicModel *self, PyObject *value, void *closure)
+{
+    vector<double> lambdas;
+    if (!pyseqence_to_doubles(value, lambdas))
+    {
+        PyErr_SetString(PyExc_ValueError, "list of numbers expected");
+        return false;
+    }
+
+    ModelGuard guard(self->o);
+    (*self)->set_recency_lambdas(lambdas);
+
+    return 0;
+}
+
+static PyObject *
+CachedDynamicModel_get_recency_ratio(PyCachedDynamicModel *self, void *closure)
+{
+    return PyFloat_FromDouble((*self)->get_recency_ratio());
+}
+
+static int
+CachedDynamicModel_set_recency_ratio(PyCachedDynamicModel *self, PyObject *value, void *closure)
+{
+    double recency_ratio = PyFloat_AsDouble(value);
+    if (recency_ratio < 0.0 || recency_ratio > 1.0)
+    {
+        PyErr_SetString(PyExc_ValueError, "value must be in the range [0..1]");
+        return -1;
+    }
+
+    ModelGuard guard(self->o);
+    (*self)->set_recency_ratio(recency_ratio);
+
+    return 0;
+}
+
+static PyObject *
+CachedDynamicModel_get_recency_smoothing(PyCachedDynamicModel *self, void *closure)
+{
+    const wchar_t* s = smoothing_to_string((*self)->get_recency_smoothing());
+    if (s)
+        return PyUnicode_FromWideChar(s, wcslen(s));
+    Py_RETURN_NONE;
+}
+
+static int
+CachedDynamicModel_set_recency_smoothing(PyCachedDynamicModel *self, PyObject *value, void *closure)
+{
+    Smoothing sm = pystring_to_smoothing(value);
+    if (!sm)
+        return -1;
+
+    vector<Smoothing> smoothings = (*self)->get_recency_smoothings();
+    if (!count(smoothings.begin(), smoothings.end(), sm))
+    {
+        PyErr_SetString(PyExc_ValueError, "unsupported smoothing option, "
+                                          "try a different model type");
+        return -1;
+    }
+
+    ModelGuard guard(self->o);
+    (*self)->set_recency_smoothing(sm);
+
+    return 0;
+}
+
+static PyGetSetDef CachedDynamicModel_getsetters[] = {
+    {(char*)"recency_halflife",
+     (getter)CachedDynamicModel_get_recency_halflife, (setter)CachedDynamicModel_set_recency_halflife,
+     (char*)"halflife of exponential falloff in number of recently used words"
+            " until w=0.5",
+     NULL},
+    {(char*)"recency_lambdas",
+     (getter)CachedDynamicModel_get_recency_lambdas, (setter)CachedDynamicModel_set_recency_lambdas,
+     (char*)"jelinec-mercer smoothing weights, one per order",
+     NULL},
+    {(char*)"recency_ratio",
+     (getter)CachedDynamicModel_get_recency_ratio, (setter)CachedDynamicModel_set_recency_ratio,
+     (char*)"ratio of recency-based to count-based probabilities",
+     NULL},
+    {(char*)"recency_smoothing",
+     (getter)CachedDynamicModel_get_recency_smoothing, (setter)CachedDynamicModel_set_recency_smoothing,
+     (char*)"ngram recency smoothing: "
+            "'jelinec-mercer' (default) or 'witten-bell'",
+     NULL},
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject CachedDynamicModelType = {
+    PyVarObject_HEAD_INIT(&PyType_Type, 0)
+    "lm.CachedDynamicModel",             /*tp_name*/
+    sizeof(PyCachedDynamicModel),             /*tp_basicsize*/
+    0,                         /*tp_itemsize*/
+    (destructor)CachedDynamicModel_dealloc, /*tp_dealloc*/
+    0,                         /*tp_print*/
+    0,                         /*tp_getattr*/
+    0,                         /*tp_setattr*/
+    0,                         /*tp_compare*/
+    0,                         /*tp_repr*/
+    0,                         /*tp_as_number*/
+    0,                         /*tp_as_sequence*/
+    0,                         /*tp_as_mapping*/
+    0,                         /*tp_hash */
+    0,                         /*tp_call*/
+    0,                         /*tp_str*/
+    0,                         /*tp_getattro*/
+    0,                         /*tp_setattro*/
+    0,                         /*tp_as_buffer*/
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
+    "CachedDynamicModel objects",           /* tp_doc */
+    0,		               /* tp_traverse */
+    0,		               /* tp_clear */
+    0,		               /* tp_richcompare */
+    0,		               /* tp_weaklistoffset */
+    0,		               /* tp_iter */
+    0,		               /* tp_iternext */
+    0,     /* tp_methods */
+    0,     /* tp_members */
+    CachedDynamicModel_getsetters,   /* tp_getset */
+    &DynamicModelKNType,                         /* tp_base */
+    0,                         /* tp_dict */
+    0,                         /* tp_descr_get */
+    0,                         /* tp_descr_set */
+    0,                         /* tp_dictoffset */
+    0,      /* tp_init */
+    0,                         /* tp_alloc */
+    CachedDynamicModel_new,                 /* tp_new */
+};
+
+
+//------------------------------------------------------------------------
+// FrozenModel - python interface for FrozenModel
+//------------------------------------------------------------------------
+
+static PyObject *
+FrozenModel_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
+{
+    PyFrozenModel *self;
+
+    self = (PyFrozenModel *)type->tp_alloc(type, 0);
+    if (self != NULL) {
+        self = new(self) PyFrozenModel;   // placement new
+    }
+    return (PyObject *)self;
+}
+
+static void
+FrozenModel_dealloc(PyFrozenModel* self)
+{
+    self->~PyFrozenModel();   // call destructor
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static PyObject *
+FrozenModel_freeze(PyFrozenModel* self, PyObject* args)
+{
+    PyObject* omodel = NULL;
+
+    if (! PyArg_ParseTuple(args, "O:freeze", &omodel))
+        return NULL;
+
+    DynamicModelBase* model = to_dynamic_model_base(omodel);
+    if (!model)
     {
-        PyErr_SetString(PyExc_ValueError,
-                         "The value must be greater than zero");
-        return -1;
+        PyErr_SetString(PyExc_TypeError,
+                        "source must be a dynamic or unigram model");
+        return NULL;
     }
 
-    (*self)->set_recency_halflife(halflife);
+    ModelGuard guard(self->o, model);
+    LMError err;
+    Py_BEGIN_ALLOW_THREADS;
+    err = (*self)->freeze(model);
+    Py_END_ALLOW_THREADS;
+    if (check_error(err))
+        return NULL;
 
-    return 0;
+    Py_RETURN_NONE;
 }
 
 static PyObject *
-CachedDynamicModel_get_recency_lambdas(PyCachedDynamicModel *self, void *closure)
+FrozenModel_copy_to(PyFrozenModel* self, PyObject* args)
 {
-    vector<double> lambdas;
-    (*self)->get_recency_lambdas(lambdas);
+    return copy_ngrams(self->o, args, false);
+}
 
-    PyObject* otuple = PyTuple_New(lambdas.size());
-    for (int i = 0; i<(int)lambdas.size(); i++)
-        PyTuple_SetItem(otuple, i, PyFloat_FromDouble(lambdas[i]));
-    return otuple;
+static PyObject *
+FrozenModel_prune_to(PyFrozenModel* self, PyObject* args)
+{
+    return copy_ngrams(self->o, args, true);
 }
 
-static int
-CachedDynamicModel_set_recency_lambdas(PyCachedDynamicModel *self, PyObject *value, void *closure)
+static PyObject *
+FrozenModel_get_ngram_count(PyFrozenModel* self, PyObject* ngram)
 {
-    vector<double> lambdas;
-    if (!pyseqence_to_doubles(value, lambdas))
-    {
-        PyErr_SetString(PyExc_ValueError, "list of numbers expected");
-        return false;
-    }
+    int n;
+    wchar_t** words = pyseqence_to_strings(ngram, &n);
+    if (!words)
+        return NULL;
 
-    (*self)->set_recency_lambdas(lambdas);
+    ModelGuard guard(self->o);
+    int count = (*self)->get_ngram_count((const wchar_t**) words, n);
+    PyObject* result = PyInt_FromLong(count);
 
-    return 0;
+    free_strings(words, n);
+
+    return result;
 }
 
 static PyObject *
-CachedDynamicModel_get_recency_ratio(PyCachedDynamicModel *self, void *closure)
+FrozenModel_memory_size(PyFrozenModel* self)
 {
-    return PyFloat_FromDouble((*self)->get_recency_ratio());
-}
+    ModelGuard guard(self->o);
+    vector<long> values;
+    (*self)->get_memory_sizes(values);
 
-static int
-CachedDynamicModel_set_recency_ratio(PyCachedDynamicModel *self, PyObject *value, void *closure)
-{
-    double recency_ratio = PyFloat_AsDouble(value);
-    if (recency_ratio < 0.0 || recency_ratio > 1.0)
+    PyObject* result = PyTuple_New(values.size());
+    if (!result)
     {
-        PyErr_SetString(PyExc_ValueError, "value must be in the range [0..1]");
-        return -1;
+        PyErr_SetString(PyExc_MemoryError, "failed to allocate tuple");
+        return NULL;
     }
+    for (int i=0; i<(int)values.size(); i++)
+        PyTuple_SetItem(result, i, PyInt_FromLong(values[i]));
 
-    (*self)->set_recency_ratio(recency_ratio);
+    return result;
+}
 
-    return 0;
+static PyObject *
+FrozenModel_get_order(PyFrozenModel *self, void *closure)
+{
+    return PyInt_FromLong((*self)->get_order());
 }
 
 static PyObject *
-CachedDynamicModel_get_recency_smoothing(PyCachedDynamicModel *self, void *closure)
+FrozenModel_get_smoothing(PyFrozenModel *self, void *closure)
 {
-    const wchar_t* s = smoothing_to_string((*self)->get_recency_smoothing());
+    const wchar_t* s = smoothing_to_string((*self)->get_smoothing());
     if (s)
         return PyUnicode_FromWideChar(s, wcslen(s));
     Py_RETURN_NONE;
 }
 
 static int
-CachedDynamicModel_set_recency_smoothing(PyCachedDynamicModel *self, PyObject *value, void *closure)
+FrozenModel_set_smoothing(PyFrozenModel *self, PyObject *value, void *closure)
 {
     Smoothing sm = pystring_to_smoothing(value);
     if (!sm)
         return -1;
 
-    vector<Smoothing> smoothings = (*self)->get_recency_smoothings();
+    vector<Smoothing> smoothings = (*self)->get_smoothings();
     if (!count(smoothings.begin(), smoothings.end(), sm))
     {
         PyErr_SetString(PyExc_ValueError, "unsupported smoothing option, "
@@ -1575,39 +2653,72 @@ CachedDynamicModel_set_recency_smoothing(PyCachedDynamicModel *self, PyObject *v
         return -1;
     }
 
-    (*self)->set_recency_smoothing(sm);
+    ModelGuard guard(self->o);
+    (*self)->set_smoothing(sm);
 
     return 0;
 }
 
-static PyGetSetDef CachedDynamicModel_getsetters[] = {
-    {(char*)"recency_halflife",
-     (getter)CachedDynamicModel_get_recency_halflife, (setter)CachedDynamicModel_set_recency_halflife,
-     (char*)"halflife of exponential falloff in number of recently used words"
-            " until w=0.5",
-     NULL},
-    {(char*)"recency_lambdas",
-     (getter)CachedDynamicModel_get_recency_lambdas, (setter)CachedDynamicModel_set_recency_lambdas,
-     (char*)"jelinec-mercer smoothing weights, one per order",
+static PyObject *
+FrozenModel_get_precompute(PyFrozenModel *self, void *closure)
+{
+    return PyBool_FromLong((*self)->get_precompute());
+}
+
+static int
+FrozenModel_set_precompute(PyFrozenModel *self, PyObject *value, void *closure)
+{
+    int precompute = PyObject_IsTrue(value);
+    if (precompute < 0)
+        return -1;
+
+    ModelGuard guard(self->o);
+    (*self)->set_precompute(precompute);
+
+    return 0;
+}
+
+static PyGetSetDef FrozenModel_getsetters[] = {
+    {(char*)"order",
+     (getter)FrozenModel_get_order, NULL,
+     (char*)"order of the language model, read-only",
      NULL},
-    {(char*)"recency_ratio",
-     (getter)CachedDynamicModel_get_recency_ratio, (setter)CachedDynamicModel_set_recency_ratio,
-     (char*)"ratio of recency-based to count-based probabilities",
+    {(char*)"smoothing",
+     (getter)FrozenModel_get_smoothing, (setter)FrozenModel_set_smoothing,
+     (char*)"ngram smoothing: 'abs-disc' (default) or 'witten-bell'",
      NULL},
-    {(char*)"recency_smoothing",
-     (getter)CachedDynamicModel_get_recency_smoothing, (setter)CachedDynamicModel_set_recency_smoothing,
-     (char*)"ngram recency smoothing: "
-            "'jelinec-mercer' (default) or 'witten-bell'",
+    {(char*)"precompute",
+     (getter)FrozenModel_get_precompute, (setter)FrozenModel_set_precompute,
+     (char*)"store smoothed probabilities for faster predictions",
      NULL},
     {NULL}  /* Sentinel */
 };
 
-static PyTypeObject CachedDynamicModelType = {
+static PyMethodDef FrozenModel_methods[] = {
+    {"freeze", (PyCFunction)FrozenModel_freeze, METH_VARARGS,
+     ""
+    },
+    {"copy_to", (PyCFunction)FrozenModel_copy_to, METH_VARARGS,
+     ""
+    },
+    {"prune_to", (PyCFunction)FrozenModel_prune_to, METH_VARARGS,
+     ""
+    },
+    {"get_ngram_count", (PyCFunction)FrozenModel_get_ngram_count, METH_O,
+     ""
+    },
+    {"memory_size", (PyCFunction)FrozenModel_memory_size, METH_NOARGS,
+     ""
+    },
+    {NULL}  /* Sentinel */
+};
+
+static PyTypeObject FrozenModelType = {
     PyVarObject_HEAD_INIT(&PyType_Type, 0)
-    "lm.CachedDynamicModel",             /*tp_name*/
-    sizeof(PyCachedDynamicModel),             /*tp_basicsize*/
+    "lm.FrozenModel",             /*tp_name*/
+    sizeof(PyFrozenModel),             /*tp_basicsize*/
     0,                         /*tp_itemsize*/
-    (destructor)CachedDynamicModel_dealloc, /*tp_dealloc*/
+    (destructor)FrozenModel_dealloc, /*tp_dealloc*/
     0,                         /*tp_print*/
     0,                         /*tp_getattr*/
     0,                         /*tp_setattr*/
@@ -1623,24 +2734,24 @@ static PyTypeObject CachedDynamicModelType = {
     0,                         /*tp_setattro*/
     0,                         /*tp_as_buffer*/
     Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
-    "CachedDynamicModel objects",           /* tp_doc */
+    "FrozenModel objects",           /* tp_doc */
     0,		               /* tp_traverse */
     0,		               /* tp_clear */
     0,		               /* tp_richcompare */
     0,		               /* tp_weaklistoffset */
     0,		               /* tp_iter */
     0,		               /* tp_iternext */
-    0,     /* tp_methods */
+    FrozenModel_methods,     /* tp_methods */
     0,     /* tp_members */
-    CachedDynamicModel_getsetters,   /* tp_getset */
-    &DynamicModelKNType,                         /* tp_base */
+    FrozenModel_getsetters,   /* tp_getset */
+    &LanguageModelType,                         /* tp_base */
     0,                         /* tp_dict */
     0,                         /* tp_descr_get */
     0,                         /* tp_descr_set */
     0,                         /* tp_dictoffset */
     0,      /* tp_init */
     0,                         /* tp_alloc */
-    CachedDynamicModel_new,                 /* tp_new */
+    FrozenModel_new,                 /* tp_new */
 };
 
 
@@ -1655,7 +2766,36 @@ OverlayModel_dealloc(PyOverlayModel* self)
     Py_TYPE(self)->tp_free((PyObject*)self);
 }
 
+static PyObject *
+OverlayModel_set_lookup_models(PyOverlayModel* self, PyObject* value)
+{
+    vector<PyLanguageModel*> models;
+    if (!pyseqence_to_objects(value, models, &LanguageModelType))
+        return NULL;
+
+    // Only components are kept alive by the overlay.
+    vector<LanguageModel*> cmodels;
+    for (int i=0; i<(int)models.size(); i++)
+    {
+        if (find(self->references.begin(), self->references.end(),
+                 models[i]) == self->references.end())
+        {
+            PyErr_SetString(PyExc_ValueError,
+                            "lookup models must be components of the overlay");
+            return NULL;
+        }
+        cmodels.push_back(models[i]->o);
+    }
+    ModelGuard guard(self->o);
+    (*self)->set_lookup_models(cmodels);
+
+    Py_RETURN_NONE;
+}
+
 static PyMethodDef OverlayModel_methods[] = {
+    {"set_lookup_models", (PyCFunction)OverlayModel_set_lookup_models, METH_O,
+     "Limit word lookups, e.g. of PREFER_LOWER_CASE, to the given components."
+    },
     {NULL}  /* Sentinel */
 };
 
@@ -1928,6 +3068,270 @@ loglinint(PyDynamicModel *self, PyObject* args)
     return (PyObject*) model;
 }
 
+// Steps of a simulated typing session, one per character of a sentence,
+// converted from python. Consecutive steps usually share their history.
+class TypingSteps
+{
+    public:
+        struct Step
+        {
+            int history;
+            wchar_t* prefix;
+            wchar_t* target;
+        };
+
+        ~TypingSteps()
+        {
+            for (int i=0; i<(int)histories.size(); i++)
+                free_strings(histories[i]);
+            for (int i=0; i<(int)steps.size(); i++)
+            {
+                PyMem_Free(steps[i].prefix);
+                PyMem_Free(steps[i].target);
+            }
+        }
+
+        // Convert a sequence of (history, prefix, target) tuples.
+        bool set(PyObject* osteps)
+        {
+            if (!PySequence_Check(osteps))
+            {
+                PyErr_SetString(PyExc_ValueError, "expected sequence type");
+                return false;
+            }
+
+            PyObject* olast_history = NULL;
+            int n = PySequence_Length(osteps);
+            for (int i=0; i<n; i++)
+            {
+                PyObject* ostep = PySequence_GetItem(osteps, i);
+                if (!ostep)
+                    return false;
+
+                PyObject* ohistory = NULL;
+                PyObject* oprefix = NULL;
+                PyObject* otarget = NULL;
+                bool ok = PyArg_ParseTuple(ostep, "OOO:simulate_typing",
+                                           &ohistory, &oprefix, &otarget);
+                if (ok && ohistory != olast_history)
+                {
+                    vector<wchar_t*> history;
+                    ok = pyseqence_to_strings(ohistory, history);
+                    if (ok)
+                        histories.push_back(history);
+                    olast_history = ohistory;
+                }
+                if (ok)
+                {
+                    Step step = {(int)histories.size()-1, NULL, NULL};
+                    step.prefix = pyunicode_to_wstr(oprefix);
+                    step.target = pyunicode_to_wstr(otarget);
+                    steps.push_back(step);
+                    ok = step.prefix && step.target;
+                }
+                Py_DECREF(ostep);
+                if (!ok)
+                    return false;
+            }
+            return true;
+        }
+
+        vector< vector<wchar_t*> > histories;
+        vector<Step> steps;
+};
+
+// Simulate typing a sentence with word completion, the inner loop of
+// the keystroke savings rate evaluation. Steps hold context and word to
+// complete for each cursor position. A word is accepted as soon as
+// query_model predicts it, otherwise the next character is typed.
+// learn_model learns the tokens of the sentence afterwards.
+// Returns a tuple (total_chars, pressed_keys).
+static PyObject *
+simulate_typing(PyObject *self, PyObject* args)
+{
+    PyObject* oquery_model = NULL;
+    PyObject* olearn_model = NULL;
+    PyObject* osteps = NULL;
+    PyObject* otokens = NULL;
+    int limit = -1;
+
+    if (!PyArg_ParseTuple(args, "O!OOO|i:simulate_typing",
+                          &LanguageModelType, &oquery_model,
+                          &olearn_model, &osteps, &otokens, &limit))
+        return NULL;
+
+    LanguageModel* query_model = ((PyLanguageModel*)oquery_model)->o;
+    DynamicModelBase* learn_model = NULL;
+    if (olearn_model != Py_None)
+    {
+        learn_model = to_dynamic_model_base(olearn_model);
+        if (!learn_model)
+        {
+            PyErr_SetString(PyExc_TypeError,
+                            "learn_model must be a dynamic or unigram model");
+            return NULL;
+        }
+    }
+
+    TypingSteps typing_steps;
+    if (!typing_steps.set(osteps))
+        return NULL;
+
+    vector<wchar_t*> tokens;
+    if (!pyseqence_to_strings(otokens, tokens))
+        return NULL;
+
+    ModelGuard guard(query_model, learn_model);
+    long total_chars = 0;
+    long pressed_keys = 0;
+    LMError err = ERR_NONE;
+
+    Py_BEGIN_ALLOW_THREADS;
+    const vector<TypingSteps::Step>& steps = typing_steps.steps;
+    int num_steps = steps.size();
+    PredictionCache cache;
+    vector<LanguageModel::Result> results;
+    vector<wchar_t*> context;
+
+    int cursor = 0;
+    while (cursor < num_steps)
+    {
+        const TypingSteps::Step& step = steps[cursor];
+        context = typing_steps.histories[step.history];
+        context.push_back(step.prefix);
+        query_model->predict(results, context, limit, 0, &cache);
+
+        int added_chars = 1;
+        for (int i=0; i<(int)results.size(); i++)
+            if (results[i].word == step.target)
+            {
+                added_chars = wcslen(step.target) - wcslen(step.prefix);
+                break;
+            }
+        // still right after the insertion point? continue
+        // with the next character
+        added_chars = max(1, min(added_chars, num_steps - cursor));
+
+        cursor += added_chars;
+        total_chars += added_chars;
+        pressed_keys++;
+    }
+
+    if (learn_model)
+        err = learn_model->learn_tokens(tokens);
+    Py_END_ALLOW_THREADS;
+
+    free_strings(tokens);
+
+    if (check_error(err))
+        return NULL;
+
+    return Py_BuildValue("(ll)", total_chars, pressed_keys);
+}
+
+
+//------------------------------------------------------------------------
+// Tokenizer
+//------------------------------------------------------------------------
+
+// Convert tokens to the ([token, ...], [[begin, end], ...]) results
+// of tokenize_text().
+static PyObject *
+tokens_to_python(PyObject* text, const vector<Tokenizer::Token>& tokens)
+{
+    PyObject* markers[] = {NULL,
+                           PyUnicode_FromString("<num>"),
+                           PyUnicode_FromString("<unk>"),
+                           PyUnicode_FromString("<s>"),
+                           PyUnicode_FromString("")};
+    PyObject* otokens = PyList_New(tokens.size());
+    PyObject* ospans = PyList_New(tokens.size());
+    PyObject* result = NULL;
+
+    if (markers[1] && markers[2] && markers[3] && markers[4] &&
+        otokens && ospans)
+    {
+        bool error = false;
+        for (int i=0; i<(int)tokens.size(); i++)
+        {
+            const Tokenizer::Token& token = tokens[i];
+            PyObject* otoken;
+            if (token.type == Tokenizer::WORD)
+                otoken = PyUnicode_Substring(text, token.begin, token.end);
+            else
+            {
+                otoken = markers[token.type];
+                Py_INCREF(otoken);
+            }
+            PyObject* ospan = Py_BuildValue("[ii]", token.begin, token.end);
+            if (!otoken || !ospan)
+            {
+                Py_XDECREF(otoken);
+                Py_XDECREF(ospan);
+                error = true;
+                break;
+            }
+            PyList_SET_ITEM(otokens, i, otoken);
+            PyList_SET_ITEM(ospans, i, ospan);
+        }
+        if (!error)
+            result = Py_BuildValue("(OO)", otokens, ospans);
+    }
+
+    for (int i=1; i<5; i++)
+        Py_XDECREF(markers[i]);
+    Py_XDECREF(otokens);
+    Py_XDECREF(ospans);
+
+    return result;
+}
+
+static PyObject *
+tokenize(PyObject* text, bool is_context, bool is_completion_context)
+{
+    Py_UCS4* buf = PyUnicode_AsUCS4Copy(text);
+    if (!buf)
+        return NULL;
+
+    vector<Tokenizer::Token> tokens;
+    Tokenizer tokenizer;
+    int length = PyUnicode_GET_LENGTH(text);
+    if (is_completion_context)
+        tokenizer.tokenize_context(buf, length, tokens);
+    else
+        tokenizer.tokenize_text(buf, length, is_context, tokens);
+    PyMem_Free(buf);
+
+    return tokens_to_python(text, tokens);
+}
+
+static PyObject *
+tokenize_text(PyObject *self, PyObject* args, PyObject *kwds)
+{
+    PyObject* text = NULL;
+    int is_context = false;
+
+    static char *kwlist[] = {(char*)"text",
+                             (char*)"is_context",
+                             NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "U|p:tokenize_text", kwlist,
+                                     &text,
+                                     &is_context))
+        return NULL;
+
+    return tokenize(text, is_context, false);
+}
+
+static PyObject *
+tokenize_context(PyObject *self, PyObject* args)
+{
+    PyObject* text = NULL;
+    if (!PyArg_ParseTuple(args, "U:tokenize_context", &text))
+        return NULL;
+
+    return tokenize(text, true, true);
+}
+
 
 static PyMethodDef module_methods[] = {
     {"overlay", (PyCFunction)overlay, METH_VARARGS,
@@ -1939,6 +3343,15 @@ static PyMethodDef module_methods[] = {
     {"loglinint", (PyCFunction)loglinint, METH_VARARGS,
      ""
     },
+    {"simulate_typing", (PyCFunction)simulate_typing, METH_VARARGS,
+     ""
+    },
+    {"tokenize_text", (PyCFunction)tokenize_text, METH_VARARGS | METH_KEYWORDS,
+     ""
+    },
+    {"tokenize_context", (PyCFunction)tokenize_context, METH_VARARGS,
+     ""
+    },
     {NULL}  /* Sentinel */
 };
 
@@ -1987,12 +3400,18 @@ moduleinit (void)
             return NULL;
         if (PyType_Ready(&CachedDynamicModelType) < 0)
             return NULL;
+        if (PyType_Ready(&FrozenModelType) < 0)
+            return NULL;
         if (PyType_Ready(&OverlayModelType) < 0)
             return NULL;
         if (PyType_Ready(&LinintModelType) < 0)
             return NULL;
         if (PyType_Ready(&LoglinintModelType) < 0)
             return NULL;
+        if (PyType_Ready(&PredictionSessionType) < 0)
+            return NULL;
+        if (PyType_Ready(&ModelSnapshotType) < 0)
+            return NULL;
 
         // add top level objects to be instantiated from python
         Py_INCREF(&LanguageModelType);
@@ -2005,6 +3424,10 @@ moduleinit (void)
         PyModule_AddObject(module, "DynamicModelKN", (PyObject *)&DynamicModelKNType);
         Py_INCREF(&CachedDynamicModelType);
         PyModule_AddObject(module, "CachedDynamicModel", (PyObject *)&CachedDynamicModelType);
+        Py_INCREF(&FrozenModelType);
+        PyModule_AddObject(module, "FrozenModel", (PyObject *)&FrozenModelType);
+        Py_INCREF(&PredictionSessionType);
+        PyModule_AddObject(module, "PredictionSession", (PyObject *)&PredictionSessionType);
 
         // add constants
         PyDict_SetItemString(LanguageModelType.tp_dict, "CASE_INSENSITIVE",
@@ -2025,6 +3448,14 @@ moduleinit (void)
                              PyInt_FromLong(LanguageModel::NORMALIZE));
         PyDict_SetItemString(LanguageModelType.tp_dict, "NO_SORT",
                              PyInt_FromLong(LanguageModel::NO_SORT));
+        PyDict_SetItemString(LanguageModelType.tp_dict, "IGNORE_MARKERS",
+                             PyInt_FromLong(LanguageModel::IGNORE_MARKERS));
+        PyDict_SetItemString(LanguageModelType.tp_dict, "PREFER_LOWER_CASE",
+                             PyInt_FromLong(LanguageModel::PREFER_LOWER_CASE));
+        PyDict_SetItemString(LanguageModelType.tp_dict, "CAPITALIZE",
+                             PyInt_FromLong(LanguageModel::CAPITALIZE));
+        PyDict_SetItemString(LanguageModelType.tp_dict, "FUZZY_PREFIX",
+                             PyInt_FromLong(LanguageModel::FUZZY_PREFIX));
         PyDict_SetItemString(LanguageModelType.tp_dict, "NUM_CONTROL_WORDS",
                              PyInt_FromLong(NUM_CONTROL_WORDS));
     }
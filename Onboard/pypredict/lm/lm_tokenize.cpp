@@ -0,0 +1,417 @@
+/*
+ * Copyright © 2026 agent <agent@local>
+ *
+ * This file is part of Onboard.
+ *
+ * Onboard is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * Onboard is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#include <string.h>
+#include <algorithm>
+
+#include "lm_tokenize.h"
+
+using namespace std;
+
+
+// Character classes of Python's re module for str patterns.
+static inline bool is_space(Py_UCS4 c)
+{
+    return Py_UNICODE_ISSPACE(c);
+}
+
+static inline bool is_decimal(Py_UCS4 c)
+{
+    return Py_UNICODE_ISDECIMAL(c);
+}
+
+static inline bool is_word(Py_UCS4 c)
+{
+    return Py_UNICODE_ISALNUM(c) || c == '_';
+}
+
+// [-'´΄], separators inside of words
+static inline bool is_word_separator(Py_UCS4 c)
+{
+    return c == '-' || c == '\'' || c == 0xb4 || c == 0x384;
+}
+
+static inline bool is_sentence_punctuation(Py_UCS4 c)
+{
+    return c == '.' || c == ';' || c == ':' || c == '!' || c == '?';
+}
+
+static inline bool match_literal(const Py_UCS4* s, int n, int pos,
+                                 const char* literal)
+{
+    for (; *literal; literal++, pos++)
+        if (pos >= n || s[pos] != (Py_UCS4)*literal)
+            return false;
+    return true;
+}
+
+// $, end of text or before a final newline
+static inline bool is_at_end(const Py_UCS4* s, int n, int pos)
+{
+    return pos == n || (pos == n-1 && s[pos] == '\n');
+}
+
+// (?=\s|$)
+static inline bool is_followed_by_space(const Py_UCS4* s, int n, int pos)
+{
+    return pos >= n || is_space(s[pos]);
+}
+
+// (?:^|(?<=\s))
+static inline bool is_preceded_by_space(const Py_UCS4* s, int pos)
+{
+    return pos == 0 || is_space(s[pos-1]);
+}
+
+static inline int skip(const Py_UCS4* s, int n, int pos, Py_UCS4 c)
+{
+    while (pos < n && s[pos] == c)
+        pos++;
+    return pos;
+}
+
+static inline int skip_decimals(const Py_UCS4* s, int n, int pos)
+{
+    while (pos < n && is_decimal(s[pos]))
+        pos++;
+    return pos;
+}
+
+static inline int skip_word_chars(const Py_UCS4* s, int n, int pos)
+{
+    while (pos < n && is_word(s[pos]))
+        pos++;
+    return pos;
+}
+
+
+void Tokenizer::tokenize_text(const Py_UCS4* text, int length,
+                              bool is_context, vector<Token>& tokens)
+{
+    // split_sentences(); replacing carriage returns with spaces
+    // changes nothing here, both are whitespace.
+    int num_sentences = 0;
+    int pos = 0;
+    while (pos < length)
+    {
+        int begin = pos;
+        int end = match_sentence(text, length, pos);
+        pos = end;
+
+        // strip whitespace
+        while (begin < end && is_space(text[begin]))
+            begin++;
+        while (end > begin && is_space(text[end-1]))
+            end--;
+
+        // remove <s>, keeping the length
+        int n = end - begin;
+        sentence.assign(text + begin, text + end);
+        for (int i=0; i<n;)
+        {
+            if (match_literal(sentence.data(), n, i, "<s>"))
+            {
+                sentence[i] = sentence[i+1] = sentence[i+2] = ' ';
+                i += 3;
+            }
+            else
+                i++;
+        }
+
+        // strip whitespace from the cuts
+        int e = n;
+        while (e > 0 && is_space(sentence[e-1]))
+            e--;
+        int b = 0;
+        while (b < e && is_space(sentence[b]))
+            b++;
+
+        // sentence begin?
+        if (num_sentences)
+        {
+            Token token = {SENTENCE_BEGIN, begin + b, begin + b};
+            tokens.push_back(token);
+        }
+
+        tokenize_sentence(sentence.data() + b, e - b, begin + b,
+                          is_context, tokens);
+        num_sentences++;
+    }
+}
+
+void Tokenizer::tokenize_context(const Py_UCS4* text, int length,
+                                 vector<Token>& tokens)
+{
+    tokenize_text(text, length, true, tokens);
+
+    if (!ends_with_word_or_operator(text, length))
+    {
+        Token token = {COMPLETION_PREFIX, length, length};
+        tokens.push_back(token);
+    }
+}
+
+// SENTENCE_PATTERN, returns the end of the sentence starting at pos.
+int Tokenizer::match_sentence(const Py_UCS4* s, int n, int pos)
+{
+    // .*? - lazy, the first sentence end wins
+    for (int i=pos; i<n; i++)
+    {
+        int end = match_sentence_end(s, n, i);
+        if (end >= 0)
+            return end;
+    }
+
+    // .+$ - last sentence fragment
+    return n;
+}
+
+int Tokenizer::match_sentence_end(const Py_UCS4* s, int n, int pos)
+{
+    Py_UCS4 c = s[pos];
+
+    // punctuation, [.;:!?](?:(?=[\s]) | \")
+    if (is_sentence_punctuation(c) && pos+1 < n)
+    {
+        if (is_space(s[pos+1]))
+            return pos+1;
+        if (s[pos+1] == '"')
+            return pos+2;
+    }
+
+    // "multiple newlines", (?:\\s*\\n\\s*)+(?=[\\n])
+    // Literal backslashes in the pattern, repeats of \s*\n\s* followed by
+    // '\' or 'n'. Greedy, the last repetition before the lookahead wins.
+    if (c == '\\')
+    {
+        int end = -1;
+        int i = pos;
+        while (i < n && s[i] == '\\')
+        {
+            i = skip(s, n, i+1, 's');
+            if (!match_literal(s, n, i, "\\n\\"))
+                break;
+            i = skip(s, n, i+3, 's');
+            if (i < n && (s[i] == '\\' || s[i] == 'n'))
+                end = i;
+        }
+        if (end >= 0)
+            return end;
+    }
+
+    // sentence end mark
+    if (match_literal(s, n, pos, "<s>"))
+        return pos+3;
+
+    return -1;
+}
+
+// TEXT_PATTERN or CONTEXT_PATTERN, tokens of a single sentence.
+void Tokenizer::tokenize_sentence(const Py_UCS4* s, int n, int offset,
+                                  bool is_context, vector<Token>& tokens)
+{
+    int pos = 0;
+    while (pos < n)
+    {
+        Token token;
+        if (match_token(s, n, pos, is_context, token))
+        {
+            pos = token.end;
+            token.begin += offset;
+            token.end += offset;
+            tokens.push_back(token);
+        }
+        else
+            pos++;
+    }
+}
+
+bool Tokenizer::match_token(const Py_UCS4* s, int n, int pos,
+                            bool is_context, Token& token)
+{
+    Py_UCS4 c = s[pos];
+    token.begin = pos;
+
+    // <unk>, repeated characters, (?:^|(?<=\s))\S*(\S)\\2{3,}\S*
+    // The backreference is escaped in the pattern, it matches a
+    // backslash followed by at least three '2' instead.
+    if (is_preceded_by_space(s, pos) && !is_space(c))
+    {
+        int end = pos;
+        while (end < n && !is_space(s[end]))
+            end++;
+        for (int i=pos+1; i+3<end; i++)
+            if (match_literal(s, n, i, "\\222"))
+            {
+                token.type = UNKNOWN;
+                token.end = end;
+                return true;
+            }
+    }
+
+    // <unk>, dash repeated, [-]{3}(?=\s|$)
+    if (match_literal(s, n, pos, "---") &&
+        is_followed_by_space(s, n, pos+3))
+    {
+        token.type = UNKNOWN;
+        token.end = pos+3;
+        return true;
+    }
+
+    // <unk>, password in URL, :[^\s:@]+?@
+    if (c == ':')
+    {
+        int i = pos+1;
+        while (i < n && !is_space(s[i]) && s[i] != ':' && s[i] != '@')
+            i++;
+        if (i > pos+1 && i < n && s[i] == '@')
+        {
+            token.type = UNKNOWN;
+            token.end = i+1;
+            return true;
+        }
+    }
+
+    // <num>, [-+]?\d+(?:[.,]\d+)*
+    int i = pos;
+    if (c == '-' || c == '+')
+        i++;
+    if (i < n && is_decimal(s[i]))
+    {
+        i = skip_decimals(s, n, i);
+        while (i+1 < n && (s[i] == '.' || s[i] == ',') && is_decimal(s[i+1]))
+            i = skip_decimals(s, n, i+1);
+        token.type = NUMBER;
+        token.end = i;
+        return true;
+    }
+
+    // <num>, [.,]\d+
+    if ((c == '.' || c == ',') && pos+1 < n && is_decimal(s[pos+1]))
+    {
+        token.type = NUMBER;
+        token.end = skip_decimals(s, n, pos+1);
+        return true;
+    }
+
+    token.type = WORD;
+
+    // word, [-]{0,2}[^\W\d]\w*(?:[-'´΄][\w]+)*[-'´΄]?
+    i = pos;
+    if (i < n && s[i] == '-')
+        i++;
+    if (i < n && s[i] == '-')
+        i++;
+    if (i < n && is_word(s[i]) && !is_decimal(s[i]))
+    {
+        i = skip_word_chars(s, n, i+1);
+        while (i+1 < n && is_word_separator(s[i]) && is_word(s[i+1]))
+            i = skip_word_chars(s, n, i+1);
+
+        // trailing apostrophes, and dashes in the context
+        if (i < n && is_word_separator(s[i]) && (is_context || s[i] != '-'))
+            i++;
+
+        token.end = i;
+        return true;
+    }
+
+    // pass through control words and begin of text markers
+    if (c == '<')
+    {
+        static const char* const control_words[] =
+            {"<unk>", "<s>", "</s>", "<num>"};
+        for (int j=0; j<4; j++)
+            if (match_literal(s, n, pos, control_words[j]))
+            {
+                token.end = pos + strlen(control_words[j]);
+                return true;
+            }
+
+        if (match_literal(s, n, pos, "<bot:"))
+        {
+            i = pos+5;
+            while (i < n && s[i] >= 'a' && s[i] <= 'z')
+                i++;
+            if (i < n && s[i] == '>')
+            {
+                token.end = i+1;
+                return true;
+            }
+        }
+    }
+
+    // space delimited operators, "|" and "-", "--" in the context
+    if (is_preceded_by_space(s, pos))
+    {
+        i = pos;
+        if (c == '|')
+            i = pos+1;
+        else if (is_context && c == '-')
+            i = (pos+1 < n && s[pos+1] == '-') ? pos+2 : pos+1;
+
+        if (i > pos && is_followed_by_space(s, n, i))
+        {
+            token.end = i;
+            return true;
+        }
+    }
+
+    return false;
+}
+
+// The completion prefix is empty unless the context ends in a word,
+// an operator or in repeated characters.
+bool Tokenizer::ends_with_word_or_operator(const Py_UCS4* s, int n)
+{
+    // $ matches at the end and before a final newline
+    int ends[2] = {n, n-1};
+    int num_ends = (n && s[n-1] == '\n') ? 2 : 1;
+
+    for (int k=0; k<num_ends; k++)
+    {
+        int end = ends[k];
+
+        // ^$, empty string
+        if (end == 0)
+            return true;
+
+        // .*[-'´΄\w]$, word at the end
+        if (is_word_separator(s[end-1]) || is_word(s[end-1]))
+            return true;
+
+        // .*(\S)\\1{3,}$, escaped backreference again,
+        // a non-space, a backslash and at least three '1'
+        int i = end;
+        while (i > 0 && s[i-1] == '1')
+            i--;
+        if (end - i >= 3 && i >= 2 && s[i-1] == '\\' && !is_space(s[i-2]))
+            return true;
+    }
+
+    // (?:^|.*\s)[|]=?$, recognized operator
+    for (int i=max(n-3, 0); i<n; i++)
+        if (s[i] == '|' && is_preceded_by_space(s, i) &&
+            (is_at_end(s, n, i+1) ||
+             (i+1 < n && s[i+1] == '=' && is_at_end(s, n, i+2))))
+            return true;
+
+    return false;
+}
+
@@ -0,0 +1,74 @@
+/*
+ * Copyright © 2026 agent <agent@local>
+ *
+ * This file is part of Onboard.
+ *
+ * Onboard is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * Onboard is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#ifndef LM_TOKENIZE_H
+#define LM_TOKENIZE_H
+
+#include "Python.h"
+#include <vector>
+
+//------------------------------------------------------------------------
+// Tokenizer - native tokenize_text() and tokenize_context()
+//------------------------------------------------------------------------
+// Hand-written matchers for SENTENCE_PATTERN, TEXT_PATTERN and
+// CONTEXT_PATTERN of lm_wrapper.py, producing the same token streams.
+// They follow the patterns as Python compiles them. Sequences like "\\s"
+// in the raw pattern strings match a literal backslash there, and so
+// they do here. Characters are classified with Python's unicode database
+// to agree with \w, \d and \s of the re module.
+// Spans are code point offsets into the text.
+class Tokenizer
+{
+    public:
+        enum TokenType
+        {
+            WORD,
+            NUMBER,             // <num>
+            UNKNOWN,            // <unk>
+            SENTENCE_BEGIN,     // <s>, empty span
+            COMPLETION_PREFIX,  // "", empty span at the end of the context
+        };
+
+        struct Token
+        {
+            TokenType type;
+            int begin;
+            int end;
+        };
+
+        void tokenize_text(const Py_UCS4* text, int length,
+                           bool is_context, std::vector<Token>& tokens);
+        void tokenize_context(const Py_UCS4* text, int length,
+                              std::vector<Token>& tokens);
+
+    private:
+        int match_sentence(const Py_UCS4* s, int n, int pos);
+        int match_sentence_end(const Py_UCS4* s, int n, int pos);
+        void tokenize_sentence(const Py_UCS4* s, int n, int offset,
+                               bool is_context, std::vector<Token>& tokens);
+        bool match_token(const Py_UCS4* s, int n, int pos, bool is_context,
+                         Token& token);
+        bool ends_with_word_or_operator(const Py_UCS4* s, int n);
+
+    private:
+        std::vector<Py_UCS4> sentence;
+};
+
+#endif
+
@@ -119,6 +119,7 @@ class UnigramModel : public DynamicModelBase
                 m_counts.push_back(0);
 
             m_counts.at(wid) += increment;
+            generation++;
 
             node.word_id = wid;
             node.count = m_counts[wid];
@@ -24,6 +24,7 @@
 #include <set>
 #include <map>
 #include <algorithm>
+#include <mutex>
 
 #ifndef ALEN
 #define ALEN(a) ((int)(sizeof(a)/sizeof(*a)))
@@ -297,6 +298,8 @@ class PoolAllocator
 
         void* alloc(size_t size)
         {
+            std::lock_guard<std::mutex> lock(mutex);
+
             //assert(size/4*4 == size); // item size must be multiple of 4
             //size_t bin = size/4;
             size_t bin = size;          // items of any size allowed
@@ -331,6 +334,8 @@ class PoolAllocator
 
         void free(void* p)
         {
+            std::lock_guard<std::mutex> lock(mutex);
+
             // try to find a slab containing the address p
             if(!slabmap.empty())
             {
@@ -355,6 +360,7 @@ class PoolAllocator
     private:
         ItemPool* pools[4096];  // max number of bins
         map<Slab*, ItemPool*> slabmap;  // find slab from pointer
+        std::mutex mutex;  // models may be used from multiple threads
 };
 
 #ifdef USE_POOL_ALLOCATOR
@@ -0,0 +1,109 @@
+/*
+ * Copyright © 2026 agent <agent@local>
+ *
+ * This file is part of Onboard.
+ *
+ * Onboard is free software; you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation; either version 3 of the License, or
+ * (at your option) any later version.
+ *
+ * Onboard is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program. If not, see <http://www.gnu.org/licenses/>.
+ */
+
+#ifndef THREAD_POOL_H
+#define THREAD_POOL_H
+
+#include <vector>
+#include <queue>
+#include <thread>
+#include <mutex>
+#include <condition_variable>
+#include <future>
+#include <functional>
+
+//------------------------------------------------------------------------
+// ThreadPool - fixed number of worker threads processing queued tasks
+//------------------------------------------------------------------------
+// Exceptions thrown by a task are passed on to the caller by the
+// future returned from submit().
+class ThreadPool
+{
+    public:
+        ThreadPool(int num_threads)
+        {
+            stopping = false;
+            for (int i=0; i<num_threads; i++)
+                threads.push_back(std::thread(&ThreadPool::run, this));
+        }
+
+        ~ThreadPool()
+        {
+            {
+                std::lock_guard<std::mutex> lock(mutex);
+                stopping = true;
+            }
+            cv.notify_all();
+            for (int i=0; i<(int)threads.size(); i++)
+                threads[i].join();
+        }
+
+        std::future<void> submit(const std::function<void()>& f)
+        {
+            std::packaged_task<void()> task(f);
+            std::future<void> result = task.get_future();
+            {
+                std::lock_guard<std::mutex> lock(mutex);
+                tasks.push(std::move(task));
+            }
+            cv.notify_one();
+            return result;
+        }
+
+        int get_num_threads() {return threads.size();}
+
+        // True when called from one of the worker threads of any pool.
+        // Tasks must not wait for other tasks of the same pool, or
+        // all workers might end up waiting.
+        static bool is_worker_thread() {return in_worker_thread();}
+
+    private:
+        static bool& in_worker_thread()
+        {
+            static thread_local bool in_worker = false;
+            return in_worker;
+        }
+
+        void run()
+        {
+            in_worker_thread() = true;
+            while (true)
+            {
+                std::packaged_task<void()> task;
+                {
+                    std::unique_lock<std::mutex> lock(mutex);
+                    cv.wait(lock, [this]{return stopping || !tasks.empty();});
+                    if (tasks.empty())
+                        return;
+                    task = std::move(tasks.front());
+                    tasks.pop();
+                }
+                task();
+            }
+        }
+
+    private:
+        std::vector<std::thread> threads;
+        std::queue< std::packaged_task<void()> > tasks;
+        std::mutex mutex;
+        std::condition_variable cv;
+        bool stopping;
+};
+
+#endif
@@ -19,30 +19,42 @@
 
 from __future__ import division, print_function, unicode_literals
 
+import os
+import errno
 import sys
 import re
+import json
+import zlib
 import codecs
+import struct
+import multiprocessing
 from math import log
+from functools import lru_cache
 
 import pypredict.lm as lm
-from pypredict.lm import overlay, linint, loglinint  # exported symbols
+from pypredict.lm import overlay, linint, loglinint, \
+                         PredictionSession  # exported symbols
 
 class _BaseModel:
 
     modified = False
     load_error = False
     load_error_msg = ""
+    journal = None     # ModelJournal recording changes, if any
 
     def learn_tokens(self, tokens, allow_new_words=True):
-        """ Extract n-grams from tokens and count them. """
-        for ngram in self._extract_ngrams(tokens):
-            self.count_ngram(ngram, 1, allow_new_words)
-
+        """
+        Extract n-grams from tokens and count them.
+        Natively, with the same n-grams as _extract_ngrams().
+        """
+        super(_BaseModel, self).learn_tokens(tokens, allow_new_words)
         self.modified = True
+        if self.journal:
+            self.journal.record_learn_tokens(tokens, allow_new_words)
 
     def _extract_ngrams(self, tokens):
         """
-        Extract n-grams from tokens.
+        Extract n-grams from tokens, reference for learn_tokens().
 
         Doctests:
         >>> m = DynamicModel(3)
@@ -73,18 +85,6 @@ class _BaseModel:
                         assert(n == len(ngram)-1)
                         yield ngram
 
-    def get_counts(self):
-        """
-        Return number of n-gram types and total occurances
-        for each n-gram level.
-        """
-        counts = [0]*self.order
-        totals = [0]*self.order
-        for ng in self.iter_ngrams():
-            counts[len(ng[0])-1] +=  1
-            totals[len(ng[0])-1] += ng[1]
-        return counts, totals
-
     def copy(self, model):
         """
         Copy contents of self to model. The order of the destination
@@ -93,10 +93,7 @@ class _BaseModel:
         if hasattr(self, "smoothing"): # not for UnigramModel
             model.smoothing = self.smoothing
 
-        for it in self.iter_ngrams():
-            ngram = it[0]
-            count = it[1]
-            model.count_ngram(ngram, count)
+        self.copy_to(model)
 
         return model
 
@@ -117,24 +114,19 @@ class _BaseModel:
             order -= 1
 
         order = max(order, 2)
-        model = self.__class__(order)
+        model = self._new_model(order)
 
         if hasattr(self, "smoothing"): # not for UnigramModel
             model.smoothing = self.smoothing
 
-        for it in self.iter_ngrams():
-            ngram = it[0]
-            count = it[1]
-
-            level = len(ngram)
-            k = min(len(prune_counts), level) - 1
-            prune_count = prune_counts[k]
-
-            if count > prune_count and  prune_count != -1:
-                model.count_ngram(ngram, count)
+        self.prune_to(model, prune_counts)
 
         return model
 
+    def _new_model(self, order):
+        """ Return an empty model of the same kind, for prune(). """
+        return self.__class__(order)
+
     def load(self, filename):
         self.load_error = False
         self.load_error_msg = ""
@@ -150,36 +142,13 @@ class _BaseModel:
         Remove word context[-1] where it appears after history context[:-1]
         from the model. If the history is empty all n-grams containing word
         will be removed.
+        Returns a dict of affected n-grams and their count changes.
         """
-        changes = self.get_remove_context_changes(context)
+        changes = super(_BaseModel, self).remove_context(context)
         if changes:
-            for ngram, count in changes.items():
-                self.count_ngram(ngram, count)
-
             self.modified = True
-
-        return changes
-
-    def get_remove_context_changes(self, context):
-        """
-        Simulate removal of context.
-        Returns a dict of affected n-grams and their count changes (negative).
-        """
-        changes = {}
-
-        for it in self.iter_ngrams():
-            ngram = it[0]
-            count = it[1]
-
-            # find intersection with context
-            for i in range(len(ngram)):
-                for j in range(min(len(context), i+1)):
-                    if ngram[i-j] != context[-j-1]:
-                        break
-                else:
-                    if j == len(context) - 1:
-                        changes[ngram] = -count
-                        break
+            if self.journal:
+                self.journal.record_remove_context(context)
 
         return changes
 
@@ -208,6 +177,227 @@ class CachedDynamicModel(_BaseModel, lm.CachedDynamicModel):
     pass
 
 
+class FrozenModel(_BaseModel, lm.FrozenModel):
+    """
+    Read-only model, loaded from a file or frozen from another model.
+    Methods that would change the n-grams raise TypeError. copy() and
+    prune() work, their destination has to be a dynamic model.
+    """
+    def learn_tokens(self, tokens, allow_new_words=True):
+        self._raise_read_only("learn_tokens")
+
+    def remove_context(self, context):
+        self._raise_read_only("remove_context")
+
+    def _new_model(self, order):
+        return DynamicModel(order)
+
+    @staticmethod
+    def _raise_read_only(name):
+        raise TypeError(
+            "FrozenModel is read-only, {}() is not supported; "
+            "freeze a DynamicModel instead".format(name))
+
+
+class ModelJournal:
+    """
+    Append-only journal of the changes learned into a persistent model,
+    kept next to the model file.
+
+    Calls to learn_tokens() and remove_context() are recorded as one
+    checksummed line each and only written to disk, with a single fsync,
+    on flush(). The header identifies the base model file the records
+    apply to. Compacting the records into a new base file rewrites the
+    journal with a new header, so records that are already part of the
+    base file are never replayed twice, even if compaction is interrupted.
+    """
+
+    MAGIC = "#onboard-lm-journal 1"
+
+    def __init__(self, filename, base_filename):
+        self.filename = filename
+        self.base_filename = base_filename
+        self.stale_filename = None  # where a mismatching journal went
+        self._pending = []     # records not written yet
+        self._size = 0         # bytes of valid data on disk, header included
+        self._rebase_size = 0
+
+    @property
+    def size(self):
+        """ Bytes written to disk, including the header. """
+        return self._size
+
+    def get_rebase_filename(self):
+        return self.filename + ".tmp"
+
+    def get_stale_filename(self):
+        return self.filename + ".stale"
+
+    def record_learn_tokens(self, tokens, allow_new_words):
+        self._pending.append(self._format_record(
+            ["l", int(bool(allow_new_words))] + list(tokens)))
+
+    def record_remove_context(self, context):
+        self._pending.append(self._format_record(["r"] + list(context)))
+
+    def replay(self, model):
+        """
+        Apply the journal to model, freshly loaded from the base file.
+        A journal left behind by an interrupted compaction is recovered.
+        A journal of a different base file can't be replayed, it is moved
+        aside to stale_filename instead of being overwritten.
+        Returns the number of records replayed.
+        """
+        base_id = self.get_base_id(self.base_filename)
+        for filename in [self.filename, self.get_rebase_filename()]:
+            result = self._read(filename, base_id)
+            if result:
+                records, size = result
+                if filename != self.filename:
+                    os.rename(filename, self.filename)
+                self.apply(model, records)
+                self._size = size
+                return len(records)
+
+        if os.path.exists(self.filename) and \
+           os.path.getsize(self.filename):
+            self.stale_filename = self.get_stale_filename()
+            os.replace(self.filename, self.stale_filename)
+
+        self._size = 0
+        return 0
+
+    def flush(self):
+        """ Append pending records to the journal and sync them to disk. """
+        if not self._pending:
+            return
+
+        data = b"".join(self._pending)
+        if self._size == 0:
+            data = self._format_header(self.get_base_id(self.base_filename)) \
+                   + data
+
+        # Overwrite anything past the last valid record, e.g. a partial
+        # record from an earlier crash or a failed write.
+        fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            os.ftruncate(fd, self._size)
+            os.lseek(fd, self._size, os.SEEK_SET)
+            self._write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self._size += len(data)
+        self._pending = []
+
+    def begin_rebase(self, base_id, end):
+        """
+        Start over with a new base file that contains all records
+        up to byte offset <end>. Records after <end> are kept.
+        Call end_rebase() once the new base file is in place.
+        """
+        with open(self.filename, "rb") as f:
+            f.seek(end)
+            data = f.read(self._size - end)
+
+        data = self._format_header(base_id) + data
+        with open(self.get_rebase_filename(), "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._rebase_size = len(data)
+
+    def end_rebase(self):
+        os.rename(self.get_rebase_filename(), self.filename)
+        self._size = self._rebase_size
+
+    @staticmethod
+    def apply(model, records):
+        for record in records:
+            if record[0] == "l":
+                model.learn_tokens(record[2:], bool(record[1]))
+            elif record[0] == "r":
+                model.remove_context(record[1:])
+
+    @staticmethod
+    def get_base_id(filename):
+        """ Identify the current version of the base file. """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return "-"
+        return "{} {}".format(st.st_size, st.st_mtime_ns)
+
+    def _read(self, filename, base_id):
+        """
+        Read all intact records of the journal for base file base_id.
+        Returns the records and the size of the valid data, None
+        if there is no such journal.
+        """
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+        header = self._format_header(base_id)
+        if not data.startswith(header):
+            return None
+
+        records = []
+        size = len(header)
+        for line in data[size:].splitlines(True):
+            record = self._parse_record(line)
+            if record is None:   # torn write, drop the rest
+                break
+            records.append(record)
+            size += len(line)
+
+        return records, size
+
+    def _format_header(self, base_id):
+        return "{} {}\n".format(self.MAGIC, base_id).encode("utf-8")
+
+    @staticmethod
+    def _format_record(record):
+        data = json.dumps(record, ensure_ascii=False).encode("utf-8")
+        return "{:08x} ".format(zlib.crc32(data) & 0xffffffff) \
+               .encode("ascii") + data + b"\n"
+
+    @staticmethod
+    def _parse_record(line):
+        """
+        Doctests:
+        >>> r = ModelJournal._format_record(["l", 1, "word1", "wörd2"])
+        >>> ModelJournal._parse_record(r)
+        ['l', 1, 'word1', 'wörd2']
+        >>> ModelJournal._parse_record(r[:-1]) is None
+        True
+        >>> ModelJournal._parse_record(r.replace(b"1", b"2")) is None
+        True
+        """
+        if not line.endswith(b"\n"):
+            return None
+        crc, _, data = line[:-1].partition(b" ")
+        try:
+            if int(crc, 16) != zlib.crc32(data) & 0xffffffff:
+                return None
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _write(fd, data):
+        view = memoryview(data)
+        while view:
+            n = os.write(fd, view)
+            view = view[n:]
+
+
 def split_tokens(tokens, separator, keep_separator = False):
     """
     Split list of tokens at separator token.
@@ -439,8 +629,14 @@ def tokenize_text(text, is_context = False):
             "Hello there! We saw 5 whales "
                              -> ["Hello", "there", "<s>",
                                  "We", "saw", "<num>", "whales"]
+
+        Runs natively, tokenize_text_re() is the reference
+        implementation with regular expressions.
     """
+    return lm.tokenize_text(text, is_context)
 
+def tokenize_text_re(text, is_context = False):
+    """ tokenize_text() with SENTENCE_PATTERN and TEXT_PATTERN. """
     tokens = []
     spans = []
     sentences, sentence_spans = split_sentences(text)
@@ -463,7 +659,11 @@ def tokenize_context(text):
     """ Split text into word tokens + completion prefix.
         The result is ready for use in predict().
     """
-    tokens, spans = tokenize_text(text, is_context = True)
+    return lm.tokenize_context(text)
+
+def tokenize_context_re(text):
+    """ tokenize_context() with regular expressions. """
+    tokens, spans = tokenize_text_re(text, is_context = True)
     if not re.match(r"""
                   ^$                             # empty string?
                 | .*[-'´΄\w]$                    # word at the end?
@@ -476,6 +676,10 @@ def tokenize_context(text):
 
     return tokens, spans
 
+# Start of the header of binary models, see lm_binary.h
+BINARY_MODEL_MAGIC = b"OBLMBIN\0"
+_BINARY_MODEL_HEADER = struct.Struct("=8sIIIII")
+
 def read_order(filename, encoding=None):
     """
     Read the order from the header of the given file.
@@ -488,6 +692,17 @@ def read_order(filename, encoding=None):
     else:
         ex_class = IOError
 
+    try:
+        with open(filename, "rb") as f:
+            data = f.read(_BINARY_MODEL_HEADER.size)
+    except ex_class as ex:
+        return None
+    if data.startswith(BINARY_MODEL_MAGIC) and \
+       len(data) == _BINARY_MODEL_HEADER.size:
+        magic, version, header_size, byte_order, flags, order = \
+            _BINARY_MODEL_HEADER.unpack(data)
+        return order
+
     try:
         text = read_corpus(filename, encoding, 20)
     except ex_class as ex:
@@ -540,6 +755,35 @@ def read_corpus(filename, encoding=None, num_lines = None):
 
     return text
 
+def read_corpus_chunks(filename, chunk_size, encoding=None):
+    """
+    Read corpus in pieces of about <chunk_size> bytes, split
+    at line ends. Like read_corpus, but without holding the
+    whole file in memory. Each chunk is decoded on its own.
+    """
+    if encoding:
+        encodings = [encoding]
+    else:
+        encodings = ['utf-8', 'latin-1']
+
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            data += f.readline()  # complete the last line
+
+            for i,enc in enumerate(encodings):
+                try:
+                    text = data.decode(enc)
+                except UnicodeDecodeError as err:
+                    if i == len(encodings)-1: # all encodings failed?
+                        raise err
+                    continue
+                break
+
+            yield text
+
 def read_vocabulary(filename, encoding=None):
     """
     Read vocabulary with one word per line.
@@ -580,18 +824,17 @@ def entropy(model, tokens, order=None):
     entropy = 0
     word_count = len(tokens)
 
-    # extract n-grams of maximum length
-    for i in range(len(tokens)):
-        b = max(i-(order-1),0)
-        e = min(i-(order-1)+order, len(tokens))
-        ngram = tokens[b:e]
-        if len(ngram) != 1:
-            p = model.get_probability(ngram)
-            if p == 0:
-                print(word_count, ngram,p)
-            e = log(p, 2) if p else float("infinity")
-            entropy += e
-            ngram_count += 1
+    # Score n-grams of maximum length natively, in one go.
+    # Single tokens without history aren't included.
+    probabilities = model.get_probabilities(tokens, order) \
+                    if order > 1 else []
+
+    for i, p in enumerate(probabilities[1:], 1):
+        if p == 0:
+            print(word_count, tokens[max(i-(order-1),0):i+1], p)
+        e = log(p, 2) if p else float("infinity")
+        entropy += e
+        ngram_count += 1
 
     entropy = -entropy/word_count if word_count else 0
     try:
@@ -602,59 +845,85 @@ def entropy(model, tokens, order=None):
     return entropy, perplexity
 
 
-def ksr(query_model, learn_model, sentences, limit, progress=None):
+def ksr(query_model, learn_model, sentences, limit, progress=None, jobs=1):
     """ Calculate keystroke savings rate from simulated typing. """
-    total_chars, pressed_keys = simulate_typing(query_model, learn_model, sentences, limit, progress)
+    total_chars, pressed_keys = simulate_typing(query_model, learn_model,
+                                                sentences, limit, progress,
+                                                jobs)
     saved_keystrokes = total_chars - pressed_keys
     return saved_keystrokes * 100.0 / total_chars if total_chars else 0
 
-def simulate_typing(query_model, learn_model, sentences, limit, progress=None):
+def simulate_typing(query_model, learn_model, sentences, limit,
+                    progress=None, jobs=1):
+    """
+    Type sentences, accepting words as soon as query_model predicts them.
+    learn_model learns each sentence after it was typed. It is meant
+    to be a scratch model, learning happens natively and isn't recorded
+    in a journal, hence journaled models are rejected.
+    Returns the number of typed characters and of pressed keys.
+
+    With jobs > 1, contiguous shards of sentences are typed by forked
+    processes, each with its own copy of the models. Learning then only
+    carries over between sentences of the same shard and the models of
+    the calling process stay unchanged. Results are summed in shard
+    order, they don't depend on timing.
+    """
+    if getattr(learn_model, "journal", None):
+        raise ValueError("learn_model must not have a journal")
+
+    n = len(sentences)
+    jobs = min(jobs, n)
+    if jobs <= 1:
+        return _simulate_typing(query_model, learn_model, sentences, limit,
+                                progress)
 
+    # tokenize once here, the cache is inherited by the forked processes
+    for sentence in sentences:
+        _get_typing_steps(sentence)
+
+    global _typing_args
+    _typing_args = (query_model, learn_model, sentences, limit)
+    try:
+        bounds = [n * i // jobs for i in range(jobs + 1)]
+        total_chars = 0
+        pressed_keys = 0
+
+        # one fresh process per shard, none may see another's learning
+        context = multiprocessing.get_context("fork")
+        with context.Pool(jobs, maxtasksperchild=1) as pool:
+            results = pool.imap(_simulate_typing_shard,
+                                zip(bounds, bounds[1:]))
+            for end, (chars, keys) in zip(bounds[1:], results):
+                total_chars += chars
+                pressed_keys += keys
+                if progress:
+                    progress(end - 1, n, total_chars, pressed_keys)
+    finally:
+        _typing_args = None
+
+    return total_chars, pressed_keys
+
+_typing_args = None  # models and sentences for the forked processes
+
+def _simulate_typing_shard(bounds):
+    query_model, learn_model, sentences, limit = _typing_args
+    begin, end = bounds
+    return _simulate_typing(query_model, learn_model, sentences[begin:end],
+                            limit)
+
+def _simulate_typing(query_model, learn_model, sentences, limit,
+                     progress=None):
     total_chars = 0
     pressed_keys = 0
 
     for i,sentence in enumerate(sentences):
-        inputline = ""
-
-        cursor = 0
-        while cursor < len(sentence):
-            context, spans = tokenize_context(". " + inputline) # simulate sentence begin
-            prefix = context[len(context)-1] if context else ""
-            prefix_to_end = sentence[len(inputline)-len(prefix):]
-            target_word = re.search(r"^([\w]|[-'])*", prefix_to_end, re.UNICODE).group()
-            choices = query_model.predict(context, limit)
-
-            if target_word in choices:
-                added_chars = len(target_word) - len(prefix)
-                if added_chars == 0: # still right after insertion point?
-                    added_chars = 1  # continue with next character
-            else:
-                added_chars = 1
-
-            for k in range(added_chars):
-                inputline += sentence[cursor]
-                cursor += 1
-                total_chars += 1
-
-            pressed_keys += 1
-
-            if 0:  # step mode for debugging
-                print("learn_model.get_counts=", learn_model.get_counts())
-                print("cursor=%d total_chars=%d pressed_keys=%d" % (cursor, total_chars, pressed_keys))
-                print("sentence= '%s'" % sentence)
-                print("inputline='%s'" % inputline)
-                print("prefix='%s'" % prefix)
-                print("prefix_to_end='%s'" % prefix_to_end)
-                print("target_word='%s'" % (target_word))
-                print("context=", context)
-                print("choices=", choices)
-                print("added_chars=", added_chars)
-                input()
-
-        # learn the sentence
+        steps, tokens = _get_typing_steps(sentence)
+        chars, keys = lm.simulate_typing(query_model, learn_model,
+                                         steps, tokens, limit)
+        total_chars += chars
+        pressed_keys += keys
         if learn_model:
-            tokens, spans = tokenize_context(sentence)
-            learn_model.learn_tokens(tokens)
+            learn_model.modified = True
 
         # progress feedback
         if progress:
@@ -662,6 +931,31 @@ def simulate_typing(query_model, learn_model, sentences, limit, progress=None):
 
     return total_chars, pressed_keys
 
+@lru_cache(maxsize=16384)  # sentences of repeatedly evaluated texts
+def _get_typing_steps(sentence):
+    """
+    Tokenize everything simulate_typing needs to know about sentence:
+    for each cursor position the context and the word to complete,
+    as well as the tokens to learn afterwards.
+    """
+    steps = []
+    history = ()
+    for cursor in range(len(sentence)):
+        inputline = sentence[:cursor]
+        context, spans = tokenize_context(". " + inputline) # simulate sentence begin
+        prefix = context[-1] if context else ""
+        prefix_to_end = sentence[len(inputline)-len(prefix):]
+        target_word = re.search(r"^([\w]|[-'])*", prefix_to_end, re.UNICODE).group()
+
+        # share histories between steps, saves memory
+        if tuple(context[:-1]) != history:
+            history = tuple(context[:-1])
+        steps.append((history, prefix, target_word))
+
+    tokens, spans = tokenize_context(sentence)
+
+    return steps, tokens
+
 
 from contextlib import contextmanager
 
@@ -18,7 +18,12 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
+import math
+import random
 import tempfile
+import threading
+import unicodedata
 import unittest
 from Onboard.pypredict import *
 
@@ -63,6 +68,44 @@ class _TestTokenization(unittest.TestCase):
                          (self.training_text, repr(sentences), repr(self.result)))
 
 
+class _TestNativeTokenizer(unittest.TestCase):
+    """ Differential fuzz test against the regex based tokenizer. """
+
+    # Fragments likely to trip up the patterns, including the
+    # backslash sequences the patterns match literally.
+    FRAGMENTS = list("aZé_ß1٣²½-+.,;:!?\"'´΄|=@<>/\\sn21 \t\n\r\xa0\u2028") + \
+                ["<s>", "</s>", "<unk>", "<num>", "<bot:txt>", "<bot:",
+                 "---", "--", ":pass@", "word", "12.5", "a\\2222",
+                 "\\111", "\\s\\n\\"]
+
+    def assert_same_tokens(self, text):
+        for is_context in (False, True):
+            self.assertEqual(tokenize_text(text, is_context),
+                             tokenize_text_re(text, is_context),
+                             "tokenize_text(%s, %s)" % (repr(text), is_context))
+        self.assertEqual(tokenize_context(text),
+                         tokenize_context_re(text),
+                         "tokenize_context(%s)" % repr(text))
+
+    def test_fragments(self):
+        rnd = random.Random(0)
+        for i in range(5000):
+            n = rnd.randint(0, 12)
+            text = "".join(rnd.choice(self.FRAGMENTS) for j in range(n))
+            self.assert_same_tokens(text)
+
+    def test_code_points(self):
+        rnd = random.Random(0)
+        for i in range(2000):
+            n = rnd.randint(0, 30)
+            text = "".join(chr(rnd.choice((rnd.randrange(0x20, 0x80),
+                                           rnd.randrange(0xa0, 0xd800),
+                                           rnd.randrange(0x10000, 0x20000),
+                                           0x20, 0x0a, 0x85)))
+                           for j in range(n))
+            self.assert_same_tokens(text)
+
+
 class _TestMultiOrder(unittest.TestCase):
     def __init__(self, test, order):
         unittest.TestCase.__init__(self, test)
@@ -755,6 +798,29 @@ class _TestModel(unittest.TestCase):
         choices = model.predict(['frü'], options = model.ACCENT_INSENSITIVE_SMART)
         self.assertEqual(choices, ['früh'])
 
+    def test_prefix_index(self):
+        model = DynamicModel()
+        model.learn_tokens(['Straße', 'strasse', 'Stroh', 'stück', 'tür'], 1)
+
+        choices = model.predict(['Str'])
+        self.assertEqual(sorted(choices), ['Straße', 'Stroh'])
+
+        choices = model.predict(['str'], options = model.CASE_INSENSITIVE)
+        self.assertEqual(sorted(choices), ['Straße', 'Stroh', 'strasse'])
+
+        choices = model.predict(['stu'], options = model.ACCENT_INSENSITIVE)
+        self.assertEqual(sorted(choices), ['stück'])
+
+        # words learned later have to show up in the folded index too
+        model.learn_tokens(['STÜRMISCH', 'Stuhl'], 1)
+        choices = model.predict(['stu'], options = model.CASE_INSENSITIVE |
+                                                   model.ACCENT_INSENSITIVE)
+        self.assertEqual(sorted(choices), ['STÜRMISCH', 'Stuhl', 'stück'])
+
+        choices = model.predict(['Stü'], options = model.CASE_INSENSITIVE_SMART |
+                                                   model.ACCENT_INSENSITIVE_SMART)
+        self.assertEqual(sorted(choices), ['STÜRMISCH'])
+
     def test_ignore_capitalized(self):
         model = DynamicModel()
         model.learn_tokens(['ABCDE'], 1)
@@ -874,6 +940,767 @@ class _TestModel(unittest.TestCase):
              (('uu', 'fff', 'ccc'), 1, 0)]
         )
 
+    def test_save_load_binary_model(self):
+        fn = os.path.join(self._dir, "model.lm")
+        bfn = os.path.join(self._dir, "model.lmb")
+        tokens = tokenize_text("ccc bbb uu fff ccc ee ccc bbb Uu")[0]
+
+        for model_class in [UnigramModel, DynamicModel,
+                            DynamicModelKN, CachedDynamicModel]:
+            model = model_class()
+            model.learn_tokens(tokens)
+            model.save(fn)
+            model.save_binary(bfn)
+
+            text_model = model_class()
+            text_model.load(fn)
+            binary_model = model_class()
+            binary_model.load(bfn)
+
+            # Same n-grams in the same (sorted) order as the text model.
+            self.assertEqual(list(binary_model.iter_ngrams()),
+                             list(text_model.iter_ngrams()))
+            for context in [[""], ["ccc", ""], ["c"], ["ccc", "bbb", "u"]]:
+                self.assertEqual(binary_model.predictp(context),
+                                 text_model.predictp(context))
+
+            # Binary models remain updatable.
+            binary_model.learn_tokens(["uuu", "ccc"])
+            self.assertEqual(sorted(binary_model.predict(["uu"])),
+                             ["uu", "uuu"])
+
+        # Saving replaces the file, models that have it mapped
+        # keep working.
+        binary_model = DynamicModel()
+        binary_model.load(bfn)
+        expected = binary_model.predictp(["ccc", ""])
+        model = DynamicModel()
+        model.learn_tokens(["xyz"] * 10)
+        model.save_binary(bfn)
+        self.assertEqual(binary_model.predictp(["ccc", ""]), expected)
+        self.assertEqual(sorted(os.listdir(self._dir)),
+                         ["model.lm", "model.lmb"])
+
+        # The vocabulary must be marked as sorted.
+        with open(bfn, "r+b") as f:
+            f.seek(20)   # BinaryModelHeader.flags
+            flags = int.from_bytes(f.read(4), sys.byteorder)
+            f.seek(20)
+            f.write((flags & ~2).to_bytes(4, sys.byteorder))
+        with self.assertRaises(IOError):
+            DynamicModel().load(bfn)
+        with self.assertRaises(IOError):
+            FrozenModel().load(bfn)
+
+        # Corrupted payload
+        model.save_binary(bfn)
+        with open(bfn, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            c = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([c[0] ^ 0xff]))
+        with self.assertRaises(IOError):
+            DynamicModel().load(bfn)
+
+    def test_merge_binary(self):
+        token_lists = [tokenize_text("ccc bbb uu fff ccc ee ccc bbb Uu")[0],
+                       tokenize_text("bbb uu. aaaaa ccc ee ü")[0],
+                       []]
+
+        for model_class in [UnigramModel, DynamicModel, DynamicModelKN]:
+            ref = model_class()
+            merged = model_class()
+            for i, tokens in enumerate(token_lists):
+                ref.learn_tokens(tokens)
+
+                partial = model_class()
+                partial.learn_tokens(tokens)
+                fn = os.path.join(self._dir, "partial{}.lmb".format(i))
+                partial.save_binary(fn)
+                merged.merge_binary(fn)
+
+            self.assertEqual(sorted(merged.iter_ngrams()),
+                             sorted(ref.iter_ngrams()))
+
+        # The file's order must not exceed the model's.
+        with self.assertRaises(IOError):
+            DynamicModel(2).merge_binary(fn)
+        with self.assertRaises(IOError):
+            DynamicModel().merge_binary(os.path.join(self._dir, "none.lmb"))
+
+    def test_model_journal(self):
+        for model_class in [DynamicModel, CachedDynamicModel]:
+            self._test_model_journal(model_class)
+
+    def _test_model_journal(self, model_class):
+        fn = os.path.join(self._dir, model_class.__name__ + ".lm")
+        jfn = fn + ".journal"
+        ref = model_class()
+
+        def check(ref):
+            model = model_class()
+            if os.path.exists(fn):
+                model.load(fn)
+            journal = ModelJournal(jfn, fn)
+            journal.replay(model)
+            self.assertEqual(sorted(model.iter_ngrams()),
+                             sorted(ref.iter_ngrams()))
+            return model, journal
+
+        model, journal = check(ref)
+        model.journal = journal
+        for m in [model, ref]:
+            m.learn_tokens(tokenize_text("ccc bbb uu fff ccc ee ccc")[0])
+            m.learn_tokens(["bbb", "uu", "xx"], False)
+            m.remove_context(["ee"])
+        journal.flush()
+        check(ref)
+
+        # partially written records are dropped, then overwritten
+        with open(jfn, "ab") as f:
+            f.write(b"00000000 [\"l\", 1, \"uu")
+        model, journal = check(ref)
+        model.journal = journal
+        for m in [model, ref]:
+            m.learn_tokens(["bbb", "uu", "ccc"])
+        journal.flush()
+        check(ref)
+
+        # compact the first records into the base file
+        def compact(model, journal, interrupt):
+            end = journal.size
+            check(model)  # the journal replays onto a fresh base model
+            snapshot = model.snapshot()
+            for m in [model, ref]:
+                m.learn_tokens(["uu", "fff"])
+            journal.flush()
+            snapshot.save(fn + ".tmp")
+            journal.begin_rebase(journal.get_base_id(fn + ".tmp"), end)
+            os.rename(fn + ".tmp", fn)
+            if not interrupt:
+                journal.end_rebase()
+
+        compact(model, journal, True)
+        model, journal = check(ref)  # recovered from the rebased journal
+        model.journal = journal
+        compact(model, journal, False)
+        check(ref)
+
+        # stale journals are ignored, but kept aside
+        with open(jfn, "rb") as f:
+            data = f.read()
+        ref.save(fn)
+        model, journal = check(ref)
+        self.assertEqual(journal.stale_filename, jfn + ".stale")
+        self.assertFalse(os.path.exists(jfn))
+        with open(journal.stale_filename, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_learn_tokens(self):
+        token_lists = [[],
+                       ["<unk>"], ["<s>"], ["<s>", "<s>", "a"],
+                       ["a", "b", "<unk>", "c"], ["a", "b", "<s>", "c"],
+                       ["a", "<s>", "<unk>", "b", "<s>"],
+                       ["<unk>", "<s>", "<s>", "a", "b", "c", "d", "<unk>"],
+                       tokenize_text("ccc bbb. uu fff --- ccc ee 1 ccc bbb "
+                                     "Uu aaaaa cc. bbb uuu")[0]]
+
+        for model_class in [UnigramModel, DynamicModel,
+                            DynamicModelKN, CachedDynamicModel]:
+            for tokens in token_lists:
+                for allow_new_words in [True, False]:
+                    model = model_class()
+                    model.learn_tokens(["a", "b", "ccc"])
+                    ref = model_class()
+                    ref.learn_tokens(["a", "b", "ccc"])
+
+                    model.learn_tokens(tokens, allow_new_words)
+                    for ngram in ref._extract_ngrams(tokens):
+                        ref.count_ngram(ngram, 1, allow_new_words)
+
+                    self.assertEqual(list(model.iter_ngrams()),
+                                     list(ref.iter_ngrams()))
+                    self.assertTrue(model.modified)
+
+    def test_maintenance(self):
+        tokens = tokenize_text("ccc bbb uu fff ccc ee ccc bbb Uu")[0]
+        model = DynamicModel()
+        model.learn_tokens(tokens)
+
+        counts, totals = model.get_counts()
+        ngrams = list(model.iter_ngrams())
+        for level in range(model.order):
+            level_ngrams = [ng for ng in ngrams if len(ng[0]) == level+1]
+            self.assertEqual(counts[level], len(level_ngrams))
+            self.assertEqual(totals[level], sum(ng[1] for ng in level_ngrams))
+
+        self.assertEqual(model.copy(DynamicModel()).get_counts()[0], counts)
+        self.assertEqual(model.prune([1]).get_counts(),
+                         ([6, 1, 0], [9, 2, 0]))
+        self.assertEqual(model.prune([0, -1]).order, 2)
+        with self.assertRaises(TypeError):
+            model.copy_to(overlay([model]))
+
+        self.assertEqual(model.get_remove_context_changes(["ccc", "bbb"]),
+                         {("ccc", "bbb"): -2, ("ccc", "bbb", "uu"): -1,
+                          ("ccc", "bbb", "Uu"): -1,
+                          ("ee", "ccc", "bbb"): -1})
+        self.assertEqual(model.get_remove_context_changes(["xyz"]), {})
+
+        model.modified = False
+        changes = model.remove_context(["bbb"])
+        self.assertEqual(len(changes), 8)
+        self.assertEqual(model.get_ngram_count(["bbb"]), 0)
+        self.assertTrue(model.modified)
+
+    def test_prediction_session(self):
+        tokens = tokenize_text("ccc bbb uu fff ccc ee ccc bbb Uu "
+                               "cca ccb bbb uuu")[0]
+        model1 = CachedDynamicModel()
+        model1.learn_tokens(tokens)
+        model2 = DynamicModel()
+        model2.learn_tokens(tokens[::-1])
+
+        for model in [model1, overlay([model1, model2]),
+                      linint([model1, model2])]:
+            session = PredictionSession(model)
+            self.assertIs(session.model, model)
+
+            # Typing a word, session and model have to agree.
+            for context in [["ccc", ""], ["ccc", "c"], ["ccc", "cc"],
+                            ["ccc", "ccb"], ["ccc", "c"], ["bbb", "u"],
+                            ["bbb", "uu"]]:
+                for options in [0, LanguageModel.CASE_INSENSITIVE]:
+                    self.assertEqual(session.predictp(context,
+                                                      options=options),
+                                     model.predictp(context,
+                                                    options=options))
+
+            # Learning invalidates the cached candidates.
+            self.assertEqual(session.predict(["ccc", "cc"]),
+                             model.predict(["ccc", "cc"]))
+            model1.learn_tokens(["ccc", "ccd", "ccd"])
+            model1.recency_ratio = 0.5
+            self.assertEqual(session.predictp(["ccc", "ccd"]),
+                             model.predictp(["ccc", "ccd"]))
+            self.assertEqual(session.predictp(["ccc", "ccd"], 1),
+                             model.predictp(["ccc", "ccd"], 1))
+
+            session.reset()
+            self.assertEqual(session.predictp(["ccc", "c"]),
+                             model.predictp(["ccc", "c"]))
+
+    def test_simulate_typing(self):
+        text = "ccc bbb uu fff. ccc ee ccc bbb Uu. cca ccb bbb uuu. " \
+               "ccc bbb uu ccb. uu fff ccc ee."
+        sentences = split_sentences(text)[0]
+        num_chars = sum(len(s) for s in sentences)
+        model = DynamicModel()
+        model.learn_tokens(tokenize_text(text)[0])
+
+        result = simulate_typing(model, None, sentences, 3)
+        self.assertEqual(result[0], num_chars)
+        self.assertLess(result[1], num_chars)
+        self.assertEqual(simulate_typing(model, None, sentences, 3, jobs=3),
+                         result)
+
+        # Learning sentence by sentence saves keystrokes on repetitions.
+        learn_model = CachedDynamicModel()
+        result = simulate_typing(learn_model, learn_model, sentences, 3)
+        self.assertEqual(result[0], num_chars)
+        self.assertLess(result[1], num_chars)
+        self.assertEqual(learn_model.get_ngram_count(["bbb", "uu"]), 2)
+        self.assertTrue(learn_model.modified)
+
+        # Forked processes don't learn into the caller's models.
+        learn_model = CachedDynamicModel()
+        simulate_typing(learn_model, learn_model, sentences, 3, jobs=2)
+        self.assertEqual(learn_model.get_ngram_count(["bbb", "uu"]), 0)
+
+        # Learning would bypass the journal.
+        learn_model.journal = ModelJournal(
+            os.path.join(self._dir, "typing.lm.journal"),
+            os.path.join(self._dir, "typing.lm"))
+        with self.assertRaises(ValueError):
+            simulate_typing(model, learn_model, sentences, 3)
+
+    def test_get_probabilities(self):
+        tokens = tokenize_text("ccc bbb uu fff. ccc ee ccc bbb Uu. "
+                               "cca ccb bbb uuu")[0]
+        model1 = DynamicModel()
+        model1.learn_tokens(tokens)
+        model2 = CachedDynamicModel()
+        model2.learn_tokens(tokens[::-1])
+        test_tokens = tokens + ["xyz", "ccc", "bbb"]
+
+        for model in [model1, model2, overlay([model1, model2]),
+                      linint([model1, model2], [0.3, 0.7]),
+                      loglinint([model1, model2])]:
+            for order in [1, 2, 3]:
+                probabilities = model.get_probabilities(test_tokens, order)
+                self.assertEqual(probabilities.typecode, "d")
+                self.assertEqual(len(probabilities), len(test_tokens))
+                for i, p in enumerate(probabilities):
+                    ngram = test_tokens[max(i-(order-1), 0):i+1]
+                    self.assertAlmostEqual(p, model.get_probability(ngram),
+                                           places=12)
+
+        self.assertEqual(len(model1.get_probabilities([], 3)), 0)
+
+        sentence = tokens[:4]
+        ps = [model1.get_probability(sentence[max(i-2, 0):i+1])
+              for i in range(1, len(sentence))]
+        self.assertAlmostEqual(entropy(model1, sentence)[0],
+                               -sum(math.log(p, 2) for p in ps) / 4)
+
+    def test_recency_sums(self):
+        tokens = tokenize_text("ccc bbb uu fff ccc ee ccc bbb Uu "
+                               "cca ccb bbb uuu. Uu ccc, bbb")[0]
+        model = CachedDynamicModel()
+        model.recency_ratio = 0.5
+        contexts = [[""], ["ccc", ""], ["ccc", "bbb", "u"], ["xyz", ""]]
+
+        # Sums of recency weights are updated incrementally while
+        # learning, changing the halflife calculates them from scratch.
+        for i in range(len(tokens)):
+            model.learn_tokens(tokens[i:i+3])
+            if i == 5:
+                model.remove_context(["bbb"])
+            if i == 10:
+                model.recency_halflife = 5
+
+            results = [model.predictp(context) for context in contexts]
+            halflife = model.recency_halflife
+            model.recency_halflife = halflife + 1
+            model.predictp([""])
+            model.recency_halflife = halflife
+            expected = [model.predictp(context) for context in contexts]
+
+            for rs, es in zip(results, expected):
+                self.assertEqual([r[0] for r in rs], [e[0] for e in es])
+                for r, e in zip(rs, es):
+                    self.assertAlmostEqual(r[1], e[1], places=12)
+
+    def test_frozen_model(self):
+        fn = os.path.join(self._dir, "model.lm")
+        bfn = os.path.join(self._dir, "model.lmb")
+        tokens = tokenize_text("ccc bbb uu fff ccc ee ccc bbb Uu "
+                               "cca ccb bbb uuu")[0]
+        model = DynamicModel()
+        model.learn_tokens(tokens)
+        model.remove_context(["fff"])   # keeps n-grams with count 0
+        model.save(fn)
+        model.save_binary(bfn)
+
+        frozen_models = []
+        for filename in [fn, bfn, None]:
+            frozen = FrozenModel()
+            if filename:
+                frozen.load(filename)
+            else:
+                frozen.freeze(model)
+            frozen_models.append(frozen)
+
+        for frozen in frozen_models:
+            self.assertEqual(frozen.order, model.order)
+            self.assertEqual(frozen.get_ngram_count(["ccc", "bbb"]), 2)
+            self.assertEqual(frozen.get_ngram_count(["ccc", "xyz"]), 0)
+            for smoothing in ["witten-bell", "abs-disc"]:
+                model.smoothing = smoothing
+                frozen.smoothing = smoothing
+                for context in [[""], ["ccc", ""], ["c"], ["ccc", "bbb", "u"],
+                                ["xyz", "c"], ["fff", ""], ["ee", "f"]]:
+                    for options in [0, LanguageModel.NORMALIZE,
+                                    LanguageModel.CASE_INSENSITIVE]:
+                        # Words are sorted in frozen models, ties
+                        # may come in a different order.
+                        self.assertEqual(
+                            sorted(frozen.predictp(context,
+                                                   options=options)),
+                            sorted(model.predictp(context,
+                                                  options=options)))
+
+        # Precomputed probabilities, same results within float precision
+        for smoothing in ["witten-bell", "abs-disc"]:
+            model.smoothing = smoothing
+            frozen.smoothing = smoothing
+            generation = frozen.generation
+            frozen.precompute = True
+            self.assertNotEqual(frozen.generation, generation)
+            for context in [[""], ["ccc", ""], ["ccc", "bbb", ""],
+                            ["xyz", "bbb", "u"], ["fff", ""],
+                            ["uu", ""], ["bbb", "uu", ""]]:
+                results = dict(frozen.predictp(context))
+                expected = dict(model.predictp(context))
+                self.assertEqual(sorted(results), sorted(expected))
+                for word, p in expected.items():
+                    self.assertAlmostEqual(results[word], p, places=6)
+            frozen.precompute = False
+        self.assertEqual(frozen.memory_size()[-1], 0)
+
+        with self.assertRaises(ValueError):
+            frozen.smoothing = "kneser-ney"
+        with self.assertRaises(TypeError):
+            frozen.freeze(overlay([model]))
+        with self.assertRaises(TypeError):
+            frozen.learn_tokens(tokens)
+        with self.assertRaises(TypeError):
+            frozen.remove_context(["ccc"])
+        with self.assertRaises(TypeError):
+            frozen.copy(FrozenModel())
+
+        # Copies of frozen models are dynamic models.
+        def ngrams(model):
+            return sorted(ng for ng in model.iter_ngrams() if ng[1])
+        for frozen in frozen_models:
+            self.assertEqual(ngrams(frozen.copy(DynamicModel())),
+                             ngrams(model.copy(DynamicModel())))
+            for prune_counts in [[0], [1], [0, 1], [-1, 1], [0, -1]]:
+                pruned = frozen.prune(prune_counts)
+                self.assertEqual(type(pruned), DynamicModel)
+                self.assertEqual(pruned.order,
+                                 model.prune(prune_counts).order)
+                self.assertEqual(ngrams(pruned),
+                                 ngrams(model.prune(prune_counts)))
+
+        # Frozen models save in the binary format.
+        frozen.save(fn)
+        self.assertEqual(read_order(fn), model.order)
+        frozen = FrozenModel()
+        frozen.load(fn)
+        self.assertEqual(frozen.predictp(["ccc", ""]),
+                         model.predictp(["ccc", ""]))
+
+        # Saving over the file it has mapped
+        frozen.save(fn)
+        self.assertEqual(frozen.predictp(["ccc", ""]),
+                         model.predictp(["ccc", ""]))
+        frozen.load(fn)
+        self.assertEqual(frozen.predictp(["ccc", ""]),
+                         model.predictp(["ccc", ""]))
+
+        # Corrupted payload
+        with open(bfn, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            c = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([c[0] ^ 0xff]))
+        with self.assertRaises(IOError):
+            FrozenModel().load(bfn)
+
+    def test_merged_model_threads(self):
+        tokens = tokenize_text("ccc bbb uu fff ccc ee ccc bbb Uu "
+                               "cca ccb bbb uuu")[0]
+        contexts = [[""], ["ccc", ""], ["ccc", "c"], ["bbb", "u"], ["C"]]
+
+        def create_models():
+            model1 = DynamicModel()
+            model1.learn_tokens(tokens)
+            model2 = UnigramModel()
+            model2.learn_tokens(tokens[::-1])
+            return [overlay([model1, model2]),
+                    linint([model1, model2, model1]), # same model twice
+                    overlay([linint([model1, model2]), model2])]
+
+        def predict(models):
+            return [model.predictp(context, options=options)
+                    for model in models
+                    for context in contexts
+                    for options in [0, LanguageModel.CASE_INSENSITIVE]]
+
+        expected = predict(create_models())
+
+        # Predictions release the GIL, models used by different
+        # threads must not interfere.
+        results = [None] * 4
+        def run(i):
+            models = create_models()
+            for _ in range(20):
+                results[i] = predict(models)
+
+        threads = [threading.Thread(target=run, args=(i,))
+                   for i in range(len(results))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for result in results:
+            self.assertEqual(result, expected)
+
+    def test_shared_model_threads(self):
+        tokens = tokenize_text("ccc bbb uu fff ccc ee ccc bbb Uu "
+                               "cca ccb bbb uuu")[0]
+        contexts = [[""], ["ccc", ""], ["ccc", "c"], ["bbb", "u"], ["C"]]
+        model1 = DynamicModel()
+        model2 = UnigramModel()
+        model2.learn_tokens(tokens)
+        merged = [overlay([model1, model2]),
+                  linint([model1, model2]),
+                  overlay([linint([model1, model2]), model2])]
+
+        # Models shared between threads are used one thread at a time,
+        # learning must not interfere with predictions.
+        def learn(model):
+            for i in range(200):
+                model.learn_tokens(tokens + ["w" + str(i), "ccc"])
+                model.count_ngram(["fff", "ee"])
+
+        def predict():
+            session = PredictionSession(merged[0])
+            for _ in range(20):
+                for model in merged:
+                    for context in contexts:
+                        model.predictp(context)
+                        session.predict(context)
+                model1.lookup_word("ccc")
+                model1.get_probabilities(tokens, 2)
+
+        threads = [threading.Thread(target=learn, args=(model1,))] + \
+                  [threading.Thread(target=predict) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        model = DynamicModel()
+        learn(model)
+        self.assertEqual(sorted(model1.iter_ngrams()),
+                         sorted(model.iter_ngrams()))
+
+    def test_merged_model_vocabulary(self):
+        tokens = tokenize_text("ccc bbb uu fff ccc ee ccc bbb Uu")[0]
+        contexts = [[""], ["ccc", ""], ["ccc", "c"], ["bbb", "u"]]
+        model1 = DynamicModel()
+        model1.learn_tokens(tokens)
+        model2 = UnigramModel()
+        model2.learn_tokens(tokens[::-1])
+        fn = os.path.join(self._dir, "model.lm")
+        DynamicModel().save(fn)
+
+        def create_merged():
+            return [overlay([model1, model2]),
+                    linint([model1, model2]),
+                    loglinint([model2, model1]),
+                    overlay([linint([model1, model2]), model2])]
+
+        def predict(models):
+            return [model.predictp(context, options=options)
+                    for model in models
+                    for context in contexts
+                    for options in [0, LanguageModel.NORMALIZE]]
+
+        # Merged models remember word ids of their components,
+        # they must notice when those change.
+        merged = create_merged()
+        for change in [lambda: model1.learn_tokens(["cca", "ccc", "ee"]),
+                       lambda: model2.clear(),
+                       lambda: model2.learn_tokens(["ee", "bbb", "ccb"]),
+                       lambda: model1.load(fn),
+                       lambda: model1.learn_tokens(tokens[::-1])]:
+            predict(merged)
+            change()
+            self.assertEqual(predict(merged), predict(create_merged()))
+
+    def test_post_filter_options(self):
+        tokens = tokenize_text("Word word1 Word1 Word2 <bot:txt> word3 "
+                               "WORD woRD Wo wo <bot:txt> Wo")[0]
+        model1 = DynamicModel()
+        model1.learn_tokens(tokens)
+        model2 = UnigramModel()
+        model2.learn_tokens(["word", "Wow", "wow"])
+
+        def reference(model, context, limit, options):
+            choices = []
+            for choice in model.predict(context, options=options & 0xff):
+                if options & LanguageModel.IGNORE_MARKERS and \
+                   choice.startswith("<") and choice.endswith(">"):
+                    continue
+                if options & LanguageModel.PREFER_LOWER_CASE:
+                    lower = choice.lower()
+                    if choice != lower and model.lookup_word(lower) == 1:
+                        continue
+                if options & LanguageModel.CAPITALIZE:
+                    choice = choice[:1].upper() + choice[1:]
+                    if not choice or choice in choices:
+                        continue
+                choices.append(choice)
+            return choices[:limit] if limit >= 0 else choices
+
+        options = [LanguageModel.IGNORE_MARKERS,
+                   LanguageModel.PREFER_LOWER_CASE,
+                   LanguageModel.CAPITALIZE,
+                   LanguageModel.IGNORE_MARKERS |
+                   LanguageModel.PREFER_LOWER_CASE |
+                   LanguageModel.CAPITALIZE |
+                   LanguageModel.CASE_INSENSITIVE]
+        for model in [model1, overlay([model1, model2])]:
+            for context in [[""], ["w"], ["W"], ["Word1", ""]]:
+                for opt in options:
+                    for limit in [-1, 1, 3]:
+                        self.assertEqual(model.predict(context, limit, opt),
+                                         reference(model, context,
+                                                   limit, opt))
+
+        choices = model1.predict([""], -1, LanguageModel.CAPITALIZE)
+        self.assertIn("<bot:txt>", choices)
+        self.assertEqual(len(choices), len(set(choices)))
+        self.assertIn("WoRD", choices)
+
+        # Lower case spellings only count in the lookup models.
+        merged = overlay([model1, model2])
+        opt = LanguageModel.PREFER_LOWER_CASE
+        self.assertNotIn("Wow", merged.predict(["W"], -1, opt))
+        self.assertNotIn("Word", merged.predict(["W"], -1, opt))
+        merged.set_lookup_models([model1])
+        self.assertIn("Wow", merged.predict(["W"], -1, opt))
+        self.assertIn("Word", merged.predict(["W"], -1, opt))
+        self.assertNotIn("Wo", merged.predict(["W"], -1, opt))
+        self.assertEqual(merged.lookup_word("wow"), 0)
+        with self.assertRaises(ValueError):
+            merged.set_lookup_models([DynamicModel()])
+
+    def test_fuzzy_prefix(self):
+        words = ("the there these then their other tent teeth test tests "
+                 "text toast täst Test Tester THERE thereafter sometimes "
+                 "somewhere someone sundown résumé resume Tent "
+                 "<bot:txt>").split()
+        model = DynamicModel()
+        model.learn_tokens(words)
+        fn = os.path.join(self._dir, "fuzzy.lm")
+        model.save(fn)
+        loaded = DynamicModel()  # unsorted dictionary after loading
+        loaded.load(fn)
+
+        def remove_accent(c):
+            return unicodedata.normalize("NFD", c)[0]
+
+        def matches(pc, wc, options):
+            # prefix character pc matches word character wc
+            if options & LanguageModel.CASE_INSENSITIVE_SMART:
+                if not pc.isupper():
+                    wc = wc.lower()
+            elif options & LanguageModel.CASE_INSENSITIVE:
+                wc = wc.lower()
+            if options & LanguageModel.ACCENT_INSENSITIVE_SMART:
+                if remove_accent(pc) == pc:
+                    wc = remove_accent(wc)
+            elif options & LanguageModel.ACCENT_INSENSITIVE:
+                wc = remove_accent(wc)
+            return pc == wc
+
+        def distance(a, b, options):
+            # optimal string alignment distance
+            d = [[i + j if not i or not j else 0
+                  for j in range(len(b) + 1)] for i in range(len(a) + 1)]
+            for i in range(1, len(a) + 1):
+                for j in range(1, len(b) + 1):
+                    d[i][j] = min(d[i-1][j] + 1, d[i][j-1] + 1,
+                                  d[i-1][j-1] +
+                                  (not matches(a[i-1], b[j-1], options)))
+                    if i > 1 and j > 1 and \
+                       matches(a[i-1], b[j-2], options) and \
+                       matches(a[i-2], b[j-1], options):
+                        d[i][j] = min(d[i][j], d[i-2][j-2] + 1)
+            return d[len(a)][len(b)]
+
+        def reference(prefix, options):
+            k = 0 if len(prefix) < 3 else 1 if len(prefix) < 7 else 2
+            if options & LanguageModel.CASE_INSENSITIVE and \
+               not options & LanguageModel.CASE_INSENSITIVE_SMART:
+                prefix = prefix.lower()
+            if options & LanguageModel.ACCENT_INSENSITIVE and \
+               not options & LanguageModel.ACCENT_INSENSITIVE_SMART:
+                prefix = "".join(remove_accent(c) for c in prefix)
+            choices = set()
+            for word in words:
+                if min(distance(prefix, word[:i], options)
+                       for i in range(len(word) + 1)) <= k:
+                    choices.add(word)
+            return choices
+
+        for m in [model, loaded]:
+            for prefix in ["th", "teh", "thre", "Tset", "tast", "tehre",
+                           "somwhere", "smoetimes", "xyz", "<bo", "Tes",
+                           "Tent", "rés", "résu", "tés", "Thre"]:
+                for opt in [0,
+                            LanguageModel.CASE_INSENSITIVE,
+                            LanguageModel.CASE_INSENSITIVE_SMART,
+                            LanguageModel.ACCENT_INSENSITIVE,
+                            LanguageModel.ACCENT_INSENSITIVE_SMART,
+                            LanguageModel.CASE_INSENSITIVE_SMART |
+                            LanguageModel.ACCENT_INSENSITIVE_SMART]:
+                    opt |= LanguageModel.FUZZY_PREFIX
+                    choices = m.predict([prefix], -1, opt)
+                    self.assertEqual(len(choices), len(set(choices)))
+                    self.assertEqual(set(choices), reference(prefix, opt),
+                                     (prefix, opt))
+
+            # exact completions rank before typo-tolerant ones
+            choices = m.predict(["tes"], -1, LanguageModel.FUZZY_PREFIX)
+            self.assertEqual(set(choices[:2]), {"test", "tests"})
+            self.assertIn("teeth", choices)
+            self.assertNotIn("toast", choices)
+            self.assertEqual(m.predict(["th"], -1, LanguageModel.FUZZY_PREFIX),
+                             m.predict(["th"], -1))
+
+            # smart options, upper case and accents must match exactly
+            opt = LanguageModel.ACCENT_INSENSITIVE_SMART
+            choices = m.predict(["Tes"], -1, opt | LanguageModel.FUZZY_PREFIX)
+            self.assertEqual(set(choices[:2]), set(m.predict(["Tes"], -1, opt)))
+            self.assertEqual(set(choices[:2]), {"Test", "Tester"})
+            choices = m.predict(["rés"], -1, opt | LanguageModel.FUZZY_PREFIX)
+            self.assertEqual(choices[0], "résumé")
+            self.assertLess(choices.index("résumé"), choices.index("resume"))
+            opt = LanguageModel.CASE_INSENSITIVE_SMART
+            choices = m.predict(["Tent"], -1, opt | LanguageModel.FUZZY_PREFIX)
+            self.assertEqual(choices[0], "Tent")
+
+        # Frequent near misses still rank after rare exact completions,
+        # in merged models, too.
+        model = DynamicModel()
+        model.learn_tokens(["the"] * 500 + ["thx"] + ["then"] * 50)
+        unigrams = UnigramModel()
+        unigrams.learn_tokens(["the"] * 100 + ["thxyz"])
+        session = PredictionSession(model)
+        for m in [model, session, overlay([model, unigrams]),
+                  linint([model, unigrams]), loglinint([model, unigrams])]:
+            for limit in [-1, 1, 5]:
+                choices = m.predict(["thx"], limit,
+                                    LanguageModel.FUZZY_PREFIX)
+                if m in (model, session):
+                    expected = ["thx", "the", "then"]
+                    self.assertEqual(choices, expected[:limit]
+                                              if limit >= 0 else expected)
+                else:
+                    self.assertLessEqual(set(choices[:2]), {"thx", "thxyz"})
+                    if limit != 1:
+                        self.assertIn("the", choices)
+
+    def test_snapshot(self):
+        tokens = tokenize_text("word1 word2 Wörd3 word1 <s> word2 word4 "
+                               "<unk> word1 word2")[0]
+        fn1 = os.path.join(self._dir, "saved.lm")
+        fn2 = os.path.join(self._dir, "snapshot.lm")
+        for model in [UnigramModel(), DynamicModel(), DynamicModelKN(),
+                      CachedDynamicModel()]:
+            model.learn_tokens(tokens)
+            model.remove_context(["word4"])
+
+            generation = model.generation
+            model.save(fn1)
+            snapshot = model.snapshot()
+            self.assertEqual(model.generation, generation)
+
+            # the snapshot doesn't change with the model
+            model.learn_tokens(["word5", "word1"])
+            self.assertNotEqual(model.generation, generation)
+            snapshot.save(fn2)
+            with open(fn1, "rb") as f1, open(fn2, "rb") as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+            self.assertRaises(IOError, snapshot.save,
+                              os.path.join(self._dir, "none", "x.lm"))
+
     def test_read_order(self):
         """ Test reading the order of a language model """
         fn = os.path.join(self._dir, "model.lm")
@@ -891,6 +1718,8 @@ class _TestModel(unittest.TestCase):
         model.learn_tokens(tokens)
         model.save(fn)
         self.assertEqual(read_order(fn), 3)
+        model.save_binary(fn)
+        self.assertEqual(read_order(fn), 3)
 
 
 def suite():
@@ -1070,6 +1899,9 @@ def suite():
         suite.addTest(_TestTokenization('test_split_sentences', a[0], a[3]))
     suites.append(suite)
 
+    suite = unittest.TestLoader().loadTestsFromTestCase(_TestNativeTokenizer)
+    suites.append(suite)
+
     suite = unittest.TestSuite()
     for i,a in enumerate(sentence_pattern_tests):
         suite.addTest(_TestPatterns('test_sentence_pattern', a[0], a[1]))
@@ -0,0 +1,527 @@
+#!/usr/bin/python3
+
+# Copyright © 2026 agent <agent@local>
+#
+# This file is part of Onboard.
+#
+# Onboard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Onboard is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+import sys
+import tempfile
+import threading
+import subprocess
+import unittest
+from concurrent.futures import wait
+
+from Onboard.SpellChecker import SpellChecker, CorrectWordFilter, \
+                                 aspell_cmd
+
+
+class TestCorrectWordFilter(unittest.TestCase):
+
+    AFF = ("SET UTF-8\n"
+           "FLAG long\n"
+           "AF 2\n"
+           "AF EdSs\n"
+           "AF Un\n"
+           "PFX Un Y 1\n"
+           "PFX Un 0 un .\n"
+           "SFX Ed Y 2\n"
+           "SFX Ed 0 ed [^y]\n"
+           "SFX Ed y ied y\n"
+           "SFX Ss Y 2\n"
+           "SFX Ss 0 s [^y]\n"
+           "SFX Ss y ies [^aeiou]y\n")
+
+    DIC = ("3\n"
+           "walk/1\n"
+           "fly/1\n"
+           "fold/2\n")
+
+    WORDS = ["walk", "walked", "walks", "fly", "flied", "flies",
+             "fold", "unfold"]
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="test_onboard_")
+        self._dir = self._tmp_dir.name
+        self._aff = self._write("test.aff", self.AFF)
+        self._dic = self._write("test.dic", self.DIC)
+        self._filename = os.path.join(self._dir, "cache", "test.filter")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _write(self, name, text):
+        filename = os.path.join(self._dir, name)
+        with open(filename, "w", encoding="UTF-8") as f:
+            f.write(text)
+        return filename
+
+    def test_read_affixes(self):
+        flag_type, aliases, prefixes, suffixes = \
+            CorrectWordFilter._read_affixes(self._aff, "utf-8")
+        self.assertEqual(flag_type, "long")
+        self.assertEqual(aliases, ["EdSs", "Un"])
+        self.assertEqual(sorted(prefixes), ["Un"])
+        self.assertEqual(sorted(suffixes), ["Ed", "Ss"])
+
+        # The first AF line is the count, even if aliases are numeric.
+        aff = self._write("num.aff",
+                          "FLAG num\n"
+                          "AF 2\n"
+                          "AF 5\n"
+                          "AF 5,7\n"
+                          "SFX 5 Y 1\n"
+                          "SFX 5 0 s .\n"
+                          "SFX 7 Y 1\n"
+                          "SFX 7 0 ed .\n")
+        flag_type, aliases, prefixes, suffixes = \
+            CorrectWordFilter._read_affixes(aff, "utf-8")
+        self.assertEqual(flag_type, "num")
+        self.assertEqual(aliases, ["5", "5,7"])
+
+        dic = self._write("num.dic", "2\nwalk/1\njump/2\n")
+        self.assertEqual(sorted(CorrectWordFilter._expand_dic(dic, aff,
+                                                              "utf-8")),
+                         ["jump", "jumped", "jumps", "walk", "walks"])
+
+    def test_expand_dic(self):
+        words = CorrectWordFilter._expand_dic(self._dic, self._aff, "utf-8")
+        self.assertEqual(sorted(words), sorted(self.WORDS))
+
+    def test_build_and_load(self):
+        wf = CorrectWordFilter.build(self._filename, self._dic, self._aff)
+        self.assertEqual(len(wf), len(self.WORDS))
+        for word in self.WORDS:
+            self.assertIn(word, wf)
+        self.assertNotIn("walkz", wf)
+
+        # memory mapped on the next start
+        wf = CorrectWordFilter.load(self._filename, self._dic, self._aff)
+        self.assertIsNotNone(wf)
+        self.assertIsInstance(wf._hashes, memoryview)
+        self.assertEqual(len(wf), len(self.WORDS))
+        for word in self.WORDS:
+            self.assertIn(word, wf)
+        self.assertNotIn("walkz", wf)
+        self.assertEqual(os.listdir(os.path.dirname(self._filename)),
+                         ["test.filter"])
+
+    def test_load_outdated(self):
+        self.assertIsNone(CorrectWordFilter.load(self._filename,
+                                                 self._dic, self._aff))
+        CorrectWordFilter.build(self._filename, self._dic, self._aff)
+
+        # the dictionary changed, the filter has to be rebuilt
+        self._write("test.dic", self.DIC.replace("3\n", "4\n") + "jump/1\n")
+        self.assertIsNone(CorrectWordFilter.load(self._filename,
+                                                 self._dic, self._aff))
+
+        # truncated file
+        CorrectWordFilter.build(self._filename, self._dic, self._aff)
+        with open(self._filename, "r+b") as f:
+            f.truncate(CorrectWordFilter.HEADER.size + 4)
+        self.assertIsNone(CorrectWordFilter.load(self._filename,
+                                                 self._dic, self._aff))
+
+
+class TestSCBackend(unittest.TestCase):
+
+    # Speaks the "ispell -a" protocol. Words starting with "x" are
+    # misspelled with suggestions, words starting with "q" without.
+    # Exits after answering argv[1] lines, if given.
+    SCRIPT = r"""
+import sys, re
+max_lines = int(sys.argv[1]) if len(sys.argv) > 1 else -1
+sys.stdout.write("@(#) International Ispell (scripted)\n")
+sys.stdout.flush()
+for i, line in enumerate(sys.stdin):
+    if i == max_lines:
+        break
+    line = line.rstrip("\n")[1:]
+    for m in re.finditer(r"\S+", line):
+        w = m.group()
+        if w.startswith("x"):
+            sys.stdout.write("& {} 2 {}: {}, {}\n".format(
+                w, m.start() + 1, w[1:] * 20, w.upper() * 20))
+        elif w.startswith("q"):
+            sys.stdout.write("# {} {}\n".format(w, m.start() + 1))
+    sys.stdout.write("\n")
+    sys.stdout.flush()
+"""
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="test_onboard_")
+        self._script = os.path.join(self._tmp_dir.name, "ispell.py")
+        with open(self._script, "w") as f:
+            f.write(self.SCRIPT)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _start(self, *args):
+        backend = aspell_cmd()
+        backend._p = subprocess.Popen([sys.executable, self._script] +
+                                      [str(a) for a in args],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+        backend._p.stdout.readline() # skip header line
+        self.addCleanup(self._stop, backend)
+        return backend
+
+    @staticmethod
+    def _stop(backend):
+        p = backend._p
+        if p:
+            p.stdin.close()
+            p.stdout.close()
+            p.wait()
+
+    def test_read_reply(self):
+        class Process:
+            stdout = io.BytesIO(b"& xab 2 1: ab, AB\n"
+                                b"# qc 5\n"
+                                b"*\n"
+                                b"\n"
+                                b"\n")
+        backend = aspell_cmd()
+        backend._p = Process()
+        self.assertEqual(backend._read_reply(),
+                         [[[0, 3, "xab"], ["ab", "AB"]],
+                          [[4, 6, "qc"], []]])
+        self.assertEqual(backend._read_reply(), [])
+        self.assertEqual(backend._read_reply(), None)  # end of output
+
+    def test_query_many(self):
+        backend = self._start()
+        texts = ["ok", "xab", "qz", "a xb qc", "", "xc\nqd"]
+        results = backend.query_many(texts)
+        self.assertEqual(results,
+                         [backend.query(text) for text in texts])
+        self.assertEqual(results[:4],
+            [[],
+             [[[0, 3, "xab"], ["ab" * 20, "XAB" * 20]]],
+             [[[0, 2, "qz"], []]],
+             [[[2, 4, "xb"], ["b" * 20, "XB" * 20]],
+              [[5, 7, "qc"], []]]])
+        self.assertEqual(results[5],
+                         [[[0, 2, "xc"], ["c" * 20, "XC" * 20]],
+                          [[3, 5, "qd"], []]])
+
+    def test_max_pending_lines(self):
+        # Large replies, the pipes would fill up without the window.
+        backend = self._start()
+        texts = ["x" + str(i) * 50 for i in range(2000)]
+        results = backend.query_many(texts)
+        self.assertEqual(len(results), len(texts))
+        self.assertEqual([r[0][0][2] for r in results], texts)
+
+        # Never more lines than the window ahead of the replies.
+        class Pipe:
+            written = 0
+            flushed = 0
+            read = 0
+            max_pending = 0
+        pipe = Pipe()
+
+        class Stdin:
+            def write(self, data):
+                pipe.written += 1
+            def flush(self):
+                pipe.flushed = pipe.written
+
+        class Stdout:
+            def readline(self):
+                pending = pipe.flushed - pipe.read
+                assert pending > 0, "reading unflushed lines"
+                pipe.max_pending = max(pipe.max_pending, pending)
+                pipe.read += 1
+                return b"\n"
+
+        class Process:
+            stdin = Stdin()
+            stdout = Stdout()
+            def poll(self):
+                return None
+
+        backend = aspell_cmd()
+        backend._p = Process()
+        self.assertEqual(backend.query_many(["a"] * 100), [[]] * 100)
+        self.assertEqual(pipe.max_pending, backend.MAX_PENDING_LINES)
+
+    def test_process_exits(self):
+        # Unanswered lines have no results, they aren't correct words.
+        backend = self._start(3)
+        results = backend.query_many(["xa", "ok", "qb", "ok", "xc"] * 20)
+        self.assertEqual(results[:3],
+                         [[[[0, 2, "xa"], ["a" * 20, "XA" * 20]]],
+                          [],
+                          [[[0, 2, "qb"], []]]])
+        self.assertEqual(results[3:], [None] * 97)
+
+        backend._p.wait()
+        self.assertFalse(backend.is_running())
+        self.assertEqual(backend.query("ok"), None)
+
+
+class _FakeBackend(object):
+    """ Backend knowing a few misspellings, counts the words queried. """
+
+    def __init__(self, misspellings):
+        self.misspellings = misspellings
+        self.running = True
+        self.dict_ids = ["en_US"]
+        self.queried = []
+
+    def start(self, dict_ids = None):
+        self.dict_ids = dict_ids
+
+    def stop(self):
+        self.dict_ids = []
+
+    def is_running(self):
+        return self.running
+
+    def query(self, text):
+        self.queried.append(text)
+        suggestions = self.misspellings.get(text)
+        if suggestions is None:
+            return []
+        return [[[0, len(text)], suggestions]]
+
+    def query_many(self, texts):
+        return [self.query(text) for text in texts]
+
+    def get_supported_dict_ids(self):
+        return ["en_US", "de_DE"]
+
+    def get_active_dict_ids(self):
+        return self.dict_ids
+
+
+class TestSpellCheckerCache(unittest.TestCase):
+
+    MISSPELLINGS = {"teh" : ["the"], "wrod" : ["word"],
+                    "speling" : ["spelling"], "adn" : ["and"]}
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="test_onboard_")
+        self._cache_dir = os.path.join(self._tmp_dir.name, "cache")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _new_checker(self):
+        checker = SpellChecker(cache_dir = self._cache_dir)
+        checker._backend = _FakeBackend(self.MISSPELLINGS)
+        return checker
+
+    def test_evict_least_recently_used_misspelling(self):
+        checker = self._new_checker()
+        checker.MAX_QUERY_CACHE_SIZE = 3
+        backend = checker._backend
+        for word in ["teh", "wrod", "speling", "teh", "adn"]:
+            self.assertEqual(checker.query_cached(word),
+                             [[[0, len(word)], self.MISSPELLINGS[word]]])
+
+        self.assertEqual(backend.queried, ["teh", "wrod", "speling", "adn"])
+        self.assertEqual(list(checker._cached_queries),
+                         ["speling", "teh", "adn"])
+
+        checker.query_cached("wrod")
+        self.assertEqual(backend.queried[-1], "wrod")
+        self.assertEqual(list(checker._cached_queries),
+                         ["teh", "adn", "wrod"])
+
+    def test_correct_words(self):
+        checker = self._new_checker()
+        checker.MAX_CORRECT_WORDS = 3
+        backend = checker._backend
+        words = ["one", "two", "three", "four", "five"]
+        for word in words:
+            self.assertEqual(checker.query_cached(word), [])
+
+        # capped, the latest word always makes it in
+        self.assertEqual(len(checker._correct_words), 3)
+        self.assertIn(CorrectWordFilter.hash_word("five"),
+                      checker._correct_words)
+        self.assertEqual(len(checker._cached_queries), 0)
+
+        del backend.queried[:]
+        self.assertEqual(checker.query_cached("five"), [])
+        self.assertEqual(checker.query_many_cached(["five", "five"]),
+                         [[], []])
+        self.assertEqual(backend.queried, [])
+
+    def test_save_and_load_correct_words(self):
+        checker = self._new_checker()
+        checker.query_many_cached(["one", "teh", "two"])
+        checker.save_correct_words()
+
+        filename = os.path.join(self._cache_dir, "_FakeBackend-en_US.bin")
+        self.assertTrue(os.path.exists(filename))
+        with open(filename, "rb") as f:
+            data = f.read()
+        self.assertEqual(len(data), 2 * 8)
+        self.assertNotIn(b"one", data)  # hashes only
+
+        checker = self._new_checker()
+        backend = checker._backend
+        checker._load_correct_words()
+        self.assertEqual(checker.query_many_cached(["one", "two", "teh"]),
+                         [[], [], [[[0, 3], ["the"]]]])
+        self.assertEqual(backend.queried, ["teh"])
+
+        # other dictionaries, other correct words
+        del backend.queried[:]
+        checker.query_cached("three")
+        self.assertTrue(checker.set_dict_ids(["de_DE"]))
+        checker.query_cached("one")
+        self.assertEqual(backend.queried, ["three", "one"])
+        checker.set_dict_ids(["en_US"])
+
+        del backend.queried[:]
+        checker.query_many_cached(["one", "two", "three"])
+        self.assertEqual(backend.queried, [])
+        self.assertEqual(sorted(os.listdir(self._cache_dir)),
+                         ["_FakeBackend-de_DE.bin",
+                          "_FakeBackend-en_US.bin"])
+
+    def test_backend_not_running(self):
+        checker = self._new_checker()
+        checker.query_cached("one")
+        checker._backend.running = False
+
+        # no answer, no cache entry
+        self.assertEqual(checker.query_cached("two"), [])
+        self.assertEqual(checker.query_cached("teh"), [])
+        self.assertEqual(checker.query_many_cached(["three", "wrod"]),
+                         [[], []])
+        self.assertEqual(checker._correct_words,
+                         set([CorrectWordFilter.hash_word("one")]))
+        self.assertEqual(len(checker._cached_queries), 0)
+
+        # last answers before the backend died aren't persisted
+        checker.save_correct_words()
+        self.assertFalse(os.path.exists(self._cache_dir))
+
+
+class _BlockingBackend(_FakeBackend):
+    """ Backend answering only once released. """
+
+    def __init__(self, misspellings):
+        _FakeBackend.__init__(self, misspellings)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def query(self, text):
+        self.started.set()
+        self.release.wait(5)
+        return _FakeBackend.query(self, text)
+
+
+class TestSpellCheckerAsync(unittest.TestCase):
+
+    MISSPELLINGS = TestSpellCheckerCache.MISSPELLINGS
+
+    def setUp(self):
+        self._checker = SpellChecker()
+        self._backend = _BlockingBackend(self.MISSPELLINGS)
+        self._checker._backend = self._backend
+        self._callbacks = []
+
+    def tearDown(self):
+        self._backend.release.set()
+        self._wait_idle()
+
+    def _wait_idle(self):
+        if self._checker._executor:
+            self._checker._executor.shutdown()
+            self._checker._executor = None
+
+    def _query(self, word):
+        return self._checker.query_cached_async(
+            word, lambda: self._callbacks.append(word))
+
+    def test_latest_query_wins(self):
+        checker = self._checker
+        self.assertEqual(self._query("teh"), [])
+        self.assertTrue(self._backend.started.wait(5))
+
+        # "teh" is running, "wrod" queued, both superseded by "adn"
+        self.assertEqual(self._query("wrod"), [])
+        self.assertEqual(self._query("adn"), [])
+        self._backend.release.set()
+        self._wait_idle()
+
+        self.assertEqual(self._callbacks, ["adn"])
+        self.assertEqual(self._backend.queried, ["teh", "adn"])
+        self.assertEqual(self._query("adn"), [[[0, 3], ["and"]]])
+        self.assertEqual(list(checker._cached_queries), ["adn"])
+
+    def test_cached_word_drops_pending_query(self):
+        checker = self._checker
+        checker._add_query("teh", [[[0, 3], ["the"]]])
+        self.assertEqual(self._query("wrod"), [])
+        self.assertTrue(self._backend.started.wait(5))
+        self.assertEqual(self._query("teh"), [[[0, 3], ["the"]]])
+        self._backend.release.set()
+        self._wait_idle()
+
+        self.assertEqual(self._callbacks, [])
+        self.assertEqual(list(checker._cached_queries), ["teh"])
+
+    def test_callback_after_results_collected(self):
+        checker = self._checker
+
+        # Let the main thread collect the results before the worker
+        # thread gets around to calling back.
+        collected = threading.Event()
+        on_query_done = checker._on_query_done
+        def delayed_on_query_done(*args):
+            collected.wait(5)
+            on_query_done(*args)
+        checker._on_query_done = delayed_on_query_done
+
+        self.assertEqual(self._query("teh"), [])
+        future = checker._pending_query
+        self._backend.release.set()
+        wait([future], 5)
+
+        self.assertEqual(checker.query_cached("teh"), [[[0, 3], ["the"]]])
+        self.assertIsNone(checker._pending_query)
+        collected.set()
+        self._wait_idle()
+
+        self.assertEqual(self._callbacks, ["teh"])
+        self.assertEqual(self._backend.queried, ["teh"])
+
+    def test_invalidate_drops_running_query(self):
+        checker = self._checker
+        self.assertEqual(self._query("teh"), [])
+        self.assertTrue(self._backend.started.wait(5))
+        checker.invalidate_query_cache()
+        self._backend.release.set()
+        self._wait_idle()
+
+        self.assertEqual(self._callbacks, [])
+        self.assertEqual(checker.query_cached("teh"), [[[0, 3], ["the"]]])
+        self.assertEqual(self._backend.queried, ["teh", "teh"])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
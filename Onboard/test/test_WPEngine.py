@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+
+# Copyright © 2026 agent <agent@local>
+#
+# This file is part of Onboard.
+#
+# Onboard is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Onboard is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import errno
+import tempfile
+import threading
+import unittest
+from concurrent.futures import Future, wait
+
+from Onboard.WPEngine import ModelCache
+
+
+class _FakeModel:
+    """ Just enough of a language model for the cache. """
+
+    def __init__(self, size):
+        self.size = size
+        self.modified = False
+        self.load_error = False
+        self.journal = None
+        self.generation = 0
+
+    def memory_size(self):
+        return [self.size]
+
+
+class _FakeJournal:
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.flushes = 0
+        self.rebased = False
+
+    def flush(self):
+        if self.fail:
+            raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        self.flushes += 1
+
+    def begin_rebase(self, base_id, end):
+        self.rebased = True
+
+    def end_rebase(self):
+        pass
+
+
+class _ModelCache(ModelCache):
+    """
+    Cache with a fixed memory budget and fake models of known size,
+    independent of the configuration and the model files.
+    """
+
+    def __init__(self, budget, sizes, model_dir):
+        ModelCache.__init__(self)
+        self.budget = budget
+        self.sizes = sizes
+        self.model_dir = model_dir
+        self.loaded = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def get_memory_budget(self):
+        return self.budget
+
+    def estimate_memory_size(self, lmid):
+        return self.sizes.get(lmid, 10)
+
+    def get_filename(self, lmid):
+        type_, class_, name = lmid.split(":")
+        return os.path.join(self.model_dir, class_, name + "." + type_)
+
+    def load_model(self, lmid):
+        self.release.wait(5)
+        self.loaded.append(lmid)
+        return _FakeModel(self.sizes.get(lmid, 10))
+
+
+class TestModelCache(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory(prefix="test_onboard_")
+        self._caches = []
+
+    def tearDown(self):
+        for cache in self._caches:
+            cache.release.set()
+            if cache._executor:
+                cache._executor.shutdown()
+        self._tmp_dir.cleanup()
+
+    def _new_cache(self, budget, sizes={}):
+        cache = _ModelCache(budget, sizes, self._tmp_dir.name)
+        self._caches.append(cache)
+        return cache
+
+    @staticmethod
+    def _wait_loaded(cache):
+        wait(list(cache._loading.values()), 5)
+
+    def test_unlimited_budget(self):
+        cache = self._new_cache(0)
+        for name in ["en", "de", "fr", "es"]:
+            cache.get_model("lm:system:" + name)
+        self.assertEqual(len(cache._language_models), 4)
+
+    def test_evict_least_recently_used(self):
+        cache = self._new_cache(30)
+        cache.get_model("lm:system:en")
+        cache.get_model("lm:system:de")
+        cache.get_model("lm:system:fr")
+        cache.get_model("lm:system:en")
+        cache.get_model("lm:system:es")
+        self.assertEqual(list(cache._language_models),
+                         ["lm:system:fr", "lm:system:en", "lm:system:es"])
+        self.assertEqual(sorted(cache._memory_sizes),
+                         sorted(cache._language_models))
+
+    def test_pinned_models_stay(self):
+        cache = self._new_cache(20)
+        lmids = ["lm:system:en", "lm:system:de", "lm:system:fr"]
+        cache.set_pinned_models(lmids)
+        for lmid in lmids:
+            cache.get_model(lmid)
+        self.assertEqual(list(cache._language_models), lmids)
+
+        # unpinned, the least recently used go until within budget
+        cache.set_pinned_models(["lm:system:en"])
+        self.assertEqual(list(cache._language_models),
+                         ["lm:system:en", "lm:system:fr"])
+
+    def test_evict_system_models_first(self):
+        cache = self._new_cache(30)
+        cache.get_model("lm:user:en")
+        cache.get_model("lm:system:de")
+        cache.get_model("lm:system:fr")
+        cache.get_model("lm:system:es")
+        self.assertEqual(list(cache._language_models),
+                         ["lm:user:en", "lm:system:fr", "lm:system:es"])
+
+    def test_never_evict_mem_models(self):
+        cache = self._new_cache(10)
+        cache.get_model("lm:mem:scratch")
+        cache.get_model("lm:system:en")
+        self.assertEqual(list(cache._language_models), ["lm:mem:scratch"])
+
+    def test_save_user_model_before_evicting(self):
+        cache = self._new_cache(20)
+        model = cache.get_model("lm:user:en")
+        model.modified = True
+        model.journal = _FakeJournal()
+        cache.set_pinned_models(["lm:system:en", "lm:system:de"])
+        cache.get_model("lm:system:en")
+        cache.get_model("lm:system:de")
+
+        self.assertEqual(model.journal.flushes, 1)
+        self.assertFalse(model.modified)
+        self.assertEqual(list(cache._language_models),
+                         ["lm:system:en", "lm:system:de"])
+
+    def test_keep_user_model_failing_to_save(self):
+        cache = self._new_cache(20)
+        model = cache.get_model("lm:user:en")
+        model.modified = True
+        model.journal = _FakeJournal(fail=True)
+        cache.set_pinned_models(["lm:system:en", "lm:system:de"])
+        cache.get_model("lm:system:en")
+        cache.get_model("lm:system:de")
+
+        # over budget, but the changes must not be lost
+        self.assertTrue(model.modified)
+        self.assertIs(cache._language_models.get("lm:user:en"), model)
+        self.assertEqual(len(cache._language_models), 3)
+
+    def test_prefetch_stops_at_budget(self):
+        cache = self._new_cache(30, {"lm:system:fr" : 15,
+                                     "lm:system:es" : 5})
+        cache.get_model("lm:system:en")
+        cache.prefetch_models(["lm:system:en", "lm:system:de",
+                               "lm:system:fr", "lm:system:es"])
+        self.assertEqual(list(cache._loading), ["lm:system:de"])
+
+        self._wait_loaded(cache)
+        model = cache.get_model("lm:system:de", block=False)
+        self.assertIsNotNone(model)
+        self.assertEqual(list(cache._language_models),
+                         ["lm:system:en", "lm:system:de"])
+        self.assertEqual(cache._loading, {})
+
+    def test_prefetch_counts_models_being_loaded(self):
+        cache = self._new_cache(30)
+        cache.release.clear()
+        cache.prefetch_models(["lm:system:en", "lm:system:de"])
+        cache.prefetch_models(["lm:system:fr", "lm:system:es"])
+        self.assertEqual(sorted(cache._loading),
+                         ["lm:system:de", "lm:system:en", "lm:system:fr"])
+
+    def test_get_model_nonblocking(self):
+        cache = self._new_cache(0)
+        cache.release.clear()
+        self.assertIsNone(cache.get_model("lm:system:en", block=False))
+        self.assertIn("lm:system:en", cache._loading)
+        self.assertIsNone(cache.get_model("lm:system:en", block=False))
+        self.assertEqual(len(cache._loading), 1)
+
+        cache.release.set()
+        self._wait_loaded(cache)
+        model = cache.get_model("lm:system:en", block=False)
+        self.assertIsNotNone(model)
+        self.assertIs(cache.get_model("lm:system:en"), model)
+        self.assertEqual(cache._loading, {})
+        self.assertEqual(cache.loaded, ["lm:system:en"])
+
+    def test_get_model_waits_for_loading_model(self):
+        cache = self._new_cache(0)
+        cache.release.clear()
+        self.assertIsNone(cache.get_model("lm:system:en", block=False))
+        threading.Timer(0.1, cache.release.set).start()
+
+        # blocking, the running load is reused, not started again
+        model = cache.get_model("lm:system:en")
+        self.assertIsNotNone(model)
+        self.assertEqual(cache.loaded, ["lm:system:en"])
+
+    def test_load_models_async(self):
+        cache = self._new_cache(0)
+        model = cache.get_model("lm:system:en")
+        cache.release.clear()
+        futures = cache.load_models_async(["lm:system:en", "lm:system:de"])
+        self.assertTrue(futures[0].done())
+        self.assertIs(futures[0].result(), model)
+        self.assertIs(cache._loading["lm:system:de"], futures[1])
+        self.assertIs(cache.load_models_async(["lm:system:de"])[0],
+                      futures[1])
+
+        cache.release.set()
+        self._wait_loaded(cache)
+        self.assertIs(cache.get_model("lm:system:de", block=False),
+                      futures[1].result())
+
+    def _start_compaction(self, cache, lmid):
+        model = cache.get_model(lmid)
+        model.journal = _FakeJournal()
+
+        filename = cache.get_filename(lmid)
+        os.makedirs(os.path.dirname(filename))
+        for fn in [filename, cache.get_compact_filename(filename)]:
+            with open(fn, "w") as f:
+                f.write(fn)
+
+        future = Future()
+        future.set_result(b"base id")
+        cache._compacting[lmid] = (future, model, 0)
+        return model, filename
+
+    def test_finish_compaction(self):
+        cache = self._new_cache(0)
+        lmid = "lm:user:en"
+        model, filename = self._start_compaction(cache, lmid)
+        cache._finish_compactions()
+
+        self.assertTrue(model.journal.rebased)
+        self.assertFalse(os.path.exists(
+            cache.get_compact_filename(filename)))
+        with open(filename) as f:
+            self.assertEqual(f.read(), cache.get_compact_filename(filename))
+        self.assertEqual(cache._compacting, {})
+
+    def test_finish_compaction_of_dropped_model(self):
+        cache = self._new_cache(0)
+        lmid = "lm:user:en"
+        model, filename = self._start_compaction(cache, lmid)
+        cache.clear()
+        cache._finish_compactions()
+        self._assert_not_compacted(cache, model, filename)
+
+    def test_finish_compaction_of_reloaded_model(self):
+        # dropped and loaded again, the new model has its own journal
+        cache = self._new_cache(0)
+        lmid = "lm:user:en"
+        model, filename = self._start_compaction(cache, lmid)
+        cache.clear()
+        self.assertIsNot(cache.get_model(lmid), model)
+        cache._finish_compactions()
+        self._assert_not_compacted(cache, model, filename)
+
+    def _assert_not_compacted(self, cache, model, filename):
+        self.assertFalse(model.journal.rebased)
+        with open(filename) as f:
+            self.assertEqual(f.read(), filename)
+        self.assertEqual(cache._compacting, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -286,7 +286,10 @@ class Extension_lm(Extension):
                'lm_unigram.cpp',
                'lm_dynamic.cpp',
                'lm_merged.cpp',
+               'lm_binary.cpp',
+               'lm_frozen.cpp',
                'lm_python.cpp',
+               'lm_tokenize.cpp',
                'pool_allocator.cpp']
 
     depends = ['lm.h',
@@ -295,7 +298,11 @@ class Extension_lm(Extension):
                'lm_dynamic_impl.h',
                'lm_dynamic_kn.h',
                'lm_dynamic_cached.h',
-               'lm_merged.h']
+               'lm_merged.h',
+               'lm_binary.h',
+               'lm_frozen.h',
+               'lm_tokenize.h',
+               'thread_pool.h']
 
     def __init__(self, root = "", module_root = ""):
         path = join(root, 'pypredict', 'lm')